@@ -0,0 +1,5 @@
+"""Benchmarks of labeler hot paths on synthetic projects.
+
+Usage:
+    python -m labeler.benchmarks.run --num-keys 10000 --output results.json
+"""
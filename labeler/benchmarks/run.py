@@ -0,0 +1,330 @@
+"""Time hot paths of labelers and label stores on a synthetic project.
+
+Results are saved as JSON; pass a previous run's results to --compare to
+see which timings changed."""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import flask
+import numpy as np
+from werkzeug.datastructures import MultiDict
+
+from labeler.benchmarks import synthetic
+from labeler.label_stores.grouped_label_store import GroupedLabelStore
+from labeler.labelers import labeler_dict
+from labeler.labelers.video_box_classification import VideoBoxClassification
+
+
+def labeler_configs(project, output_root, num_items):
+    """Map labeler type to LABELER_ARGS for the synthetic project."""
+    def config(name, root, **kwargs):
+        return {
+            'root': str(project[root]),
+            'labels_csv': str(project['labels_csv']),
+            'output_dir': str(output_root / name),
+            **kwargs
+        }
+
+    return {
+        'SingleImageLabeler':
+        config('SingleImageLabeler', 'images'),
+        'SingleVideoLabeler':
+        config('SingleVideoLabeler', 'videos', num_items=num_items),
+        'SingleVideoWithThumbnailsLabeler':
+        config('SingleVideoWithThumbnailsLabeler',
+               'videos',
+               num_items=num_items),
+        'SingleVideoWithServersideThumbnailsLabeler':
+        config('SingleVideoWithServersideThumbnailsLabeler', 'videos'),
+        'SingleImageWithCaptionsLabeler':
+        config('SingleImageWithCaptionsLabeler',
+               'images',
+               image_caption_json=str(project['image_caption_json']),
+               num_items=num_items),
+        'AnchorPmkLabeler':
+        config('AnchorPmkLabeler',
+               'images',
+               pair_caption_json=str(project['pair_caption_json']),
+               num_items=num_items),
+        'GridLabeler':
+        config('GridLabeler', 'images', num_items=num_items),
+        'GridGifLabeler':
+        config('GridGifLabeler', 'gifs', num_items=num_items),
+        'GridSummaryVideoLabeler':
+        config('GridSummaryVideoLabeler', 'videos', num_items=num_items),
+        'VideoBoxClassification':
+        config('VideoBoxClassification',
+               'videos',
+               boxes_json=str(project['boxes_json']),
+               num_items=num_items),
+        'CocoVideoBoxClassification':
+        config('CocoVideoBoxClassification',
+               'videos',
+               frames_root=str(project['frames']),
+               coco_json=str(project['coco_json']),
+               vocabulary_json=str(project['vocabulary_json']),
+               num_items=num_items),
+    }
+
+
+def measure(fn, repeat=5):
+    """Call fn() `repeat` times; return summary of durations, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'repeat': repeat
+    }
+
+
+def page_form(labeler, keys, rng):
+    """Return a /submit form labeling `keys`, as sent by the labeler's page."""
+    form = {}
+    label_names = labeler.label_store.valid_labels
+    for key in keys:
+        escaped = labeler.escape_key(key)
+        form[f'{escaped}__notes'] = ''
+        if isinstance(labeler, VideoBoxClassification):
+            for track in labeler.boxes[key]:
+                form[f'{escaped}__{labeler.escape_key(track)}'] = ','.join(
+                    rng.sample(label_names, 2))
+        else:
+            for label in rng.sample(range(len(label_names)), 2):
+                form[f'{escaped}__{label}'] = 'on'
+    return form
+
+
+def benchmark_labeler(name, config, app, args, rng):
+    """Time hot paths of labeler `name`.
+
+    Returns:
+        results (dict): Map benchmark name to summary from measure(), or to
+            {'error': str} if the benchmark failed.
+    """
+    results = {}
+
+    def run(benchmark, fn, repeat):
+        try:
+            results[benchmark] = measure(fn, repeat)
+        except Exception as e:
+            logging.warning('%s: %s failed:\n%s', name, benchmark,
+                            traceback.format_exc())
+            results[benchmark] = {'error': f'{type(e).__name__}: {e}'}
+
+    labeler_class = labeler_dict[name]
+    output_dir = Path(config['output_dir'])
+
+    # Construct once to find the keys, then write a labeling history.
+    try:
+        labeler = labeler_class(**config)
+    except Exception as e:
+        logging.warning('%s: construction failed:\n%s', name,
+                        traceback.format_exc())
+        return {'construct': {'error': f'{type(e).__name__}: {e}'}}
+    label_store = labeler.label_store
+    grouped = (label_store.keys
+               if isinstance(label_store, GroupedLabelStore) else None)
+    shutil.rmtree(output_dir)
+    output_dir.mkdir(parents=True)
+    synthetic.write_history(output_dir / 'labels.json',
+                            label_store.keys,
+                            args.num_annotations,
+                            seed=args.seed,
+                            grouped_keys=grouped)
+
+    labelers = []
+    # Cold: caches (e.g. key orders and caption indices) are built.
+    run('construct_cold', lambda: labelers.append(labeler_class(**config)), 1)
+    run('construct_warm', lambda: labelers.append(labeler_class(**config)),
+        args.repeat)
+    if not labelers:
+        return results
+    labeler = labelers[-1]
+    label_store = labeler.label_store
+    keys = list(label_store.keys)
+
+    run('get_unlabeled',
+        lambda: label_store.get_unlabeled(labeler.num_items), args.repeat)
+    lookup_keys = [rng.choice(keys) for _ in range(args.num_lookups)]
+    run(f'get_label_x{args.num_lookups}',
+        lambda: [label_store.get_label(x) for x in lookup_keys], args.repeat)
+
+    page = label_store.get_unlabeled(labeler.num_items) or keys[:10]
+    form = page_form(labeler, page, rng)
+    run('parse_form', lambda: labeler.parse_form(form), args.repeat)
+    # Submitting includes labeler-specific work, e.g. AnchorPmkLabeler's
+    # label propagation. As in label.py, the form is a MultiDict.
+    submit_form = MultiDict(form)
+    run('submit', lambda: labeler.submit(submit_form), args.repeat)
+    run('dump_to_disk', label_store._dump_to_disk, args.repeat)
+
+    def render_index():
+        with app.test_request_context('/'):
+            labeler.index()
+
+    run('index', render_index, args.repeat)
+    return results
+
+
+def benchmark_filter_labels(labels_json, args):
+    try:
+        from labeler.filter_labels import filter_labels, load_labels
+    except ImportError as e:
+        # filter_labels requires script_utils.
+        return {'import': {'error': f'{type(e).__name__}: {e}'}}
+    labels, labels_list = load_labels([labels_json])
+    return {
+        'load_labels':
+        measure(lambda: load_labels([labels_json]), args.repeat),
+        'filter_labels':
+        measure(
+            lambda: filter_labels(labels,
+                                  labels_list,
+                                  must_have=labels_list[:1],
+                                  unspecified_labels_policy='can-have'),
+            args.repeat)
+    }
+
+
+def compare(results, previous):
+    """Print median timings of `results` relative to `previous` results."""
+    print(f'{"benchmark (median ms)":<60} {"previous":>10} {"current":>10} '
+          f'{"ratio":>7}')
+    for group, benchmarks in results['results'].items():
+        for benchmark, current in benchmarks.items():
+            old = previous['results'].get(group, {}).get(benchmark, {})
+            if 'median' not in current or 'median' not in old:
+                continue
+            print(f'{group + "/" + benchmark:<60} '
+                  f'{1000 * old["median"]:>10.3f} '
+                  f'{1000 * current["median"]:>10.3f} '
+                  f'{current["median"] / max(old["median"], 1e-9):>7.2f}')
+
+
+def main():
+    # Use first line of file docstring as description if it exists.
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0] if __doc__ else '',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--output', type=Path, required=True,
+                        help='JSON file to save results to.')
+    parser.add_argument('--num-keys', type=int, default=1000)
+    parser.add_argument('--num-annotations',
+                        type=int,
+                        default=None,
+                        help='Number of annotations in the labeling history. '
+                        'Defaults to num_keys / 2.')
+    parser.add_argument('--num-tracks',
+                        type=int,
+                        default=None,
+                        help='Number of box tracks. Defaults to 2 * num_keys.')
+    parser.add_argument('--num-items', type=int, default=10,
+                        help='Items per page.')
+    parser.add_argument('--num-lookups', type=int, default=1000,
+                        help='Number of get_label() calls to time together.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--labelers',
+                        nargs='*',
+                        help='Labeler types to benchmark. Defaults to all.')
+    parser.add_argument('--work-dir',
+                        type=Path,
+                        help='Where to generate the synthetic project. '
+                        'Defaults to a temporary directory, which is removed '
+                        'afterwards.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare',
+                        type=Path,
+                        help='Results JSON from a previous run to compare to.')
+
+    args = parser.parse_args()
+    if args.num_annotations is None:
+        args.num_annotations = args.num_keys // 2
+    logging.basicConfig(format='%(asctime)s %(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+
+    if args.work_dir is None:
+        work_dir = Path(tempfile.mkdtemp(prefix='labeler_benchmark_'))
+    else:
+        work_dir = args.work_dir
+        if work_dir.exists():
+            shutil.rmtree(work_dir)
+    rng = random.Random(args.seed)
+    # Renders templates from labeler/templates, like label.py's app.
+    app = flask.Flask('labeler')
+
+    try:
+        logging.info('Generating project with %s keys in %s', args.num_keys,
+                     work_dir)
+        start = time.perf_counter()
+        project = synthetic.make_project(work_dir / 'project',
+                                         num_keys=args.num_keys,
+                                         num_tracks=args.num_tracks,
+                                         seed=args.seed)
+        logging.info('Generated project in %.1fs',
+                     time.perf_counter() - start)
+        if not project['has_valid_videos']:
+            logging.warning('ffmpeg not found; videos are placeholders.')
+
+        configs = labeler_configs(project, work_dir / 'outputs',
+                                  args.num_items)
+        names = args.labelers or list(labeler_dict.keys())
+        results = {}
+        for name in names:
+            if name not in configs:
+                logging.warning('No synthetic config for %s; skipping.', name)
+                results[name] = {'error': 'No synthetic config.'}
+                continue
+            logging.info('Benchmarking %s', name)
+            results[name] = benchmark_labeler(name, configs[name], app, args,
+                                              rng)
+        logging.info('Benchmarking filter_labels')
+        labels_json = work_dir / 'filter_labels.json'
+        synthetic.write_history(labels_json,
+                                synthetic.relative_paths(
+                                    args.num_keys, '.jpg'),
+                                args.num_annotations,
+                                seed=args.seed)
+        results['filter_labels'] = benchmark_filter_labels(labels_json, args)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    output = {
+        'args': {k: str(v) for k, v in vars(args).items()},
+        'environment': {
+            'python': sys.version,
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')
+        },
+        'results': results
+    }
+    args.output.parent.mkdir(exist_ok=True, parents=True)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    logging.info('Saved results to %s', args.output)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(output, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
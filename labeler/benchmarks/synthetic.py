@@ -0,0 +1,243 @@
+"""Generate synthetic labeling projects for benchmarks."""
+
+import csv
+import io
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+# Label spec with a category row, as expected by the captions labelers.
+LABELS = [
+    # (name, row, propagate_anchors)
+    ('keep', 0, 0),
+    ('remove', 0, 0),
+    ('bad-anchor', 0, 1),
+    ('person', 1, 1),
+    ('bicycle', 1, 1),
+    ('car', 1, 1),
+    ('dog', 1, 1),
+    ('other', 1, 0),
+]
+KEYBOARD = 'qwertyuiopasdfghjkl'
+NUM_DIRECTORIES = 100
+
+
+def _image_bytes(image_format, size=(64, 48)):
+    output = io.BytesIO()
+    Image.new('RGB', size, (128, 64, 32)).save(output, format=image_format)
+    return output.getvalue()
+
+
+def _video_bytes():
+    """Return bytes of a short H.264 video, or None if ffmpeg is missing."""
+    if shutil.which('ffmpeg') is None:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'video.mp4'
+        subprocess.run([
+            'ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i',
+            'testsrc=duration=2:size=160x120:rate=10', '-pix_fmt', 'yuv420p',
+            str(path)
+        ],
+                       check=True)
+        return path.read_bytes()
+
+
+def relative_paths(num_keys, suffix):
+    """Return `num_keys` relative paths, spread over subdirectories."""
+    return [
+        f'{i % NUM_DIRECTORIES:03d}/item_{i:08d}{suffix}'
+        for i in range(num_keys)
+    ]
+
+
+def write_files(root, paths, data):
+    root = Path(root)
+    for path in paths:
+        path = root / path
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path.write_bytes(data)
+
+
+def write_labels_csv(path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            'index', 'keyboard', 'name', 'description_short',
+            'description_long', 'color', 'row', 'propagate_anchors'
+        ])
+        for i, (name, row, propagate) in enumerate(LABELS):
+            writer.writerow(
+                [i, KEYBOARD[i], name, name, name, 'gray', row, propagate])
+
+
+def random_annotation(key, rng, track_keys=None):
+    """Return an annotation as saved by the label stores.
+
+    Args:
+        track_keys (List[str], None): If specified, return a grouped
+            annotation (see GroupedLabelStore) with labels for these keys.
+    """
+    def random_labels():
+        return sorted(rng.sample(range(len(LABELS)), rng.randint(0, 3)))
+
+    if track_keys is None:
+        return {'key': key, 'labels': random_labels(), 'notes': ''}
+    return {
+        'key': key,
+        'labels': {x: random_labels()
+                   for x in track_keys},
+        'other_labels': {x: []
+                         for x in track_keys},
+        'notes': None
+    }
+
+
+def write_history(path, keys, num_annotations, seed=0, grouped_keys=None):
+    """Write labels.json with `num_annotations` annotations of `keys`.
+
+    Keys may be annotated more than once, as when labels are revised.
+
+    Args:
+        grouped_keys (Dict[str, List[str]], None): If specified, write
+            grouped annotations for keys in this dict.
+    """
+    rng = random.Random(seed)
+    keys = list(keys)
+    annotations = []
+    for _ in range(num_annotations if keys else 0):
+        key = rng.choice(keys)
+        annotations.append(
+            random_annotation(
+                key, rng,
+                grouped_keys[key] if grouped_keys is not None else None))
+    with open(path, 'w') as f:
+        json.dump({
+            'annotations': annotations,
+            'labels': [x[0] for x in LABELS]
+        }, f)
+
+
+def make_project(output_dir, num_keys=1000, num_tracks=None, num_steps=5,
+                 num_anchors=None, seed=0):
+    """Generate files for a synthetic labeling project.
+
+    Images, gifs and videos are tiny, and identical; videos are only valid if
+    ffmpeg is available, and are otherwise placeholder files, which labelers
+    that read videos (e.g. CocoVideoBoxClassification) cannot load.
+
+    Args:
+        output_dir (Path)
+        num_keys (int): Number of images, gifs and videos.
+        num_tracks (int): Number of box tracks, spread over the videos.
+            Defaults to 2 * num_keys.
+        num_steps (int): Number of annotated steps (frames) per video.
+        num_anchors (int): Number of anchors for AnchorPmkLabeler; each
+            anchor is paired with ~num_keys / num_anchors images. Defaults
+            to num_keys / 10.
+
+    Returns:
+        project (dict): Maps names (e.g. 'images', 'boxes_json') to paths.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    rng = random.Random(seed)
+    if num_tracks is None:
+        num_tracks = 2 * num_keys
+    if num_anchors is None:
+        num_anchors = max(num_keys // 10, 1)
+
+    project = {
+        'labels_csv': output_dir / 'labels.csv',
+        'images': output_dir / 'images',
+        'gifs': output_dir / 'gifs',
+        'videos': output_dir / 'videos',
+        'frames': output_dir / 'frames',
+        'boxes_json': output_dir / 'boxes.json',
+        'coco_json': output_dir / 'coco.json',
+        'vocabulary_json': output_dir / 'vocabulary.json',
+        'image_caption_json': output_dir / 'image_captions.json',
+        'pair_caption_json': output_dir / 'pair_captions.json',
+        'has_valid_videos': False
+    }
+    write_labels_csv(project['labels_csv'])
+
+    images = relative_paths(num_keys, '.jpg')
+    videos = relative_paths(num_keys, '.mp4')
+    write_files(project['images'], images, _image_bytes('JPEG'))
+    write_files(project['gifs'], relative_paths(num_keys, '.gif'),
+                _image_bytes('GIF'))
+    video_bytes = _video_bytes()
+    project['has_valid_videos'] = video_bytes is not None
+    write_files(project['videos'], videos, video_bytes or b'\0' * 1024)
+
+    # Boxes for VideoBoxClassification.
+    boxes = {x: {} for x in videos}
+    for track in range(num_tracks):
+        video = videos[track % num_keys]
+        x, y = rng.uniform(0, 100), rng.uniform(0, 80)
+        boxes[video][str(track)] = {
+            'boxes': {
+                str(step): [x + step, y + step, 40, 30]
+                for step in range(num_steps)
+            }
+        }
+    with open(project['boxes_json'], 'w') as f:
+        json.dump(boxes, f)
+
+    # The same boxes, in COCO format for CocoVideoBoxClassification.
+    coco = {'images': [], 'annotations': []}
+    image_ids = {}
+    frame_paths = []
+    for video in videos:
+        stem = video.rsplit('.', 1)[0]
+        for step in range(num_steps):
+            file_name = f'{stem}/frame_{step:04d}.jpg'
+            image_ids[(video, step)] = len(coco['images'])
+            coco['images'].append({
+                'id': len(coco['images']),
+                'file_name': file_name,
+                'frame_index': step * 5,
+                'video': stem
+            })
+            frame_paths.append(file_name)
+    for video, tracks in boxes.items():
+        for track, info in tracks.items():
+            for step, box in info['boxes'].items():
+                coco['annotations'].append({
+                    'id': len(coco['annotations']),
+                    'image_id': image_ids[(video, int(step))],
+                    'track_id': int(track),
+                    'bbox': box
+                })
+    write_files(project['frames'], frame_paths, _image_bytes('JPEG'))
+    with open(project['coco_json'], 'w') as f:
+        json.dump(coco, f)
+    with open(project['vocabulary_json'], 'w') as f:
+        json.dump(
+            {
+                'categories': [{
+                    'id': i,
+                    'name': x[0]
+                } for i, x in enumerate(LABELS)]
+            }, f)
+
+    # Captions.
+    words = ['a', 'person', 'riding', 'bicycle', 'with', 'dog', 'near', 'car']
+    with open(project['image_caption_json'], 'w') as f:
+        json.dump(
+            {x: ' '.join(rng.choices(words, k=8))
+             for x in images}, f)
+    anchors = images[:num_anchors]
+    pairs = {}
+    for i, pmk in enumerate(images):
+        key = f'{anchors[i % num_anchors]},{pmk}'
+        pairs[key] = ' '.join(rng.choices(words, k=8))
+    with open(project['pair_caption_json'], 'w') as f:
+        json.dump(pairs, f)
+    return project
@@ -1,40 +1,236 @@
 """Filter labels.json based on label criteria."""
 
 import argparse
-import collections
 import csv
 import json
 import logging
+import os
 from pathlib import Path
 from pprint import pformat
+from typing import NamedTuple, Sequence
+
+import numpy as np
 
 from script_utils.common import common_setup
 
+from labeler.label_sets import read_combined
 
-def load_labels(input_paths):
-    # Map data to list of (input_path, label) tuples.
-    labels = collections.defaultdict(list)
-    labels_list = None
-    for path in input_paths:
-        with open(path, 'r') as f:
-            annotations = json.load(f)
-            for i, row in enumerate(annotations['annotations']):
-                labels[row['key']].append((path, row))
-            if labels_list is None:
-                labels_list = annotations['labels']
-            else:
-                assert labels_list == annotations['labels']
-
-    for key, key_labels in labels.items():
-        if len(key_labels) > 1:
-            paths = [x[0] for x in key_labels]
-            logging.debug(
-                f'{key} labeled multiple times in {paths}; using latest '
-                f'label from {paths[-1]}.')
-        labels[key] = key_labels[-1][1]
+def load_labels(input_paths, num_workers=None, return_sources=False):
+    """Merge labels from labels.json files; later files take precedence.
+
+    A wrapper around label_sets.read_combined('overlay', ...): files are
+    streamed, and only the latest row for each key is kept while merging,
+    so memory is proportional to the number of keys rather than to the size
+    of the files.
+
+    Args:
+        input_paths (List[str]): labels.json files, oldest first.
+        num_workers (int): Number of processes to parse large inputs with.
+            Defaults to the number of CPUs; 1 parses in this process.
+        return_sources (bool): If True, also return a map from each key to
+            the path its row was taken from.
+
+    Returns:
+        labels (Dict[str, dict]): Map key to latest row for key.
+        labels_list (List[str])
+        sources (Dict[str, str]): Only returned if return_sources is True.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    rows, labels_list = read_combined('overlay',
+                                      input_paths,
+                                      num_workers=num_workers)
+    labels = {key: row for key, _, row in rows}
+    if return_sources:
+        sources = {key: str(input_paths[i]) for key, i, _ in rows}
+        return labels, labels_list, sources
     return labels, labels_list
 
 
+class Rule(NamedTuple):
+    """Criteria for selecting rows by their labels; see filter_labels()."""
+    name: str
+    must_have: Sequence[str] = ()
+    must_not_have: Sequence[str] = ()
+    can_have: Sequence[str] = ()
+    must_have_one_of: bool = False
+    unspecified_labels: str = 'error'
+
+
+class LabelMatrix:
+    """Labels of all rows as a (rows x labels) boolean matrix.
+
+    Built once, then used to evaluate any number of rules without looping
+    over rows in Python."""
+    def __init__(self, labels, labels_list):
+        """
+        Args:
+            labels (Dict[str, dict]): Map key to row, as returned by
+                load_labels().
+            labels_list (List[str])
+        """
+        self.labels_list = labels_list
+        self.label_map = {x: i for i, x in enumerate(labels_list)}
+        self.keys = list(labels.keys())
+        self.rows = list(labels.values())
+        counts = np.fromiter((len(x['labels']) for x in self.rows),
+                             dtype=np.int64,
+                             count=len(self.rows))
+        label_ids = np.fromiter(
+            (x for row in self.rows for x in row['labels']),
+            dtype=np.int64,
+            count=int(counts.sum()))
+        row_ids = np.repeat(np.arange(len(self.rows)), counts)
+        invalid = (label_ids < 0) | (label_ids >= len(labels_list))
+        if invalid.any():
+            i = int(np.argmax(invalid))
+            raise ValueError(
+                f'Row for key {self.keys[row_ids[i]]} has label id '
+                f'{label_ids[i]}, but there are only {len(labels_list)} '
+                f'labels.')
+        self.matrix = np.zeros((len(self.rows), len(labels_list)), dtype=bool)
+        self.matrix[row_ids, label_ids] = True
+
+    def _label_ids(self, names):
+        for name in names:
+            if name not in self.label_map:
+                raise ValueError('Unknown label %s, valid labels: %s' %
+                                 (name, self.label_map.keys()))
+        return {self.label_map[x] for x in names}
+
+    def resolve(self, rule):
+        """Return (must_have, must_not_have, can_have) label ids of rule."""
+        must_have = self._label_ids(rule.must_have)
+        must_not_have = self._label_ids(rule.must_not_have)
+        can_have = self._label_ids(rule.can_have)
+        unspecified = (set(range(len(self.labels_list))) -
+                       (must_have | must_not_have | can_have))
+        if unspecified:
+            policy = rule.unspecified_labels
+            if policy == 'error':
+                raise ValueError(
+                    'Label(s): %s were not specified in any of '
+                    '--{must,must-not,can}-have.' %
+                    [self.labels_list[x] for x in sorted(unspecified)])
+            elif policy == 'can-have':
+                can_have |= unspecified
+            elif policy == 'must-have':
+                must_have |= unspecified
+            elif policy == 'must-not-have':
+                must_not_have |= unspecified
+            else:
+                raise ValueError('Unknown unspecified_labels_policy %s' %
+                                 policy)
+        return must_have, must_not_have, can_have
+
+    def evaluate(self, rule):
+        """Evaluate rule on all rows.
+
+        Returns:
+            result (dict): Contains boolean arrays, with one entry per row:
+                'valid': Row matches the rule.
+                'missing': Row is missing must_have labels.
+                'unwanted': Row has must_not_have labels.
+        """
+        must_have, must_not_have, _ = self.resolve(rule)
+        must_have_matrix = self.matrix[:, sorted(must_have)]
+        if rule.must_have_one_of:
+            missing = ~must_have_matrix.any(axis=1)
+        else:
+            missing = ~must_have_matrix.all(axis=1)
+        unwanted = self.matrix[:, sorted(must_not_have)].any(axis=1)
+        return {
+            'valid': ~missing & ~unwanted,
+            'missing': missing,
+            'unwanted': unwanted
+        }
+
+    def log_rule(self, rule):
+        must_have, must_not_have, can_have = self.resolve(rule)
+
+        def names(ids):
+            return [self.labels_list[x] for x in sorted(ids)]
+
+        logging.info('Rule %s: looking for rows that', rule.name)
+        logging.info('MUST HAVE%s: %s',
+                     ' (one of)' if rule.must_have_one_of else '',
+                     names(must_have))
+        logging.info('MUST NOT HAVE: %s', names(must_not_have))
+        logging.info('CAN HAVE: %s', names(can_have))
+
+    def log_rejections(self, rule, result, file_logger):
+        """Log each row rejected by rule, and why."""
+        must_have, must_not_have, _ = self.resolve(rule)
+        for i in np.flatnonzero(~result['valid']):
+            row_labels = set(self.rows[i]['labels'])
+            if result['missing'][i]:
+                file_logger.info(
+                    'Label %s missing labels %s' %
+                    (pformat(dict(self.rows[i])),
+                     [self.labels_list[x] for x in must_have - row_labels]))
+            else:
+                file_logger.info(
+                    'Label %s has unwanted labels %s' %
+                    (pformat(dict(self.rows[i])),
+                     [self.labels_list[x]
+                      for x in row_labels & must_not_have]))
+
+
+def filter_rules(labels, labels_list, rules, file_logger=None,
+                 log_rejections=False):
+    """Select rows matching each of several rules.
+
+    Args:
+        labels (Dict[str, dict]): Map key to row, as returned by
+            load_labels().
+        labels_list (List[str])
+        rules (List[Rule])
+        log_rejections (bool): If True, log each rejected row to
+            file_logger. Otherwise, only counts are logged.
+
+    Returns:
+        results (Dict[str, Tuple[List[dict], List[dict]]]): Map rule name to
+            (matching rows, nonmatching rows).
+    """
+    if file_logger is None:
+        file_logger = logging.getLogger()
+    matrix = LabelMatrix(labels, labels_list)
+    results = {}
+    for rule in rules:
+        matrix.log_rule(rule)
+        result = matrix.evaluate(rule)
+        logging.info(
+            'Rule %s: %s/%s rows matched; %s missing must-have labels, %s '
+            'with must-not-have labels.', rule.name,
+            int(result['valid'].sum()), len(matrix.rows),
+            int(result['missing'].sum()), int(result['unwanted'].sum()))
+        if log_rejections:
+            matrix.log_rejections(rule, result, file_logger)
+        results[rule.name] = (
+            [matrix.rows[i] for i in np.flatnonzero(result['valid'])],
+            [matrix.rows[i] for i in np.flatnonzero(~result['valid'])])
+    return results
+
+
+def load_rules(rules_json):
+    """Load rules from a JSON file of the form
+
+        {
+            <name>: {
+                'must_have': List[str],
+                'must_not_have': List[str],
+                'can_have': List[str],
+                'must_have_one_of': bool,
+                'unspecified_labels': str
+            }, ...
+        }
+
+    where all fields are optional, and default to those of Rule."""
+    with open(rules_json, 'r') as f:
+        rules = json.load(f)
+    return [Rule(name=name, **fields) for name, fields in rules.items()]
+
+
 def filter_labels(labels,
                   labels_list,
                   file_logger=None,
@@ -43,84 +239,17 @@ def filter_labels(labels,
                   can_have=[],
                   must_have_one_of=False,
                   unspecified_labels_policy='error',
-                  return_nonmatching=False):
-    if file_logger is None:
-        file_logger = logging.getLogger()
-
-    label_map = {}
-    label_names = {}
-    for i, label in enumerate(labels_list):
-        label_map[label] = i
-        label_names[i] = label
-
-    def validate_label(label):
-        if label not in label_map:
-            raise ValueError('Unknown label %s, valid labels: %s' %
-                             (label, label_map.keys()))
-        return True
-
-    must_have_labels = set(
-        [label_map[x] for x in must_have if validate_label(x)])
-    must_not_have_labels = set(
-        [label_map[x] for x in must_not_have if validate_label(x)])
-    can_have_labels = set(
-        [label_map[x] for x in can_have if validate_label(x)])
-
-    unspecified_labels = (
-        set(label_map.values()) -
-        (must_have_labels | must_not_have_labels | can_have_labels))
-    if unspecified_labels:
-        if unspecified_labels_policy == 'error':
-            raise ValueError('Label(s): %s were not specified in any of '
-                             '--{must,must-not,can}-have.' %
-                             [label_names[x] for x in unspecified_labels])
-        elif unspecified_labels_policy == 'can-have':
-            can_have_labels |= unspecified_labels
-        elif unspecified_labels_policy == 'must-have':
-            must_have_labels |= unspecified_labels
-        elif unspecified_labels_policy == 'must-not-have':
-            must_not_have_labels |= unspecified_labels
-        else:
-            raise ValueError('Unknown unspecified_labels_policy %s' %
-                             unspecified_labels_policy)
-
-    logging.info('Looking for rows that')
-    if must_have_one_of:
-        logging.info('MUST HAVE (one of): %s',
-                     [label_names[x] for x in must_have_labels])
-    else:
-        logging.info('MUST HAVE: %s',
-                     [label_names[x] for x in must_have_labels])
-    logging.info('MUST NOT HAVE: %s',
-                 [label_names[x] for x in must_not_have_labels])
-    logging.info('CAN HAVE: %s', [label_names[x] for x in can_have_labels])
-
-    valid_rows = []
-    invalid_rows = []
-    for key, row in labels.items():
-        row_labels = set(row['labels'])
-        missing_labels = must_have_labels - row_labels
-        unwanted_labels = row_labels & must_not_have_labels
-        if must_have_one_of:
-            if missing_labels == must_have_labels:
-                file_logger.info('Label %s missing labels %s' % (pformat(
-                    dict(row)), [label_names[x] for x in missing_labels]))
-                invalid_rows.append(row)
-                continue
-        elif missing_labels:
-            file_logger.info(
-                'Label %s missing labels %s' %
-                (pformat(dict(row)), [label_names[x] for x in missing_labels]))
-            invalid_rows.append(row)
-            continue
-        if unwanted_labels:
-            file_logger.info(
-                'Label %s has unwanted labels %s' %
-                (pformat(dict(row)), [label_names[x]
-                                      for x in unwanted_labels]))
-            invalid_rows.append(row)
-            continue
-        valid_rows.append(row)
+                  return_nonmatching=False,
+                  log_rejections=False):
+    rule = Rule(name='filter',
+                must_have=must_have,
+                must_not_have=must_not_have,
+                can_have=can_have,
+                must_have_one_of=must_have_one_of,
+                unspecified_labels=unspecified_labels_policy)
+    valid_rows, invalid_rows = filter_rules(
+        labels, labels_list, [rule], file_logger,
+        log_rejections=log_rejections)[rule.name]
     if return_nonmatching:
         return valid_rows, invalid_rows
     else:
@@ -133,7 +262,19 @@ def main():
         description=__doc__.split('\n')[0] if __doc__ else '',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--input-labels', nargs='+', required=True)
-    parser.add_argument('--output-labels', type=Path, required=True)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--output-labels', type=Path)
+    output.add_argument(
+        '--rules',
+        type=Path,
+        help=('JSON file mapping rule names to criteria, e.g. '
+              '{"cats": {"must_have": ["cat"], "unspecified_labels": '
+              '"can-have"}}; see load_rules(). Labels matching each rule are '
+              'written to <output-dir>/<name>.json. Criteria flags below are '
+              'ignored.'))
+    parser.add_argument('--output-dir',
+                        type=Path,
+                        help='Output directory for --rules.')
     parser.add_argument(
         '--must-have',
         nargs='*',
@@ -163,23 +304,58 @@ def main():
         choices=['error', 'can-have', 'must-have', 'must-not-have'],
         default='error',
         help='What to do about labels not specified in flags.')
+    parser.add_argument(
+        '--log-rejections',
+        action='store_true',
+        help=('Log each rejected row and why. By default, only counts are '
+              'logged.'))
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        help=('Processes to parse large --input-labels with. Defaults to the '
+              'number of CPUs.'))
     args = parser.parse_args()
 
-    args.output_labels.parent.mkdir(exist_ok=True, parents=True)
-    file_logger = common_setup(
-        args.output_labels.name + '_' + Path(__file__).name,
-        args.output_labels.parent, args)
+    if args.rules is not None:
+        if args.output_dir is None:
+            parser.error('--rules requires --output-dir')
+        rules = load_rules(args.rules)
+        # Rule names are used as file names in --output-dir.
+        for rule in rules:
+            if (not rule.name or rule.name in ('.', '..')
+                    or any(x and x in rule.name
+                           for x in (os.sep, os.altsep))):
+                parser.error(f'Invalid rule name {rule.name!r} in '
+                             f'{args.rules}: rule names are used as file '
+                             f'names, and cannot contain path separators.')
+        outputs = {x.name: args.output_dir / f'{x.name}.json' for x in rules}
+        log_name = args.rules.name
+        output_dir = args.output_dir
+    else:
+        rules = [
+            Rule(name=args.output_labels.stem,
+                 must_have=args.must_have,
+                 must_not_have=args.must_not_have,
+                 can_have=args.can_have,
+                 must_have_one_of=args.must_have_one_of,
+                 unspecified_labels=args.unspecified_labels)
+        ]
+        outputs = {rules[0].name: args.output_labels}
+        log_name = args.output_labels.name
+        output_dir = args.output_labels.parent
+    output_dir.mkdir(exist_ok=True, parents=True)
+    file_logger = common_setup(log_name + '_' + Path(__file__).name,
+                               output_dir, args)
     logging.info('Args:\n%s', vars(args))
 
-    labels, labels_list = load_labels(args.input_labels)
-    valid_rows = filter_labels(labels, labels_list, file_logger,
-                               args.must_have, args.must_not_have,
-                               args.can_have, args.must_have_one_of,
-                               args.unspecified_labels)
-    logging.info(
-        '%s/%s rows matched criterion' % (len(valid_rows), len(labels)))
-    with open(args.output_labels, 'w') as f:
-        json.dump({'annotations': valid_rows, 'labels': labels_list}, f)
+    labels, labels_list = load_labels(args.input_labels,
+                                      num_workers=args.num_workers)
+    results = filter_rules(labels, labels_list, rules, file_logger,
+                           log_rejections=args.log_rejections)
+    for name, (valid_rows, _) in results.items():
+        with open(outputs[name], 'w') as f:
+            json.dump({'annotations': valid_rows, 'labels': labels_list}, f)
+        logging.info('Wrote %s rows to %s', len(valid_rows), outputs[name])
 
 
 if __name__ == "__main__":
@@ -1,12 +1,20 @@
 """Image labeler interface."""
+import logging
+import mimetypes
 import os
 import shutil
+import time
+import urllib.parse
 from pathlib import Path
 
 import flask
 from flask import Flask, abort, redirect, request
+from werkzeug.security import safe_join
 
-from labeler.labelers import labeler_dict
+from labeler.labelers.snapshot import load_labeler
+from labeler.utils import metrics, startup
+from labeler.utils.compression import compress_response
+from labeler.utils.profiling import RequestProfiler
 
 app = Flask(__name__)
 if 'FLASK_CONFIG' not in os.environ:
@@ -15,24 +23,121 @@ app.config.from_pyfile(os.environ['FLASK_CONFIG'])
 
 cfg = app.config
 
-labeler = labeler_dict[cfg['LABELER_TYPE']](**cfg['LABELER_ARGS'])
+# Log startup (e.g. phase timings and snapshot restores) unless the server
+# already configured logging.
+logging.basicConfig(format='%(asctime)s %(message)s',
+                    datefmt='%H:%M:%S',
+                    level=logging.INFO)
+
+# With LABELER_SNAPSHOT = True, restarts restore the labeler from a snapshot
+# in output_dir if its inputs haven't changed; see labeler.labelers.snapshot.
+labeler = load_labeler(
+    cfg['LABELER_TYPE'],
+    cfg['LABELER_ARGS'],
+    use_snapshot=cfg.get('LABELER_SNAPSHOT', False),
+    shallow_fingerprint=cfg.get('LABELER_SNAPSHOT_SHALLOW_FINGERPRINT', False))
+logging.info(startup.format_phases())
 
 if 'output_dir' in cfg['LABELER_ARGS']:
     output_dir = Path(cfg['LABELER_ARGS']['output_dir'])
     config_path = Path(os.environ['FLASK_CONFIG'])
     shutil.copy(config_path, output_dir / config_path.name)
 
+# Fraction of requests to profile with cProfile; see README.
+profile_rate = float(
+    os.environ.get('LABELER_PROFILE_REQUESTS', cfg.get('PROFILE_REQUESTS', 0)))
+if profile_rate > 0:
+    if 'PROFILE_DIR' in cfg:
+        profile_dir = cfg['PROFILE_DIR']
+    elif 'output_dir' in cfg['LABELER_ARGS']:
+        profile_dir = Path(cfg['LABELER_ARGS']['output_dir']) / 'profiles'
+    else:
+        raise ValueError('PROFILE_REQUESTS requires PROFILE_DIR or an '
+                         'output_dir in LABELER_ARGS.')
+    profiler = RequestProfiler(profile_dir,
+                               rate=profile_rate,
+                               min_seconds=cfg.get('PROFILE_MIN_SECONDS', 0))
+else:
+    profiler = None
+
+REQUEST_SECONDS = metrics.histogram('labeler_request_duration_seconds',
+                                    'Time to handle requests.',
+                                    ['route', 'method', 'status'])
+
+
+def route_label():
+    """Route of the current request, for metrics.
+
+    /api and /file requests are grouped by API request and public
+    directory."""
+    if request.url_rule is None:
+        return 'unmatched'
+    if request.endpoint == 'api':
+        return '/api/' + request.view_args['api_request'].split('/', 1)[0]
+    if request.endpoint == 'file':
+        return '/file/' + request.view_args['path'].split('/', 1)[0]
+    return request.url_rule.rule
+
+
+@app.before_request
+def start_timer():
+    flask.g.request_start = time.perf_counter()
+    flask.g.profile = profiler.start() if profiler is not None else None
+
+
+# Runs after all after_request functions, and also if the request failed.
+@app.teardown_request
+def save_profile(exception):
+    profile = flask.g.pop('profile', None)
+    if profile is not None:
+        profiler.finish(profile, route_label(),
+                        time.perf_counter() - flask.g.request_start)
+
+
+# after_request functions run in reverse order of registration, so this
+# includes the time to compress responses.
+@app.after_request
+def record_request_metrics(response):
+    REQUEST_SECONDS.observe(time.perf_counter() - flask.g.request_start,
+                            route=route_label(),
+                            method=request.method,
+                            status=response.status_code)
+    return response
+
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return flask.Response(metrics.render(),
+                          mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/')
 def index():
     return labeler.index()
 
 
+@app.route('/batch')
+def batch():
+    """Return a later page as JSON, for the client to prefetch."""
+    if not hasattr(labeler, 'batch'):
+        abort(404)
+    return flask.jsonify(labeler.batch(request.args.get('page', 1, type=int)))
+
+
 @app.route('/submit', methods=['POST'])
 def submit():
     output = labeler.submit(request.form)
     if not output:
-        output = redirect('/')
+        if request.accept_mimetypes.best == 'application/json':
+            # Submitted in the background by the client.
+            output = flask.jsonify({'success': True})
+        else:
+            output = redirect('/')
     return output
 
 
@@ -48,4 +153,18 @@ def file(path):
     if key not in public_directories:
         abort(404)
     full_path = Path(public_directories[key]) / path
+    if cfg.get('MEDIA_ACCEL_REDIRECT'):
+        # Let a reverse proxy (e.g. nginx) serve the file, instead of tying up
+        # a worker process; see `python -m labeler.serve --help`.
+        if safe_join(public_directories[key], path) is None:
+            abort(404)
+        response = flask.Response(
+            mimetype=(mimetypes.guess_type(path)[0]
+                      or 'application/octet-stream'))
+        # Quoted, since nginx decodes the redirect URI, and header values
+        # can't hold arbitrary characters.
+        response.headers['X-Accel-Redirect'] = (
+            f'{cfg["MEDIA_ACCEL_REDIRECT"].rstrip("/")}/'
+            f'{urllib.parse.quote(f"{key}/{path}")}')
+        return response
     return flask.send_from_directory(full_path.parent, full_path.name)
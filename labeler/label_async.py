@@ -0,0 +1,176 @@
+"""Async (ASGI) variant of the labeler interface in label.py.
+
+Serves the same routes with the same labelers, but media files are streamed
+without holding a thread per request, so one process can serve many
+concurrent media requests. All other routes (pages, submissions, /api/...)
+are handled by label.py's Flask app in a bounded thread pool.
+
+Media and static files are timed in /metrics and compressed like in
+label.py.
+
+Requires starlette and an ASGI server, e.g.:
+
+    FLASK_CONFIG=imagenetvid.cfg uvicorn labeler.label_async:app \
+        --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import mimetypes
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import anyio
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.routing import Route
+from starlette.staticfiles import StaticFiles
+from werkzeug.http import parse_accept_header
+from werkzeug.security import safe_join
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from labeler import label
+from labeler.utils.compression import (COMPRESSIBLE_MIMETYPES,
+                                       choose_encoding, compress_file)
+
+cfg = label.cfg
+
+# Labeler calls may block on disk or on subprocesses (e.g. generating
+# thumbnails); limit how many run at once.
+labeler_executor = ThreadPoolExecutor(cfg.get('ASYNC_LABELER_THREADS', 8))
+
+
+def _run_flask(environ):
+    app_iter, status, headers = run_wsgi_app(label.app.wsgi_app,
+                                             environ,
+                                             buffered=True)
+    try:
+        content = b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return content, status, headers
+
+
+async def flask_route(request):
+    """Handle request with label.py's Flask app in the labeler executor."""
+    body = await request.body()
+    headers = [(k, v) for k, v in request.headers.items()
+               if k not in ('content-type', 'content-length')]
+    environ = EnvironBuilder(path=request.url.path,
+                             query_string=request.url.query,
+                             method=request.method,
+                             headers=headers,
+                             content_type=request.headers.get('content-type'),
+                             data=body).get_environ()
+    if request.client is not None:
+        environ['REMOTE_ADDR'] = request.client.host
+
+    loop = asyncio.get_running_loop()
+    content, status, headers = await loop.run_in_executor(
+        labeler_executor, _run_flask, environ)
+    response = Response(content, status_code=int(status.split(' ', 1)[0]))
+    response.raw_headers = [(k.lower().encode('latin-1'),
+                             v.encode('latin-1')) for k, v in headers]
+    return response
+
+
+async def _compress(request, response):
+    """Compress text files (e.g. static CSS and JS), as label.compress()
+    does for Flask responses."""
+    if (not isinstance(response, FileResponse)
+            or response.status_code != 200
+            or response.media_type not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.headers['vary'] = 'Accept-Encoding'
+    encoding = choose_encoding(
+        parse_accept_header(request.headers.get('accept-encoding')))
+    if encoding is None:
+        return response
+    # Compressed files are cached, so each file is only read and compressed
+    # once.
+    compressed = await anyio.to_thread.run_sync(compress_file, response.path,
+                                                encoding)
+    if compressed is None:
+        return response
+    headers = dict(response.headers)
+    # Ranges and the length would refer to the uncompressed body.
+    for name in ('accept-ranges', 'content-length', 'content-type'):
+        headers.pop(name, None)
+    headers['content-encoding'] = encoding
+    if 'etag' in headers and not headers['etag'].startswith('W/'):
+        headers['etag'] = 'W/' + headers['etag']
+    return Response(compressed,
+                    headers=headers,
+                    media_type=response.media_type)
+
+
+def _instrumented(endpoint, route_label):
+    """Wrap endpoint to record REQUEST_SECONDS and compress responses, like
+    label.py's before_request and after_request functions.
+
+    Args:
+        endpoint (Callable[[Request], Awaitable[Response]])
+        route_label (Callable[[Request], str]): Route for metrics; see
+            label.route_label().
+    """
+    async def instrumented(request):
+        start = time.perf_counter()
+        try:
+            response = await endpoint(request)
+        except HTTPException as e:
+            response = Response(status_code=e.status_code)
+        response = await _compress(request, response)
+        label.REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                      route=route_label(request),
+                                      method=request.method,
+                                      status=response.status_code)
+        return response
+
+    return instrumented
+
+
+async def file(request):
+    key = request.path_params['key']
+    path = request.path_params['path']
+    public_directories = label.labeler.public_directories()
+    if public_directories.get(key) is None:
+        return Response(status_code=404)
+    full_path = safe_join(str(public_directories[key]), path)
+    if full_path is None or not await anyio.Path(full_path).is_file():
+        return Response(status_code=404)
+    if cfg.get('MEDIA_ACCEL_REDIRECT'):
+        return Response(
+            media_type=(mimetypes.guess_type(path)[0]
+                        or 'application/octet-stream'),
+            headers={
+                'X-Accel-Redirect':
+                f'{cfg["MEDIA_ACCEL_REDIRECT"].rstrip("/")}/'
+                f'{urllib.parse.quote(f"{key}/{path}")}'
+            })
+    return FileResponse(full_path)
+
+
+static_files = StaticFiles(directory=Path(label.__file__).parent / 'static')
+
+
+async def static(request):
+    return await static_files.get_response(request.path_params['path'],
+                                           request.scope)
+
+
+def file_route(request):
+    return '/file/' + request.path_params['key']
+
+
+def static_route(request):
+    # Route of static files in label.py.
+    return '/static/<path:filename>'
+
+
+app = Starlette(routes=[
+    Route('/file/{key}/{path:path}', _instrumented(file, file_route)),
+    Route('/static/{path:path}', _instrumented(static, static_route)),
+    Route('/{path:path}', flask_route, methods=['GET', 'POST']),
+])
@@ -0,0 +1,335 @@
+"""Combine label files by key: union, intersection, difference or overlay.
+
+Inputs and output can be labels.json, JSONL or CSV files; see
+labeler/utils/label_files.py. Within each input, the latest row for a key is
+used, as in labels.json histories. Across inputs:
+
+    union: Keys in any input, labeled as in the first input with the key.
+    intersection: Keys in all inputs, labeled as in the first input.
+    difference: Keys in the first input that are in none of the others.
+    overlay: Keys in any input, labeled as in the last input with the key
+        (as in filter_labels.load_labels()).
+
+Keys are output in the order they first appear in the inputs.
+
+Inputs are streamed. Inputs larger than --partition-mb are split by key hash
+into partitions on disk, which are combined one at a time, so memory is
+bounded by the partition size rather than the input size. With
+--num-workers, several large inputs are parsed in parallel."""
+
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from pathlib import Path
+
+from labeler.utils.label_files import LabelReader, gc_paused, write_labels
+from labeler.utils.log import setup_logging
+
+OPERATIONS = ('union', 'intersection', 'difference', 'overlay')
+
+# Parse inputs in worker processes if they total at least this many bytes;
+# for smaller inputs, sending rows back from workers costs more than it saves.
+PARALLEL_MIN_BYTES = 64 * 2**20
+
+
+def _read_latest_rows(path, key_column, keep_rows):
+    """Return (labels_list, fieldnames, [(key, latest row for key), ...])
+    for a label file; run in worker processes."""
+    reader = LabelReader(path, key_column)
+    with gc_paused():
+        rows = {key: row if keep_rows else None for key, row in reader}
+    return reader.labels_list, reader.fieldnames, list(rows.items())
+
+
+class _ParsedFile:
+    """Rows parsed by a worker, iterable like a LabelReader."""
+    def __init__(self, path, labels_list, fieldnames, rows):
+        self.path = path
+        self.labels_list = labels_list
+        self.fieldnames = fieldnames
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class _Inputs:
+    """Stream (input index, sequence number, key, row) for rows of inputs.
+
+    Sequence numbers increase across inputs, and are used to output keys in
+    the order they first appear."""
+    def __init__(self, paths, operation, key_column=None, num_workers=1):
+        self.paths = [Path(x) for x in paths]
+        self.key_column = key_column
+        self.num_workers = num_workers
+        # Labels from inputs other than the first are only used by union and
+        # overlay; other operations only need their keys.
+        self.keep_rows = operation in ('union', 'overlay')
+        self.labels_list = None
+        self.labels_list_path = None
+        # Columns of the first input, if it is a CSV.
+        self.fieldnames = None
+        self.num_rows = [0 for _ in paths]
+
+    def __iter__(self):
+        sequence = 0
+        for i, reader in enumerate(self._readers()):
+            keep_rows = self.keep_rows or i == 0
+            for key, row in reader:
+                yield i, sequence, key, row if keep_rows else None
+                sequence += 1
+                self.num_rows[i] += 1
+            if i == 0:
+                self.fieldnames = reader.fieldnames
+            self._check_vocabulary(reader)
+
+    def _readers(self):
+        """Yield a LabelReader, or a _ParsedFile, for each input in order.
+
+        Inputs parsed by workers only contain the latest row for each key,
+        which is all that combining them uses."""
+        num_bytes = sum(os.path.getsize(x) for x in self.paths)
+        # A single labels.json can't be split without parsing it, so only
+        # multiple inputs are parsed in parallel.
+        if (self.num_workers <= 1 or len(self.paths) <= 1
+                or num_bytes < PARALLEL_MIN_BYTES):
+            for path in self.paths:
+                yield LabelReader(path, self.key_column)
+            return
+        with ProcessPoolExecutor(self.num_workers) as executor:
+            # Keep at most one pending file per worker, so finished files
+            # don't pile up in memory waiting for earlier ones to be read.
+            pending = collections.deque()
+            for i, path in enumerate(self.paths):
+                if len(pending) >= self.num_workers:
+                    done_path, future = pending.popleft()
+                    yield _ParsedFile(done_path, *future.result())
+                future = executor.submit(_read_latest_rows, path,
+                                         self.key_column, self.keep_rows
+                                         or i == 0)
+                pending.append((path, future))
+            while pending:
+                done_path, future = pending.popleft()
+                yield _ParsedFile(done_path, *future.result())
+
+    def _check_vocabulary(self, reader):
+        if reader.labels_list is None:
+            return
+        if self.labels_list is None:
+            self.labels_list = reader.labels_list
+            self.labels_list_path = reader.path
+        elif reader.labels_list != self.labels_list:
+            raise ValueError(f'Labels in {reader.path} do not match labels '
+                             f'in {self.labels_list_path}')
+
+
+def _combine_records(operation, records, num_inputs):
+    """Combine records from _Inputs (or a partition of them).
+
+    Returns:
+        rows (List[Tuple[int, int, str, dict]]): (sequence number, index of
+            input the row is from, key, row) for selected keys, sorted by
+            sequence number.
+    """
+    # Map key to [first sequence number, input of row, row, number of
+    # inputs with key, last input with key].
+    entries = {}
+    with gc_paused():
+        for i, sequence, key, row in records:
+            entry = entries.get(key)
+            if entry is None:
+                entries[key] = [sequence, i, row, 1, i]
+                continue
+            if entry[4] != i:
+                entry[3] += 1
+                entry[4] = i
+            if operation == 'overlay' or entry[1] == i:
+                entry[1] = i
+                entry[2] = row
+
+        if operation == 'intersection':
+            selected = (x for x in entries.items() if x[1][3] == num_inputs)
+        elif operation == 'difference':
+            selected = (x for x in entries.items()
+                        if x[1][1] == 0 and x[1][3] == 1)
+        else:
+            selected = entries.items()
+        return sorted(((x[0], x[1], key, x[2]) for key, x in selected),
+                      key=itemgetter(0))
+
+
+def _partition(key, num_partitions):
+    return zlib.crc32(key.encode('utf-8', 'surrogateescape')) % num_partitions
+
+
+def _read_jsonl(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _combine_partitioned(operation, inputs, num_partitions, work_dir):
+    """Yield (sequence number, row) for selected keys, in order, spilling
+    inputs to `num_partitions` partitions in work_dir."""
+    partition_paths = [
+        work_dir / f'partition_{i}.jsonl' for i in range(num_partitions)
+    ]
+    partition_files = [open(x, 'w') for x in partition_paths]
+    try:
+        for record in inputs:
+            partition_files[_partition(record[2], num_partitions)].write(
+                json.dumps(record) + '\n')
+    finally:
+        for f in partition_files:
+            f.close()
+
+    result_paths = []
+    for i, path in enumerate(partition_paths):
+        rows = _combine_records(operation, _read_jsonl(path),
+                                len(inputs.paths))
+        os.remove(path)
+        result_paths.append(work_dir / f'result_{i}.jsonl')
+        with open(result_paths[-1], 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+        logging.info('Combined partition %s/%s', i + 1, num_partitions)
+    yield from heapq.merge(*[_read_jsonl(x) for x in result_paths],
+                           key=itemgetter(0))
+
+
+def read_combined(operation, input_paths, key_column=None, num_workers=1):
+    """Combine label files in memory; see combine().
+
+    Returns:
+        rows (List[Tuple[str, int, dict]]): (key, index of input the row is
+            from, row) for selected keys, in the order keys first appear.
+        labels_list (List[str]): Label vocabulary of the inputs, or None if
+            they have none.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f'Unknown operation {operation}; expected one of '
+                         f'{OPERATIONS}')
+    inputs = _Inputs(input_paths, operation, key_column, num_workers)
+    rows = _combine_records(operation, inputs, len(input_paths))
+    return [(key, i, row) for _, i, key, row in rows], inputs.labels_list
+
+
+def combine(operation,
+            input_paths,
+            output_path,
+            key_column=None,
+            partition_bytes=256 * 2**20,
+            work_dir=None,
+            fieldnames=None,
+            num_workers=1):
+    """Combine label files by key, and write the result to output_path.
+
+    Args:
+        operation (str): One of OPERATIONS.
+        input_paths (List[str or Path])
+        output_path (str or Path)
+        key_column (str): Field containing keys; see LabelReader.
+        partition_bytes (int): Inputs totaling more than this many bytes are
+            partitioned on disk.
+        work_dir (str or Path): Directory for partitions. Defaults to the
+            system temporary directory.
+        fieldnames (List[str]): Columns of CSV outputs. Defaults to the
+            columns of the first input, if it is a CSV, or else to the
+            fields of the first row.
+        num_workers (int): Number of processes to parse large inputs with.
+
+    Returns:
+        num_rows (int): Number of rows written.
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f'Unknown operation {operation}; expected one of '
+                         f'{OPERATIONS}')
+    inputs = _Inputs(input_paths, operation, key_column, num_workers)
+    num_bytes = sum(os.path.getsize(x) for x in input_paths)
+    num_partitions = max(1, math.ceil(num_bytes / partition_bytes))
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        if num_partitions == 1:
+            rows = iter(
+                _combine_records(operation, inputs, len(input_paths)))
+        else:
+            logging.info('Partitioning %.1fMB of inputs into %s partitions',
+                         num_bytes / 2**20, num_partitions)
+            rows = _combine_partitioned(operation, inputs, num_partitions,
+                                        Path(tmp_dir))
+        # Inputs are fully read once the first row is available.
+        first = next(rows, None)
+        logging.info('Read %s rows from %s inputs', sum(inputs.num_rows),
+                     len(input_paths))
+        if fieldnames is None:
+            fieldnames = inputs.fieldnames
+        with write_labels(output_path, inputs.labels_list,
+                          fieldnames) as writer:
+            if first is not None:
+                rows = itertools.chain([first], rows)
+            for _, _, _, row in rows:
+                writer.write(row)
+    return writer.num_rows
+
+
+def main():
+    # Use first line of file docstring as description if it exists.
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0] if __doc__ else '',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('operation', choices=OPERATIONS)
+    parser.add_argument('inputs',
+                        nargs='+',
+                        type=Path,
+                        help='Label files (.json, .jsonl or .csv).')
+    parser.add_argument('--output',
+                        type=Path,
+                        required=True,
+                        help='Output label file (.json, .jsonl or .csv).')
+    parser.add_argument(
+        '--key-column',
+        help=('Field containing keys. Defaults to "key", or to "video" for '
+              'CSVs without a "key" column.'))
+    parser.add_argument(
+        '--partition-mb',
+        type=float,
+        default=256,
+        help=('Inputs larger than this are partitioned by key on disk, and '
+              'combined one partition at a time.'))
+    parser.add_argument('--work-dir',
+                        type=Path,
+                        help=('Directory for partitions. Defaults to the '
+                              'system temporary directory.'))
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=1,
+        help=('Processes to parse inputs with, when there are several large '
+              'inputs.'))
+
+    args = parser.parse_args()
+    args.output.parent.mkdir(exist_ok=True, parents=True)
+    setup_logging(str(args.output) + '.log')
+    logging.info('Args:\n%s', vars(args))
+
+    num_rows = combine(args.operation,
+                       args.inputs,
+                       args.output,
+                       key_column=args.key_column,
+                       partition_bytes=args.partition_mb * 2**20,
+                       work_dir=args.work_dir,
+                       num_workers=args.num_workers)
+    logging.info('Wrote %s rows to %s', num_rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
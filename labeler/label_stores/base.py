@@ -17,3 +17,11 @@ class LabelStore(ABC):
     @abstractmethod
     def num_total(self):
         pass
+
+    def prepare(self):
+        """Compute state that is otherwise computed on the first request.
+
+        Called once the labeler is constructed, so that the cost shows up in
+        startup phases (and is saved in snapshots) instead of slowing the
+        first request."""
+        pass
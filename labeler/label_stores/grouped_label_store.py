@@ -6,7 +6,8 @@ from pathlib import Path
 
 from natsort import natsorted
 
-from .json_label_store import JsonLabelStore
+from .json_label_store import JsonLabelStore, shared_by_default
+from ..utils import metrics, startup
 
 
 class GroupedLabelStore(JsonLabelStore):
@@ -31,34 +32,50 @@ class GroupedLabelStore(JsonLabelStore):
                  extra_fields=[],
                  initial_labels=None,
                  initial_keys_only=False,
-                 seed=0):
+                 seed=0,
+                 shared=None,
+                 order=None):
         """
         Args:
             grouped_keys (Dict[str, List[str]])
             <rest as in JsonLabelStore>
         """
-        self.keys = {k: set(v) for k, v in grouped_keys.items()}
+        self._set_keys(grouped_keys)
         self.valid_labels = labels
         self.extra_fields = extra_fields
         self.output = Path(output_json) if output_json is not None else None
         self.seed = seed
+        # Grouped keys are always shuffled with natsort; see get_unlabeled().
+        self.order_method = 'natsort'
+        # None if shared should follow shared_by_default(); see
+        # __setstate__.
+        self._shared_arg = shared
+        self.shared = shared_by_default() if shared is None else shared
+        self._disk_stat = None
+        self._batch = None
 
-        if self.output is not None and self.output.exists():
-            self._load_from_disk(self.output)
-        else:
-            # List of dicts of the form:
-            #   {'key': str, 'labels': {<key>: List[int]}, <extra fields>}
-            self.current_labels = []
+        with startup.phase('load_labels'):
+            if self.output is not None and self.output.exists():
+                self._load_from_disk(self.output)
+            else:
+                # current_labels is a list of dicts of the form:
+                #   {'key': str, 'labels': {<key>: List[int]}, <extra fields>}
+                self._set_current_labels([])
 
         # We create an initial labels store only if `initial_labels` is
         # specified, or when `setup_initial_label` is called, to avoid creating
         # infinite recursive initial label stores.
         if initial_labels is not None:
-            self.setup_initial_labels(initial_labels,
-                                      initial_keys_only=initial_keys_only)
+            with startup.phase('initial_labels'):
+                self.setup_initial_labels(initial_labels,
+                                          initial_keys_only=initial_keys_only)
         else:
             self.initial_labels = None
 
+    def _check_keys(self, keys):
+        # Unknown group keys are reported by _check_annotation.
+        pass
+
     def _check_annotation(self, annotation):
         key = annotation['key']
         if key not in self.keys:
@@ -95,11 +112,24 @@ class GroupedLabelStore(JsonLabelStore):
                 x['key']: self.keys[x['key']]
                 for x in json.load(f)['annotations']
             }
-        self.initial_labels.keys = keys
-        self.keys = keys
-        self.initial_labels.current_labels = [
+        self.initial_labels._set_keys(keys)
+        self._set_keys(keys)
+        self.initial_labels._set_current_labels([
             x for x in self.initial_labels.current_labels if x['key'] in keys
-        ]
+        ])
+
+    def _set_keys(self, grouped_keys):
+        self.keys = {k: set(v) for k, v in grouped_keys.items()}
+
+    def _reset_labeled(self):
+        pass
+
+    def prepare(self):
+        # Group keys are sorted on each request; see get_unlabeled().
+        pass
+
+    def _mark_labeled(self, keys):
+        pass
 
     def update(self, labels):
         """
@@ -107,13 +137,14 @@ class GroupedLabelStore(JsonLabelStore):
             labels (dict): Map group key to dict containing
                 {'labels': {<key>: List[int], ...}, [extra_fields]: ...}
         """
+        annotations = []
         for key, label_info in labels.items():
             annotation = {'key': key}
             for k, v in label_info.items():
                 annotation[k] = v
             self._check_annotation(annotation)
-            self.current_labels.append(annotation)
-        self._dump_to_disk()
+            annotations.append(annotation)
+        self._append(annotations)
 
     def update_initial_labels(self, labels):
         """
@@ -124,7 +155,11 @@ class GroupedLabelStore(JsonLabelStore):
         return super().update_initial_labels(labels)
 
     def get_unlabeled(self, num_items, randomized=True):
-        unlabeled = natsorted(set(self.keys.keys()) - self.labeled_keys())
-        if randomized:
-            random.Random(self.seed).shuffle(unlabeled)
-        return unlabeled[:num_items]
+        with metrics.timer('get_unlabeled'):
+            unlabeled = natsorted(set(self.keys.keys()) - self.labeled_keys())
+            if randomized:
+                random.Random(self.seed).shuffle(unlabeled)
+            return unlabeled[:num_items]
+
+    def num_completed(self):
+        return len(self.labeled_keys() & self.keys.keys())
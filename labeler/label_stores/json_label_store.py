@@ -1,11 +1,36 @@
+import contextlib
 import copy
+import hashlib
 import json
+import logging
+import os
 import random
+import zipfile
 from pathlib import Path
 
-from natsort import natsorted
+import numpy as np
+from natsort import index_natsorted
 
 from labeler.label_stores.base import LabelStore
+from labeler.label_stores.key_registry import KeyRegistry
+from labeler.utils import metrics, startup
+from labeler.utils.fs import atomic_write, file_lock
+
+DUMP_BYTES = metrics.histogram('labeler_label_dump_bytes',
+                               'Size of label JSON files written.',
+                               buckets=[4**i * 1024 for i in range(11)])
+
+# Errors from loading a missing, truncated or corrupt key order file.
+_ORDER_LOAD_ERRORS = (OSError, EOFError, KeyError, ValueError,
+                      zipfile.BadZipFile)
+
+
+def shared_by_default():
+    """Whether label stores should be shared across server processes.
+
+    Set by `labeler.serve` through the LABELER_SHARED_LABEL_STORE environment
+    variable, so that labelers don't need to know how they are served."""
+    return os.environ.get('LABELER_SHARED_LABEL_STORE', '0') == '1'
 
 
 class JsonLabelStore(LabelStore):
@@ -30,40 +55,166 @@ class JsonLabelStore(LabelStore):
                  extra_fields=[],
                  initial_labels=None,
                  initial_keys_only=False,
-                 seed=0):
+                 seed=0,
+                 shared=None,
+                 order=None):
         """
         Args:
-            keys (List[str])
+            keys (Iterable[str], KeyRegistry)
             labels (List[str])
             output_json (str)
             extra_fields (List[str])
             initial_labels (Path): JSON output by, e.g., a previous labeling
                 session.
             seed (int)
+            shared (bool): If True, output_json may be updated by other
+                processes; writes are serialized with a lock file, and labels
+                are reloaded when output_json changes on disk. Defaults to
+                shared_by_default().
+            order (str): How keys are shuffled for labeling. 'hash' sorts
+                keys by a seeded hash of each key, so adding keys does not
+                change the relative order of existing keys. 'natsort'
+                shuffles the naturally sorted keys, as earlier versions did;
+                this is slow with millions of keys. Defaults to the order
+                previously used for output_json: 'natsort' for outputs
+                created before this option existed, and 'hash' for new
+                outputs. The order is saved next to output_json, and only
+                recomputed if the keys change.
         """
-        self.keys = set(keys)
+        self._set_keys(keys)
         self.valid_labels = labels
         self.extra_fields = extra_fields
         self.output = Path(output_json) if output_json is not None else None
         self.seed = seed
-        self.randomized_keys = natsorted(self.keys)
-        random.Random(self.seed).shuffle(self.randomized_keys)
+        if order is None:
+            order = self._previous_order_method()
+        assert order in ('hash', 'natsort'), f'Unknown order {order}'
+        self.order_method = order
+        # None if shared should follow shared_by_default(); see
+        # __setstate__.
+        self._shared_arg = shared
+        self.shared = shared_by_default() if shared is None else shared
+        self._disk_stat = None
+        self._batch = None
 
-        if self.output is not None and self.output.exists():
-            self._load_from_disk(self.output)
-        else:
-            # List of {'key': str, 'labels': List[int], <extra fields>} dicts.
-            self.current_labels = []
+        with startup.phase('load_labels'):
+            if self.output is not None and self.output.exists():
+                self._load_from_disk(self.output)
+            else:
+                self._set_current_labels([])
 
         # We create an initial labels store only if `initial_labels` is
         # specified, or when `setup_initial_label` is called, to avoid creating
         # infinite recursive initial label stores.
         if initial_labels is not None:
-            self.setup_initial_labels(initial_labels,
-                                      initial_keys_only=initial_keys_only)
+            with startup.phase('initial_labels'):
+                self.setup_initial_labels(initial_labels,
+                                          initial_keys_only=initial_keys_only)
         else:
             self.initial_labels = None
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Stores restored from a snapshot may be served differently than
+        # when the snapshot was saved (e.g. by labeler.serve's workers
+        # instead of flask run).
+        if self._shared_arg is None:
+            self.shared = shared_by_default()
+
+    def _set_keys(self, keys):
+        # Key ids are used to index self.order and self._labeled.
+        with startup.phase('index_keys'):
+            self.keys = KeyRegistry(keys)
+        self._order = None
+        self._natural_order = None
+
+    @property
+    def order(self):
+        """Array of key ids, in the order keys are presented for labeling."""
+        if self._order is None:
+            with startup.phase('key_order'):
+                self._order = self._load_order()
+                if self._order is None:
+                    self._order = self._compute_order()
+                    self._save_order()
+        return self._order
+
+    def _order_path(self):
+        return self.output.with_name(self.output.stem + '_order.npz')
+
+    def _previous_order_method(self):
+        if self.output is None:
+            return 'hash'
+        try:
+            with np.load(self._order_path()) as data:
+                return str(data['method'])
+        except _ORDER_LOAD_ERRORS as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning('Could not load key order from %s (%s); '
+                                'regenerating it.', self._order_path(), e)
+            # Outputs from before orders were saved used 'natsort'.
+            return 'natsort' if self.output.exists() else 'hash'
+
+    def _order_info(self):
+        return {
+            'method': self.order_method,
+            'seed': str(self.seed),
+            'keys': self.keys.fingerprint()
+        }
+
+    def _load_order(self):
+        if self.output is None:
+            return None
+        try:
+            with np.load(self._order_path()) as data:
+                info = {k: str(data[k]) for k in ('method', 'seed', 'keys')}
+                if info != self._order_info():
+                    return None
+                return data['order']
+        except _ORDER_LOAD_ERRORS:
+            return None
+
+    def _save_order(self):
+        if self.output is None:
+            return
+        self.output.parent.mkdir(exist_ok=True, parents=True)
+        with atomic_write(self._order_path(), 'wb') as f:
+            np.savez(f, order=self._order, **self._order_info())
+
+    def _compute_order(self):
+        """Compute order of key ids for self.order_method.
+
+        For 'hash', each key is hashed in a Python loop (blake2b has no
+        vectorized implementation); only sorting the hashes is vectorized.
+        The order is saved, so this only runs when the keys change."""
+        if self.order_method == 'natsort':
+            order = index_natsorted(self.keys)
+            random.Random(self.seed).shuffle(order)
+            return np.array(order, dtype=np.int64)
+        seeded = hashlib.blake2b(f'{self.seed}\0'.encode('utf-8'),
+                                 digest_size=8)
+
+        def key_hash(key):
+            h = seeded.copy()
+            h.update(key.encode('utf-8'))
+            return int.from_bytes(h.digest(), 'little')
+
+        hashes = np.fromiter((key_hash(x) for x in self.keys),
+                             dtype=np.uint64,
+                             count=len(self.keys))
+        return np.argsort(hashes, kind='stable')
+
+    def prepare(self):
+        self.order
+
+    @property
+    def natural_order(self):
+        """Array of key ids, in natural sort order of keys."""
+        if self._natural_order is None:
+            self._natural_order = np.array(index_natsorted(self.keys),
+                                           dtype=np.int64)
+        return self._natural_order
+
     def setup_initial_labels(self, labels_path=None, initial_keys_only=False):
         """Setup label store for initial labels.
 
@@ -73,12 +224,15 @@ class JsonLabelStore(LabelStore):
         if self.output is not None:
             output_json = self.output.with_name(self.output.stem +
                                                 "_initial.json")
-        # Use type(self) to allow subclasses to re-use this method.
+        # Use type(self) to allow subclasses to re-use this method. The initial
+        # label store shares our keys.
         self.initial_labels = type(self)(self.keys,
                                          self.valid_labels,
                                          output_json=output_json,
                                          extra_fields=self.extra_fields,
-                                         seed=self.seed)
+                                         seed=self.seed,
+                                         shared=self._shared_arg,
+                                         order=self.order_method)
         if labels_path is not None:
             self.initial_labels._load_from_disk(labels_path)
             if output_json.exists():
@@ -88,19 +242,26 @@ class JsonLabelStore(LabelStore):
 
     def _remove_noninitial_keys(self, initial_labels_path):
         with open(initial_labels_path, 'r') as f:
-            keys = {x['key'] for x in json.load(f)['annotations']}
-        self.initial_labels.keys = keys
-        self.keys = keys
-        self.initial_labels.current_labels = [
+            keys = KeyRegistry(x['key'] for x in json.load(f)['annotations'])
+        self._set_keys(keys)
+        self._set_current_labels(self.current_labels)
+        self.initial_labels._set_keys(keys)
+        self.initial_labels._set_current_labels([
             x for x in self.initial_labels.current_labels
             if x['key'] in keys
-        ]
+        ])
+
+    def _check_keys(self, keys):
+        keys = list(keys)
+        ids = self.keys.ids(keys)
+        if (ids < 0).any():
+            key = keys[int(np.argmax(ids < 0))]
+            raise AssertionError(
+                f"Could not find key {key} from previously saved labels in "
+                f"current list of keys to label.")
 
     def _check_annotation(self, annotation):
-        key = annotation['key']
-        assert key in self.keys, (
-            f"Could not find key {key} from previously saved labels in "
-            f"current list of keys to label.")
+        # Keys are checked for all annotations at once by _check_keys().
         assert all(0 <= int(x) < len(self.valid_labels)
                    for x in annotation['labels'])
         assert set(annotation.keys()) == set(['labels', 'key'] +
@@ -112,28 +273,132 @@ class JsonLabelStore(LabelStore):
 
         assert set(data.keys()) == {'annotations', 'labels'}
         assert data['labels'] == self.valid_labels
+        self._check_keys(x['key'] for x in data['annotations'])
         for annotation in data['annotations']:
             self._check_annotation(annotation)
 
-        self.current_labels = data['annotations']
+        self._set_current_labels(data['annotations'])
+        if output == self.output:
+            self._disk_stat = self._stat_output()
+
+    def _set_current_labels(self, annotations):
+        # List of {'key': str, 'labels': List[int], <extra fields>} dicts, in
+        # the order they were labeled.
+        self.current_labels = []
+        # Map key to its latest annotation in current_labels.
+        self._latest_labels = {}
+        self._reset_labeled()
+        self._add_labels(annotations)
+
+    def _reset_labeled(self):
+        # Whether each key (by id) is labeled.
+        self._labeled = np.zeros(len(self.keys), dtype=bool)
+
+    def _mark_labeled(self, keys):
+        ids = self.keys.ids(keys)
+        self._labeled[ids[ids >= 0]] = True
 
     def _dump_to_disk(self):
         if self.output is None:
             return
 
-        with open(self.output, 'w') as f:
-            json.dump(
-                {
-                    'annotations': self.current_labels,
-                    'labels': self.valid_labels
-                }, f)
+        with metrics.timer('dump_labels'):
+            with atomic_write(self.output) as f:
+                json.dump(
+                    {
+                        'annotations': self.current_labels,
+                        'labels': self.valid_labels
+                    }, f)
+                DUMP_BYTES.observe(f.tell())
+        self._disk_stat = self._stat_output()
 
-    def get_label(self, key):
-        matches = (x for x in reversed(self.current_labels) if x['key'] == key)
+    def _stat_output(self):
         try:
-            return copy.deepcopy(next(matches))
-        except StopIteration:
+            stat = os.stat(self.output)
+        except FileNotFoundError:
             return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _sync(self):
+        """Reload labels if another process updated output_json."""
+        if not self.shared or self.output is None:
+            return
+        stat = self._stat_output()
+        if stat is not None and stat != self._disk_stat:
+            self._load_from_disk(self.output)
+
+    def reload_if_changed(self):
+        """Reload labels if output_json changed since they were loaded.
+
+        Used when restoring a label store from a snapshot, whose labels may
+        be older than output_json."""
+        if self.output is not None:
+            stat = self._stat_output()
+            if stat is None and self._disk_stat is not None:
+                raise FileNotFoundError(
+                    f'{self.output} was removed after labels were loaded.')
+            if stat != self._disk_stat:
+                self._load_from_disk(self.output)
+        if self.initial_labels is not None:
+            self.initial_labels.reload_if_changed()
+
+    def _write_lock(self):
+        if not self.shared or self.output is None:
+            return contextlib.nullcontext()
+        return file_lock(self.output.with_name(self.output.name + '.lock'))
+
+    def _append(self, annotations):
+        if self._batch is not None:
+            self._add_labels(annotations)
+            self._batch['dirty'] = True
+            return
+        with self._write_lock():
+            self._sync()
+            self._add_labels(annotations)
+            self._dump_to_disk()
+
+    def _add_labels(self, annotations):
+        self.current_labels.extend(annotations)
+        for annotation in annotations:
+            self._latest_labels[annotation['key']] = annotation
+        self._mark_labeled(x['key'] for x in annotations)
+
+    @contextlib.contextmanager
+    def batch_updates(self):
+        """Write all updates made within this context to disk at once.
+
+        Applies to both update() and update_initial_labels(); each JSON file is
+        written (at most) once, on exit. If an exception is raised, updates
+        made within the context are discarded. If the store is shared, other
+        processes cannot write labels until the context exits."""
+        if self._batch is not None:  # Nested batch
+            yield
+            return
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(self._write_lock())
+            self._sync()
+            num_labels = len(self.current_labels)
+            self._batch = {'dirty': False, 'stack': stack}
+            try:
+                if self.initial_labels is not None:
+                    stack.enter_context(self.initial_labels.batch_updates())
+                yield
+            except BaseException:
+                # Discard updates made in this batch.
+                self._set_current_labels(self.current_labels[:num_labels])
+                raise
+            else:
+                if self._batch['dirty']:
+                    self._dump_to_disk()
+            finally:
+                self._batch = None
+
+    def get_label(self, key):
+        self._sync()
+        annotation = self._latest_labels.get(key)
+        if annotation is None:
+            return None
+        return copy.deepcopy(annotation)
 
     def update(self, labels):
         """
@@ -141,6 +406,7 @@ class JsonLabelStore(LabelStore):
             labels (dict): Map data key to dict containing
                 {'labels': List[int], [extra_fields]: ...}
         """
+        annotations = []
         for key, label_info in labels.items():
             annotation = {'key': key}
             for k, v in label_info.items():
@@ -148,8 +414,8 @@ class JsonLabelStore(LabelStore):
                     annotation[k] = v
                 else:
                     print('WARN: Ignoring unknown field: ', k)
-            self.current_labels.append(annotation)
-        self._dump_to_disk()
+            annotations.append(annotation)
+        self._append(annotations)
 
     def get_initial_label(self, key):
         if self.initial_labels is not None:
@@ -165,21 +431,33 @@ class JsonLabelStore(LabelStore):
         """
         if self.initial_labels is None:
             self.setup_initial_labels()
+            if self._batch is not None:
+                self._batch['stack'].enter_context(
+                    self.initial_labels.batch_updates())
         return self.initial_labels.update(labels)
 
     def labeled_keys(self):
-        return {x['key'] for x in self.current_labels}
+        self._sync()
+        return set(self._latest_labels.keys())
+
+    def labeled_by_id(self):
+        """Return boolean array of whether each key, by id, is labeled.
+
+        The array is replaced, rather than updated, when labels are
+        reloaded."""
+        self._sync()
+        return self._labeled
 
     def get_unlabeled(self, num_items, randomized=True):
-        if randomized:
-            keys = self.randomized_keys
-        else:
-            keys = natsorted(self.keys)
-        return [x for x in keys
-                if x not in set(self.labeled_keys())][:num_items]
+        with metrics.timer('get_unlabeled'):
+            self._sync()
+            order = self.order if randomized else self.natural_order
+            unlabeled = order[~self._labeled[order]][:num_items]
+            return [self.keys[i] for i in unlabeled]
 
     def num_completed(self):
-        return len({x['key'] for x in self.current_labels} & set(self.keys))
+        self._sync()
+        return int(self._labeled.sum())
 
     def num_total(self):
         return len(self.keys)
@@ -0,0 +1,167 @@
+"""Compact, read-only set of string keys with integer ids."""
+
+import hashlib
+from collections.abc import Set
+
+import numpy as np
+
+
+def _encode_varint(value, output):
+    while value >= 0x80:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def _decode_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class KeyRegistry(Set):
+    """Set of keys, where each key has an integer id.
+
+    Ids are the indices of keys in sorted order. Keys are stored front-coded
+    in one buffer: keys are split into blocks of BLOCK_SIZE, the first key of
+    each block is stored in full, and each following key is stored as the
+    length of the prefix it shares with the previous key, followed by the
+    rest of the key. With paths that share long directory prefixes, this
+    takes a fraction of the memory of a set of strings.
+
+    Supports `in`, iteration (in id order) and len(), so it can be used in
+    place of a set of keys.
+    """
+    BLOCK_SIZE = 16
+
+    def __init__(self, keys):
+        """
+        Args:
+            keys (Iterable[str]): Duplicates are ignored.
+        """
+        if isinstance(keys, KeyRegistry):
+            self._data = keys._data
+            self._block_offsets = keys._block_offsets
+            self._len = keys._len
+            return
+        encoded = sorted({x.encode('utf-8') for x in keys})
+        data = bytearray()
+        block_offsets = []
+        previous = b''
+        for i, key in enumerate(encoded):
+            if i % self.BLOCK_SIZE == 0:
+                block_offsets.append(len(data))
+                prefix = 0
+            else:
+                prefix = 0
+                max_prefix = min(len(key), len(previous))
+                while prefix < max_prefix and key[prefix] == previous[prefix]:
+                    prefix += 1
+                _encode_varint(prefix, data)
+            _encode_varint(len(key) - prefix, data)
+            data += key[prefix:]
+            previous = key
+        self._data = bytes(data)
+        self._block_offsets = np.array(block_offsets, dtype=np.int64)
+        self._len = len(encoded)
+
+    def _decode_block(self, block):
+        """Yield encoded keys in `block`."""
+        position = int(self._block_offsets[block])
+        num_keys = min(self.BLOCK_SIZE, self._len - block * self.BLOCK_SIZE)
+        key = b''
+        for i in range(num_keys):
+            prefix = 0
+            if i > 0:
+                prefix, position = _decode_varint(self._data, position)
+            length, position = _decode_varint(self._data, position)
+            key = key[:prefix] + self._data[position:position + length]
+            position += length
+            yield key
+
+    def _first_key(self, block):
+        position = int(self._block_offsets[block])
+        length, position = _decode_varint(self._data, position)
+        return self._data[position:position + length]
+
+    def id(self, key):
+        """Return id of `key`, or None if it is not in the registry."""
+        if not isinstance(key, str) or self._len == 0:
+            return None
+        encoded = key.encode('utf-8')
+        # Find the last block whose first key is <= encoded.
+        low, high = 0, len(self._block_offsets)
+        while low < high:
+            mid = (low + high) // 2
+            if self._first_key(mid) <= encoded:
+                low = mid + 1
+            else:
+                high = mid
+        block = low - 1
+        if block < 0:
+            return None
+        for i, block_key in enumerate(self._decode_block(block)):
+            if block_key == encoded:
+                return block * self.BLOCK_SIZE + i
+            elif block_key > encoded:
+                break
+        return None
+
+    def ids(self, keys):
+        """Return array of ids of `keys`, with -1 for missing keys.
+
+        Faster than calling id() for each key when looking up many keys."""
+        keys = list(keys)
+        ids = np.full(len(keys), -1, dtype=np.int64)
+        if len(keys) * 64 < self._len:
+            for i, key in enumerate(keys):
+                key_id = self.id(key)
+                if key_id is not None:
+                    ids[i] = key_id
+            return ids
+        # Walk through the registry and the sorted keys together.
+        query_order = sorted(range(len(keys)), key=keys.__getitem__)
+        registry = enumerate(iter(self))
+        key_id, registry_key = next(registry, (None, None))
+        for i in query_order:
+            while registry_key is not None and registry_key < keys[i]:
+                key_id, registry_key = next(registry, (None, None))
+            if registry_key is None:
+                break
+            if registry_key == keys[i]:
+                ids[i] = key_id
+        return ids
+
+    def __getitem__(self, key_id):
+        """Return key with id `key_id`."""
+        if not 0 <= key_id < self._len:
+            raise IndexError(key_id)
+        block, offset = divmod(int(key_id), self.BLOCK_SIZE)
+        for i, key in enumerate(self._decode_block(block)):
+            if i == offset:
+                return key.decode('utf-8')
+
+    def __contains__(self, key):
+        return self.id(key) is not None
+
+    def __iter__(self):
+        for block in range(len(self._block_offsets)):
+            for key in self._decode_block(block):
+                yield key.decode('utf-8')
+
+    def __len__(self):
+        return self._len
+
+    def fingerprint(self):
+        """Return a hash identifying the set of keys."""
+        return hashlib.sha1(self._data).hexdigest()
+
+    def nbytes(self):
+        """Approximate memory used by the registry, in bytes."""
+        return len(self._data) + self._block_offsets.nbytes
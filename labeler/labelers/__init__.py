@@ -1,20 +1,113 @@
-from .anchor_pmk import AnchorPmkLabeler
-from .single_file import (SingleImageLabeler, SingleVideoLabeler)
-from .single_image_with_captions import SingleImageWithCaptionsLabeler
-from .single_video_with_thumbnails import SingleVideoWithThumbnailsLabeler
-from .grid_labeler import GridLabeler, GridGifLabeler, GridSummaryVideoLabeler
-from .video_box_classification import (
-    VideoBoxClassification, CocoVideoBoxClassification)
-
-labeler_dict = {
-    'SingleImageLabeler': SingleImageLabeler,
-    'SingleVideoLabeler': SingleVideoLabeler,
-    'SingleVideoWithThumbnailsLabeler': SingleVideoWithThumbnailsLabeler,
-    'SingleImageWithCaptionsLabeler': SingleImageWithCaptionsLabeler,
-    'AnchorPmkLabeler': AnchorPmkLabeler,
-    'GridLabeler': GridLabeler,
-    'GridGifLabeler': GridGifLabeler,
-    'GridSummaryVideoLabeler': GridSummaryVideoLabeler,
-    'VideoBoxClassification': VideoBoxClassification,
-    'CocoVideoBoxClassification': CocoVideoBoxClassification
+"""Labelers, by LABELER_TYPE.
+
+Labeler modules are only imported when their type is looked up in
+`labeler_dict`, so scripts and server processes don't pay for importing
+every labeler and its dependencies. Other packages can add labelers through
+the 'labeler.labelers' entry point group, e.g. in their setup.py:
+
+    entry_points={
+        'labeler.labelers': [
+            'MyLabeler = my_package.my_labeler:MyLabeler',
+        ],
+    }
+"""
+
+import importlib
+from collections.abc import Mapping
+
+ENTRY_POINT_GROUP = 'labeler.labelers'
+
+# Map LABELER_TYPE to '<module>:<class>', with modules relative to this
+# package.
+_BUILTIN_LABELERS = {
+    'SingleImageLabeler':
+    '.single_file:SingleImageLabeler',
+    'SingleVideoLabeler':
+    '.single_file:SingleVideoLabeler',
+    'SingleVideoWithThumbnailsLabeler':
+    '.single_video_with_thumbnails:SingleVideoWithThumbnailsLabeler',
+    'SingleVideoWithServersideThumbnailsLabeler':
+    ('.single_video_with_serverside_thumbnails:'
+     'SingleVideoWithServersideThumbnailsLabeler'),
+    'SingleImageWithCaptionsLabeler':
+    '.single_image_with_captions:SingleImageWithCaptionsLabeler',
+    'AnchorPmkLabeler':
+    '.anchor_pmk:AnchorPmkLabeler',
+    'GridLabeler':
+    '.grid_labeler:GridLabeler',
+    'GridGifLabeler':
+    '.grid_labeler:GridGifLabeler',
+    'GridSummaryVideoLabeler':
+    '.grid_labeler:GridSummaryVideoLabeler',
+    'VideoBoxClassification':
+    '.video_box_classification:VideoBoxClassification',
+    'CocoVideoBoxClassification':
+    '.video_box_classification:CocoVideoBoxClassification',
+    'TaoFederatedLabelVerifier':
+    '.tao_federated_label_verification:TaoFederatedLabelVerifier',
 }
+
+
+def _entry_points():
+    from importlib import metadata
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return entry_points.select(group=ENTRY_POINT_GROUP)
+    # Python < 3.10
+    return entry_points.get(ENTRY_POINT_GROUP, [])
+
+
+class LabelerRegistry(Mapping):
+    """Map LABELER_TYPE to labeler class, importing classes on first use."""
+    def __init__(self, labelers):
+        """
+        Args:
+            labelers (Dict[str, str]): Map LABELER_TYPE to
+                '<module>:<class>'.
+        """
+        self._targets = dict(labelers)
+        self._classes = {}
+        self._plugins = None
+
+    def _plugin_entry_points(self):
+        if self._plugins is None:
+            self._plugins = {
+                x.name: x
+                for x in _entry_points() if x.name not in self._targets
+            }
+        return self._plugins
+
+    def __getitem__(self, labeler_type):
+        if labeler_type not in self._classes:
+            if labeler_type in self._targets:
+                module, name = self._targets[labeler_type].split(':')
+                labeler_class = getattr(
+                    importlib.import_module(module, __name__), name)
+            elif labeler_type in self._plugin_entry_points():
+                labeler_class = self._plugins[labeler_type].load()
+            else:
+                raise KeyError(f'Unknown LABELER_TYPE {labeler_type}')
+            self._classes[labeler_type] = labeler_class
+        return self._classes[labeler_type]
+
+    def __contains__(self, labeler_type):
+        return (labeler_type in self._targets
+                or labeler_type in self._plugin_entry_points())
+
+    def __iter__(self):
+        yield from self._targets
+        yield from self._plugin_entry_points()
+
+    def __len__(self):
+        return len(self._targets) + len(self._plugin_entry_points())
+
+
+labeler_dict = LabelerRegistry(_BUILTIN_LABELERS)
+
+
+def __getattr__(name):
+    # Support importing labeler classes from this package, e.g.
+    # `from labeler.labelers import GridLabeler`.
+    if name in _BUILTIN_LABELERS:
+        return labeler_dict[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,11 +1,16 @@
 """Label anchor frame and pm-k frame."""
 
 import collections
-import json
+import itertools
+import logging
+import random
 from pathlib import Path
 
-from flask import render_template
+import numpy as np
+from natsort import natsorted
 
+from ..utils import startup
+from ..utils.caption_index import CaptionIndex
 from .single_image_with_captions import SingleImageWithCaptionsLabeler
 
 
@@ -17,30 +22,39 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
                  pair_caption_json,
                  num_items=10,
                  review_labels=None,
-                 anchor_bad_name='bad-anchor'):
+                 anchor_bad_name='bad-anchor',
+                 group_by_anchor=True,
+                 caption_index_dir=None):
         """
         pair_caption_json (Path): Maps "<anchor-path>,<pmk-path>" to image
             caption, where the paths are relative from the root directory.
+        group_by_anchor (bool): If True, show all pm-k pairs of an anchor
+            together, on as few pages as possible. Otherwise, show pairs in
+            random order.
+        caption_index_dir (Path): Where to store the index of captions (see
+            CaptionIndex). Defaults to <output_dir>/caption_index.
         """
-        with open(pair_caption_json, 'r') as f:
-            pair_captions = json.load(f)
-            self.pair_captions = {
-                tuple(k.split(',')): v
-                for k, v in pair_captions.items()
-            }
+        if caption_index_dir is None:
+            caption_index_dir = Path(output_dir) / 'caption_index'
+        # Keys are "<anchor-path>,<pmk-path>", as created by create_key().
+        self.pair_captions = CaptionIndex(pair_caption_json,
+                                          caption_index_dir)
 
         self.keys_by_anchor = collections.defaultdict(list)
         keys = []
-        for anchor, pmk in self.pair_captions.keys():
-            key = self.create_key(anchor, pmk)
-            keys.append(key)
-            self.keys_by_anchor[anchor].append(key)
+        with startup.phase('group_pairs'):
+            for key in self.pair_captions:
+                anchor, pmk = self.parse_key(key)
+                keys.append(key)
+                self.keys_by_anchor[anchor].append(key)
         self.init_with_keys(root,
                             keys,
                             labels_csv,
                             output_dir,
                             num_items,
                             review_labels=review_labels)
+        self.template = 'label_anchor_pmk_with_captions.html'
+        self.template_extra_args = {}
         self.propagate_labels = {
             x.idx
             for x in self.labels if int(x.extra.get('propagate_anchors', '0'))
@@ -48,20 +62,80 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
         self.anchor_bad_label = next(x.idx for x in self.labels
                                      if x.name == anchor_bad_name)
 
+        self.group_by_anchor = group_by_anchor
+        self.anchor_order = natsorted(self.keys_by_anchor.keys())
+        random.Random(self.label_store.seed).shuffle(self.anchor_order)
+        self._index_anchor_keys()
+
+    def _index_anchor_keys(self):
+        """Sort the pairs of each anchor, and index their key ids.
+
+        Pairs that are not in the label store (e.g. when only reviewing
+        review_labels) are removed from keys_by_anchor, so they are neither
+        shown nor propagated to."""
+        anchor_keys = [
+            natsorted(self.keys_by_anchor[x]) for x in self.anchor_order
+        ]
+        ids = self.label_store.keys.ids(itertools.chain(*anchor_keys))
+        start = 0
+        for anchor, keys in zip(self.anchor_order, anchor_keys):
+            found = ids[start:start + len(keys)] >= 0
+            self.keys_by_anchor[anchor] = list(itertools.compress(keys, found))
+            start += len(keys)
+        # Key ids of the pairs of self.anchor_order[i] are
+        # _anchor_ids[_anchor_offsets[i]:_anchor_offsets[i + 1]].
+        self._anchor_ids = ids[ids >= 0]
+        self._anchor_offsets = np.cumsum(
+            [0] + [len(self.keys_by_anchor[x]) for x in self.anchor_order])
+        # Index in anchor_order of the first anchor that may have unlabeled
+        # pairs, valid while the number of labeled keys doesn't decrease.
+        self._anchor_cursor = 0
+        self._cursor_num_completed = 0
+
     def create_key(self, anchor_path, pmk_path):
         return f'{anchor_path},{pmk_path}'
 
     def parse_key(self, key):
         return tuple(key.split(','))
 
-    def index(self):
-        anchor_pmk_keys = self.label_store.get_unlabeled(self.num_items)
-        total_images = self.label_store.num_total()
-        num_complete = self.label_store.num_completed()
-        captions = {
-            key: self.pair_captions[self.parse_key(key)]
-            for key in anchor_pmk_keys
-        }
+    def pages(self, num_pages):
+        """Group unlabeled pairs into pages, keeping each anchor's pairs
+        together.
+
+        Labels propagated from a pair then apply to the other pairs of its
+        anchor on the same page, and the anchor image is loaded once. An
+        anchor whose pairs don't fit in the rest of a page starts a new page;
+        anchors with more than num_items pairs are split across pages."""
+        if not self.group_by_anchor:
+            return super().pages(num_pages)
+        labeled = self.label_store.labeled_by_id()
+        num_completed = int(labeled.sum())
+        if num_completed < self._cursor_num_completed:
+            # Labels were removed, e.g. by restoring an older labels file.
+            self._anchor_cursor = 0
+        self._cursor_num_completed = num_completed
+
+        offsets = self._anchor_offsets
+        pages = [[]]
+        for i in range(self._anchor_cursor, len(self.anchor_order)):
+            ids = self._anchor_ids[offsets[i]:offsets[i + 1]]
+            ids = ids[~labeled[ids]]
+            if not len(ids) and i == self._anchor_cursor:
+                self._anchor_cursor += 1
+            keys = [self.label_store.keys[x] for x in ids]
+            while keys:
+                space = self.num_items - len(pages[-1])
+                if len(keys) > space and pages[-1]:
+                    if len(pages) == num_pages:
+                        return pages
+                    pages.append([])
+                    space = self.num_items
+                pages[-1].extend(keys[:space])
+                keys = keys[space:]
+        return [x for x in pages if x]
+
+    def template_args(self, keys, num_pending=0):
+        captions = {key: self.pair_captions[key] for key in keys}
         labels_by_row = self.labels_by_row()
 
         # Hack: Sort categories row
@@ -73,7 +147,7 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
         labels_by_row[category_row_idx] = row1
 
         pairs_to_label = []
-        for key in anchor_pmk_keys:
+        for key in keys:
             anchor, pmk = self.parse_key(key)
             anchor_url = self.key_to_url(anchor)
             pmk_url = self.key_to_url(pmk)
@@ -81,13 +155,12 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
                 (key, anchor_url, pmk_url,
                  self.label_store.get_initial_label(key), captions[key]))
 
-        return render_template('label_anchor_pmk_with_captions.html',
-                               num_left=total_images - num_complete,
-                               num_total=total_images,
-                               percent_complete='%.2f' %
-                               (100 * num_complete / total_images),
-                               pairs_to_label=pairs_to_label,
-                               labels=labels_by_row)
+        template_kwargs = self.progress_args(num_pending)
+        template_kwargs.update({
+            'pairs_to_label': pairs_to_label,
+            'labels': labels_by_row
+        })
+        return template_kwargs
 
     def submit(self, form):
         label_infos = self.parse_form(form)
@@ -101,7 +174,7 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
             # If a previous row in this page called this anchor bad, add
             # anchor bad to this pmk pair as well.
             if (anchor in to_propagate
-                    and self.anchor_bad_label in to_propagate[anchor]):
+                    and self.anchor_bad_label in to_propagate[anchor]['add']):
                 labels.add(self.anchor_bad_label)
 
             to_propagate[anchor] = {
@@ -109,9 +182,19 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
                 'remove': self.propagate_labels - labels
             }
 
-        self.label_store.update(self.parse_form(form))
+        # Write final and initial labels once, after propagating.
+        with self.label_store.batch_updates():
+            self.label_store.update(label_infos)
+            self.propagate(to_propagate)
 
-        print(f"Propagating labels:\n{to_propagate}")
+    def propagate(self, to_propagate):
+        """Propagate anchor labels to all pm-k pairs of each anchor.
+
+        Args:
+            to_propagate (dict): Map anchor to dict
+                {'add': add_labels, 'remove': remove_labels}.
+        """
+        logging.debug('Propagating labels:\n%s', to_propagate)
         final_updates = {}
         initial_updates = {}
         for anchor, updates in to_propagate.items():
@@ -130,6 +213,7 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
                     }
 
                 if annotation is not None:
+                    annotation.pop('key', None)
                     annotation['labels'] = sorted(
                         set(annotation['labels']) | updates['add'] -
                         updates['remove'])
@@ -140,8 +224,9 @@ class AnchorPmkLabeler(SingleImageWithCaptionsLabeler):
                         'notes': ''
                     }
         if final_updates:
-            print('final', final_updates)
+            logging.info('Updating %s labeled pairs.', len(final_updates))
             self.label_store.update(final_updates)
         if initial_updates:
-            print('initial', final_updates)
+            logging.info('Updating initial labels of %s pairs.',
+                         len(initial_updates))
             self.label_store.update_initial_labels(initial_updates)
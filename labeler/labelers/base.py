@@ -15,4 +15,5 @@ class Labeler(ABC):
         pass
 
     def public_directories(self):
-        return []
+        """Map name to directory whose files are served at /file/<name>/."""
+        return {}
@@ -1,7 +1,12 @@
 from pathlib import Path
 
+import flask
+
 from labeler.labelers.single_file import SingleFileLabeler
 from labeler.utils import fs
+from labeler.utils.image import resize_image
+from labeler.utils.media_cache import MediaCache
+from labeler.utils import video as video_utils
 
 
 class GridLabeler(SingleFileLabeler):
@@ -12,7 +17,19 @@ class GridLabeler(SingleFileLabeler):
                  show_notes=True,
                  num_items=10,
                  cell_width=200,
-                 cell_height='auto'):
+                 cell_height='auto',
+                 variant_width=None,
+                 variant_format='jpg',
+                 num_variant_workers=4):
+        """
+        Args:
+            variant_width (int, None): Width of downscaled images shown in the
+                grid. Defaults to cell_width if it is an int. Set to 0 to show
+                original images in the grid. The original image is always
+                shown in the preview.
+            variant_format (str): 'jpg' or 'webp'.
+            num_variant_workers (int): Number of processes for resizing.
+        """
         template_args = {
             'show_notes': show_notes,
             'ui': {
@@ -27,6 +44,61 @@ class GridLabeler(SingleFileLabeler):
                          template='label_grid_images.html',
                          template_extra_args=template_args,
                          num_items=num_items)
+        if variant_width is None and isinstance(cell_width, int):
+            variant_width = cell_width
+        if variant_width:
+            self.variants = MediaCache(
+                self.output_dir / 'variants' / f'w{variant_width}',
+                resize_image,
+                suffix=f'.{variant_format}',
+                generate_kwargs={'width': variant_width},
+                num_workers=num_variant_workers)
+        else:
+            self.variants = None
+
+    def public_directories(self):
+        dirs = super().public_directories()
+        if self.variants is not None:
+            dirs['variant'] = self.variants.cache_dir
+        return dirs
+
+    def key_to_variant_url(self, key):
+        if self.variants is None:
+            return self.key_to_url(key)
+        if self.variants.path(key).exists():
+            return f'/file/variant/{key}{self.variants.suffix}'
+        # Start resizing now, so the image is (nearly) ready by the time the
+        # browser requests it.
+        self.variants.submit(self.root / key, key)
+        return f'/api/variant/{key}'
+
+    def api(self, api_request):
+        try:
+            request, key = api_request.split('/', 1)
+        except ValueError:
+            flask.abort(404)
+
+        if (request == 'variant' and self.variants is not None
+                and key in self.label_store.keys):
+            self.variants.get(self.root / key, key)
+            return flask.redirect(
+                f'/file/variant/{key}{self.variants.suffix}')
+        else:
+            flask.abort(404)
+
+    def precompute_media(self):
+        if self.variants is not None:
+            self.variants.precompute(
+                ((self.root / key, key) for key in self.label_store.keys),
+                desc='Resizing images')
+
+    def update_template_args(self, kwargs):
+        kwargs['to_label'] = [
+            (key, url, labels,
+             self.key_to_variant_url(self.unescape_key(key)))
+            for key, url, labels in kwargs['to_label']
+        ]
+        return kwargs
 
 
 class GridGifLabeler(SingleFileLabeler):
@@ -38,7 +110,18 @@ class GridGifLabeler(SingleFileLabeler):
                  show_notes=True,
                  num_items=10,
                  cell_width=200,
-                 cell_height='auto'):
+                 cell_height='auto',
+                 gif_video_format=None,
+                 num_gif_video_workers=4):
+        """
+        Args:
+            video_root (str, None): If specified, clicking on a gif shows the
+                video at the same relative path, with an .mp4 suffix.
+            gif_video_format (str, None): If 'mp4' or 'webm', show gifs in the
+                grid as muted, looping videos of this format, which are much
+                smaller and cheaper to decode than the gifs.
+            num_gif_video_workers (int): Number of parallel ffmpeg processes.
+        """
         template_args = {
             'show_notes': show_notes,
             'ui': {
@@ -66,11 +149,26 @@ class GridGifLabeler(SingleFileLabeler):
             self.video_paths = {}
         self.video_root = video_root
 
+        if gif_video_format is not None:
+            assert gif_video_format in ('mp4', 'webm'), (
+                f'Unknown gif_video_format {gif_video_format}')
+            # Conversion happens in ffmpeg, so threads are sufficient.
+            self.gif_videos = MediaCache(self.output_dir / 'gif_videos',
+                                         video_utils.gif_to_video,
+                                         suffix=f'.{gif_video_format}',
+                                         num_workers=num_gif_video_workers,
+                                         use_processes=False)
+        else:
+            self.gif_videos = None
+
     def public_directories(self):
-        return {
+        dirs = {
             'gif': self.root,
             'video': self.video_root
         }
+        if self.gif_videos is not None:
+            dirs['gif_video'] = self.gif_videos.cache_dir
+        return dirs
 
     def key_to_url(self, key):
         key_path = Path(key)
@@ -90,20 +188,62 @@ class GridGifLabeler(SingleFileLabeler):
             relative = url.split('/file/video/')[1]
             return self.video_root / relative
 
+    def key_to_gif_video_url(self, key):
+        suffix = self.gif_videos.suffix
+        if self.gif_videos.path(key).exists():
+            return f'/file/gif_video/{key}{suffix}'
+        self.gif_videos.submit(self.root / key, key)
+        # Keep the video suffix in the URL so the preview knows to show a
+        # video.
+        return f'/api/gif_video/{key}{suffix}'
+
+    def api(self, api_request):
+        try:
+            request, params = api_request.split('/', 1)
+        except ValueError:
+            flask.abort(404)
+
+        if request == 'gif_video' and self.gif_videos is not None:
+            suffix = self.gif_videos.suffix
+            key = params[:-len(suffix)]
+            if params.endswith(suffix) and key in self.label_store.keys:
+                self.gif_videos.get(self.root / key, key)
+                return flask.redirect(f'/file/gif_video/{params}')
+        flask.abort(404)
+
+    def precompute_media(self):
+        if self.gif_videos is not None:
+            self.gif_videos.precompute(
+                ((self.root / key, key) for key in self.label_store.keys),
+                desc='Converting gifs')
+
     def update_template_args(self, kwargs):
         to_label = kwargs['to_label']
         new_to_label = []
         for data in to_label:
             key, gif_path, labels = data
-            video_path = self.video_paths.get(self.unescape_key(key), None)
-            new_to_label.append(
-                (key, gif_path, labels, self.key_to_url(video_path)))
+            unescaped = self.unescape_key(key)
+            video_path = self.video_paths.get(unescaped, None)
+            preview_url = (self.key_to_url(video_path)
+                           if video_path is not None else None)
+            if self.gif_videos is not None:
+                new_to_label.append(
+                    (key, self.key_to_gif_video_url(unescaped), labels,
+                     preview_url, True))
+            else:
+                new_to_label.append(
+                    (key, gif_path, labels, preview_url, False))
         kwargs['to_label'] = new_to_label
         return kwargs
 
 
 class GridSummaryVideoLabeler(SingleFileLabeler):
-    """Labeler showing video summary in grid with full video when clicked."""
+    """Labeler showing video summary in grid with full video when clicked.
+
+    Cells initially show a poster frame for each summary video; the video
+    itself is only loaded for the active cell, or for visible cells when all
+    videos are playing.
+    """
     def __init__(self,
                  root,
                  labels_csv,
@@ -112,7 +252,15 @@ class GridSummaryVideoLabeler(SingleFileLabeler):
                  show_notes=True,
                  num_items=10,
                  cell_width=200,
-                 cell_height='auto'):
+                 cell_height='auto',
+                 poster_width=None,
+                 num_poster_workers=4):
+        """
+        Args:
+            poster_width (int, None): Width of poster frames. Defaults to
+                cell_width if it is an int, else posters are not resized.
+            num_poster_workers (int): Number of parallel ffmpeg processes.
+        """
         template_args = {
             'show_notes': show_notes,
             'ui': {
@@ -140,10 +288,21 @@ class GridSummaryVideoLabeler(SingleFileLabeler):
             self.video_paths = {}
         self.full_video_root = full_video_root
 
+        if poster_width is None and isinstance(cell_width, int):
+            poster_width = cell_width
+        self.posters = MediaCache(
+            self.output_dir / 'posters' / f'w{poster_width or "full"}',
+            video_utils.extract_poster,
+            suffix='.jpg',
+            generate_kwargs={'width': poster_width},
+            num_workers=num_poster_workers,
+            use_processes=False)
+
     def public_directories(self):
         return {
             'short': self.root,
-            'full': self.full_video_root
+            'full': self.full_video_root,
+            'poster': self.posters.cache_dir
         }
 
     def key_to_url(self, key, full_video=False):
@@ -163,16 +322,43 @@ class GridSummaryVideoLabeler(SingleFileLabeler):
             relative = url.split('/file/full/')[1]
             return self.full_video_root / relative
 
+    def key_to_poster_url(self, key):
+        if self.posters.path(key).exists():
+            return f'/file/poster/{key}{self.posters.suffix}'
+        self.posters.submit(self.root / key, key)
+        return f'/api/poster/{key}'
+
+    def api(self, api_request):
+        try:
+            request, key = api_request.split('/', 1)
+        except ValueError:
+            flask.abort(404)
+
+        if request == 'poster' and key in self.label_store.keys:
+            self.posters.get(self.root / key, key)
+            return flask.redirect(
+                f'/file/poster/{key}{self.posters.suffix}')
+        else:
+            flask.abort(404)
+
+    def precompute_media(self):
+        self.posters.precompute(
+            ((self.root / key, key) for key in self.label_store.keys),
+            desc='Extracting posters')
+
     def update_template_args(self, kwargs):
         to_label = kwargs['to_label']
         new_to_label = []
         for data in to_label:
             key, path, labels = data
             unescaped = self.unescape_key(key)
+            video_url = None
             if unescaped in self.video_paths:
-                video_url = self.key_to_url(self.video_paths[unescaped], full_video=True)
-            else:
+                video_url = self.key_to_url(self.video_paths[unescaped],
+                                            full_video=True)
+            elif self.full_video_root is not None:
                 print(f'Found no full video for {unescaped}')
-            new_to_label.append((key, path, labels, video_url))
+            new_to_label.append((key, path, labels, video_url,
+                                 self.key_to_poster_url(unescaped)))
         kwargs['to_label'] = new_to_label
         return kwargs
@@ -1,14 +1,19 @@
 import collections
 import csv
 import shutil
+from html.parser import HTMLParser
 from pathlib import Path
 from typing import NamedTuple, Optional
 
+import flask
 from flask import abort, render_template
 
 from labeler.labelers.base import Labeler
 from labeler.label_stores.json_label_store import JsonLabelStore
 from labeler.utils.fs import get_files, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS
+from labeler.utils import metrics, startup
+from labeler.utils.media_cache import MediaCache
+from labeler.utils import video as video_utils
 
 
 class LabelSpec(NamedTuple):
@@ -32,10 +37,11 @@ class SingleFileLabeler(Labeler):
                  template_extra_args={},
                  num_items=10,
                  review_labels=None):
-        keys = [
-            str(x.relative_to(root))
-            for x in get_files(Path(root), extensions)
-        ]
+        with startup.phase('list_files'):
+            keys = [
+                str(x.relative_to(root))
+                for x in get_files(Path(root), extensions)
+            ]
         self.init_with_keys(root, keys, labels_csv, output_dir, num_items,
                             review_labels)
         self.template = template
@@ -52,13 +58,14 @@ class SingleFileLabeler(Labeler):
         self.labels = SingleFileLabeler.load_label_spec(labels_csv)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True, parents=True)
-        self.label_store = JsonLabelStore(
-            keys=map(str, keys),
-            extra_fields=['notes'],
-            labels=[x.name for x in self.labels],
-            output_json=self.output_dir / 'labels.json',
-            initial_labels=review_labels,
-            initial_keys_only=review_labels is not None)
+        with startup.phase('label_store'):
+            self.label_store = JsonLabelStore(
+                keys=map(str, keys),
+                extra_fields=['notes'],
+                labels=[x.name for x in self.labels],
+                output_json=self.output_dir / 'labels.json',
+                initial_labels=review_labels,
+                initial_keys_only=review_labels is not None)
 
         self.num_items = num_items
 
@@ -148,28 +155,105 @@ class SingleFileLabeler(Labeler):
     def unescape_key(self, key):
         return key.replace(r'\_\_', '__')
 
-    def index(self):
-        if self.template is None:
-            abort(404)
+    def pages(self, num_pages):
+        """Keys to show on the next `num_pages` pages, assuming each page is
+        submitted before the next one is shown.
+
+        Returns:
+            pages (List[List[str]]): May contain fewer than `num_pages` pages
+                if there are not enough unlabeled keys.
+        """
+        keys = self.label_store.get_unlabeled(num_pages * self.num_items)
+        return [
+            keys[i:i + self.num_items]
+            for i in range(0, len(keys), self.num_items)
+        ]
+
+    def page_keys(self, page=0):
+        """Keys to show on the `page`-th page from now, assuming the pages
+        before it are submitted first."""
+        pages = self.pages(page + 1)
+        return pages[page] if page < len(pages) else []
 
-        keys = self.label_store.get_unlabeled(self.num_items)
+    def progress_args(self, num_pending=0):
+        """Progress template args, counting `num_pending` items (e.g. on pages
+        that have not been submitted yet) as complete."""
         total = self.label_store.num_total()
-        num_complete = self.label_store.num_completed()
-        percent_complete = '%.2f' % (100 * num_complete / total)
+        num_complete = min(self.label_store.num_completed() + num_pending,
+                           total)
+        return {
+            'num_left': total - num_complete,
+            'num_total': total,
+            'percent_complete': '%.2f' % (100 * num_complete /
+                                          max(total, 1e-9))
+        }
 
+    def template_args(self, keys, num_pending=0):
         to_label = [(self.escape_key(key), self.key_to_url(key),
                      self.label_store.get_initial_label(key)) for key in keys]
-        template_kwargs = {
-            'num_left': total - num_complete,
-            'num_total': total,
-            'percent_complete': percent_complete,
+        template_kwargs = self.progress_args(num_pending)
+        template_kwargs.update({
             'to_label': to_label,
             'labels': self.labels_by_row(),
-        }
+        })
         template_kwargs = self.update_template_args(template_kwargs)
-        return render_template(self.template,
-                               **template_kwargs,
-                               **self.template_extra_args)
+        return {**template_kwargs, **self.template_extra_args}
+
+    def index(self):
+        if self.template is None:
+            abort(404)
+        keys = self.page_keys()
+        with metrics.timer('template_args'):
+            template_kwargs = self.template_args(keys)
+        with metrics.timer('render'):
+            return render_template(self.template, **template_kwargs)
+
+    def batch(self, page=1):
+        """Return the `page`-th page from now for the client to prefetch.
+
+        Returns:
+            batch (dict): Contains
+                'media': List of {'url': str, 'type': 'img' | 'video'} media
+                    loaded by the page, for the client to prefetch.
+                'html': Rendered page, whose form replaces the current one.
+        """
+        if self.template is None:
+            abort(404)
+        pages = self.pages(page + 1)
+        keys = pages[page] if page < len(pages) else []
+        with metrics.timer('template_args'):
+            template_kwargs = self.template_args(
+                keys, num_pending=sum(len(x) for x in pages[:page]))
+        with metrics.timer('render'):
+            html = render_template(self.template, **template_kwargs)
+        return {'media': _MediaParser.parse(html), 'html': html}
+
+
+class _MediaParser(HTMLParser):
+    """Collects URLs of images and videos loaded by a page."""
+    def __init__(self):
+        super().__init__()
+        self.media = []
+        self._urls = set()
+
+    def _add(self, url, media_type):
+        # Pages may show the same file more than once.
+        if url not in self._urls:
+            self._urls.add(url)
+            self.media.append({'url': url, 'type': media_type})
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in ('img', 'video', 'source') and attrs.get('src'):
+            self._add(attrs['src'], 'img' if tag == 'img' else 'video')
+        if tag == 'video' and attrs.get('poster'):
+            self._add(attrs['poster'], 'img')
+
+    @classmethod
+    def parse(cls, html):
+        parser = cls()
+        parser.feed(html)
+        return parser.media
 
 
 class SingleImageLabeler(SingleFileLabeler):
@@ -193,10 +277,75 @@ class SingleVideoLabeler(SingleFileLabeler):
                  labels_csv,
                  output_dir,
                  num_items=10,
-                 extensions=VIDEO_EXTENSIONS):
+                 extensions=VIDEO_EXTENSIONS,
+                 template='label_single_video.html',
+                 template_extra_args={},
+                 proxy_height=None,
+                 proxy_crf=28,
+                 num_proxy_workers=2):
+        """
+        Args:
+            proxy_height (int, None): If specified, serve small faststart
+                H.264 proxies of the videos at this height instead of the
+                originals, which are still shown in the preview.
+            proxy_crf (int): x264 CRF for proxies; higher is smaller.
+            num_proxy_workers (int): Number of parallel ffmpeg processes.
+        """
         super().__init__(root,
                          extensions,
                          labels_csv,
                          output_dir,
-                         template='label_single_video.html',
+                         template=template,
+                         template_extra_args=template_extra_args,
                          num_items=num_items)
+        if proxy_height:
+            # Transcoding happens in ffmpeg, so threads are sufficient.
+            self.proxies = MediaCache(
+                self.output_dir / 'proxies' / f'{proxy_height}p',
+                video_utils.transcode_proxy,
+                suffix='.mp4',
+                generate_kwargs={'height': proxy_height, 'crf': proxy_crf},
+                num_workers=num_proxy_workers,
+                use_processes=False)
+        else:
+            self.proxies = None
+
+    def public_directories(self):
+        dirs = super().public_directories()
+        if self.proxies is not None:
+            dirs['proxy'] = self.proxies.cache_dir
+        return dirs
+
+    def key_to_proxy_url(self, key):
+        if self.proxies is None:
+            return self.key_to_url(key)
+        if self.proxies.path(key).exists():
+            return f'/file/proxy/{key}{self.proxies.suffix}'
+        self.proxies.submit(self.root / key, key)
+        return f'/api/proxy/{key}'
+
+    def api(self, api_request):
+        try:
+            request, key = api_request.split('/', 1)
+        except ValueError:
+            flask.abort(404)
+
+        if (request == 'proxy' and self.proxies is not None
+                and key in self.label_store.keys):
+            self.proxies.get(self.root / key, key)
+            return flask.redirect(f'/file/proxy/{key}{self.proxies.suffix}')
+        else:
+            flask.abort(404)
+
+    def precompute_media(self):
+        if self.proxies is not None:
+            self.proxies.precompute(
+                ((self.root / key, key) for key in self.label_store.keys),
+                desc='Transcoding proxies')
+
+    def update_template_args(self, kwargs):
+        kwargs['to_label'] = [
+            (key, url, labels, self.key_to_proxy_url(self.unescape_key(key)))
+            for key, url, labels in kwargs['to_label']
+        ]
+        return kwargs
@@ -1,9 +1,7 @@
-import json
 from pathlib import Path
 
-from flask import render_template
-
 from ..label_stores.json_label_store import JsonLabelStore
+from ..utils.caption_index import CaptionIndex
 from .single_file import SingleImageLabeler
 
 
@@ -14,13 +12,18 @@ class SingleImageWithCaptionsLabeler(SingleImageLabeler):
                  output_dir,
                  image_caption_json,
                  num_items=10,
-                 review_labels=None):
+                 review_labels=None,
+                 caption_index_dir=None):
         """
         image_caption_json (Path): Maps relative path from root to image
             caption.
+        caption_index_dir (Path): Where to store the index of captions (see
+            CaptionIndex). Defaults to <output_dir>/caption_index.
         """
-        with open(image_caption_json, 'r') as f:
-            self.image_captions = json.load(f)
+        if caption_index_dir is None:
+            caption_index_dir = Path(output_dir) / 'caption_index'
+        self.image_captions = CaptionIndex(image_caption_json,
+                                           caption_index_dir)
 
         self.init_with_keys(root,
                             self.image_captions.keys(),
@@ -28,14 +31,13 @@ class SingleImageWithCaptionsLabeler(SingleImageLabeler):
                             output_dir,
                             num_items,
                             review_labels=review_labels)
+        self.template = 'label_single_image_with_captions.html'
+        self.template_extra_args = {}
 
-    def index(self):
-        image_keys = self.label_store.get_unlabeled(self.num_items)
-        total_images = self.label_store.num_total()
-        num_complete = self.label_store.num_completed()
+    def template_args(self, keys, num_pending=0):
         captions = {
             key: self.image_captions[str(Path(key).relative_to(self.root))]
-            for key in image_keys
+            for key in keys
         }
         labels_by_row = self.labels_by_row()
         # Hack: Assume second row is categories, sort by name.
@@ -45,12 +47,11 @@ class SingleImageWithCaptionsLabeler(SingleImageLabeler):
 
         images_to_label = [(key, self.key_to_url(key),
                             self.label_store.get_initial_label(key),
-                            captions[key]) for key in image_keys]
-
-        return render_template('label_single_image_with_captions.html',
-                               num_left=total_images - num_complete,
-                               num_total=total_images,
-                               percent_complete='%.2f' %
-                               (100 * num_complete / total_images),
-                               to_label=images_to_label,
-                               labels=labels_by_row)
+                            captions[key]) for key in keys]
+
+        template_kwargs = self.progress_args(num_pending)
+        template_kwargs.update({
+            'to_label': images_to_label,
+            'labels': labels_by_row
+        })
+        return template_kwargs
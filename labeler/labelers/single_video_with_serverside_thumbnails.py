@@ -2,21 +2,21 @@ import collections
 import csv
 import tempfile
 import threading
+import time
 from functools import lru_cache
 from pathlib import Path
 from typing import NamedTuple, Optional
 
 import flask
-from moviepy.video.io.VideoFileClip import VideoFileClip
-from PIL import Image
 
 from labeler.labelers.single_file import SingleFileLabeler
 from labeler.label_stores.json_label_store import JsonLabelStore
 from labeler.utils.fs import VIDEO_EXTENSIONS
 from labeler.utils import video as video_utils
+from labeler.utils.media_cache import GENERATE_SECONDS, QUEUE_WAIT_SECONDS
 
 
-class SingleVideoWithThumbnailsLabeler(SingleFileLabeler):
+class SingleVideoWithServersideThumbnailsLabeler(SingleFileLabeler):
     def __init__(self,
                  root,
                  labels_csv,
@@ -24,7 +24,11 @@ class SingleVideoWithThumbnailsLabeler(SingleFileLabeler):
                  num_thumbnails=10,
                  thumb_duration=0,  # Set to 0 to generate image thumbnails
                  extensions=VIDEO_EXTENSIONS):
-        super().__init__(root, extensions, labels_csv, output_dir)
+        super().__init__(root,
+                         extensions,
+                         labels_csv,
+                         output_dir,
+                         template='label_video_with_serverside_thumbnails.html')
         self.num_thumbnails = num_thumbnails
         self.thumb_duration = thumb_duration
         self.thumbnail_dir = self.output_dir / 'thumbnails'
@@ -33,6 +37,16 @@ class SingleVideoWithThumbnailsLabeler(SingleFileLabeler):
         # running (through moviepy).
         self._thumbnail_semaphore = threading.Semaphore(8)
 
+    def __getstate__(self):
+        # Semaphores can't be pickled (e.g., in labeler snapshots).
+        state = self.__dict__.copy()
+        del state['_thumbnail_semaphore']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thumbnail_semaphore = threading.Semaphore(8)
+
     def public_directories(self):
         dirs = {
             'thumb': str(self.thumbnail_dir)
@@ -45,10 +59,17 @@ class SingleVideoWithThumbnailsLabeler(SingleFileLabeler):
         return f'/file/thumb/{relative}'
 
     def get_thumbnail(self, video, index):
+        queued = time.perf_counter()
         with self._thumbnail_semaphore:
-            return self._get_thumbnail_unsafe(video, index)
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued,
+                                       generator='thumbnail')
+            with GENERATE_SECONDS.time(generator='thumbnail'):
+                return self._get_thumbnail_unsafe(video, index)
 
     def _get_thumbnail_unsafe(self, video, index):
+        from moviepy.video.io.VideoFileClip import VideoFileClip
+        from PIL import Image
+
         video = self.url_to_key(video)
         relative = video.relative_to(self.root)
         thumbnail_dir = self.thumbnail_dir / relative
@@ -100,20 +121,15 @@ class SingleVideoWithThumbnailsLabeler(SingleFileLabeler):
             f'/api/thumbnail/{video}/{i}' for i in range(self.num_thumbnails)
         ]
 
-    def index(self):
-        video_keys = self.label_store.get_unlabeled(self.num_items)
-        total_videos = self.label_store.num_total()
-        num_complete = self.label_store.num_completed()
-        percent_complete = 100 * num_complete / max(total_videos, 1e-9)
+    def template_args(self, keys, num_pending=0):
         videos_to_label = [(key, self.key_to_url(key),
                             self.key_to_thumb_urls(key),
                             self.label_store.get_initial_label(key))
-                           for key in video_keys]
-        return flask.render_template(
-            'label_video_with_serverside_thumbnails.html',
-            num_left=total_videos - num_complete,
-            num_total=total_videos,
-            percent_complete='%.2f' % percent_complete,
-            to_label=videos_to_label,
-            image_thumbnails=self.thumb_duration == 0,
-            labels=self.labels_by_row())
+                           for key in keys]
+        template_kwargs = self.progress_args(num_pending)
+        template_kwargs.update({
+            'to_label': videos_to_label,
+            'image_thumbnails': self.thumb_duration == 0,
+            'labels': self.labels_by_row()
+        })
+        return template_kwargs
@@ -10,7 +10,10 @@ class SingleVideoWithThumbnailsLabeler(SingleVideoLabeler):
                  num_thumbnails=5,
                  require_first_thumbnail=False,
                  extensions=VIDEO_EXTENSIONS,
-                 num_items=10):
+                 num_items=10,
+                 proxy_height=None,
+                 proxy_crf=28,
+                 num_proxy_workers=2):
         template_args = {
             'num_thumbnails': num_thumbnails,
             'require_first_thumbnail': (
@@ -22,4 +25,7 @@ class SingleVideoWithThumbnailsLabeler(SingleVideoLabeler):
                          output_dir=output_dir,
                          template='label_video_with_thumbnails.html',
                          template_extra_args=template_args,
-                         num_items=num_items)
+                         num_items=num_items,
+                         proxy_height=proxy_height,
+                         proxy_crf=proxy_crf,
+                         num_proxy_workers=num_proxy_workers)
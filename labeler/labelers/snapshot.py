@@ -0,0 +1,182 @@
+"""Save constructed labelers to disk, so servers restart quickly.
+
+Constructing a labeler can list large directories, parse large JSON files,
+probe videos and validate labels. A snapshot is a pickle of the constructed
+labeler, saved in its output_dir, along with a fingerprint of its inputs:
+the labeler type and arguments, the files and directories passed as
+arguments, and the labeler code. The snapshot is used only if the
+fingerprint matches; labels are then reloaded if they changed since the
+snapshot was saved.
+
+Directories are fingerprinted by the names of all files and directories in
+their tree, so that snapshots of labelers that list directories (e.g.
+SingleFileLabeler) are not restored with a stale set of keys. This lists
+the whole tree on each start. With shallow_fingerprint, directories are
+instead fingerprinted by their own modification time, which changes when
+entries directly in them are added, removed or renamed, but not when
+entries in their subdirectories are. Neither detects files modified in
+place. Delete the snapshot to rebuild the labeler after such changes.
+
+Snapshots are pickles, so only load snapshots from trusted output
+directories.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import platform
+from pathlib import Path
+
+from labeler.label_stores.json_label_store import shared_by_default
+from labeler.labelers import labeler_dict
+from labeler.utils import startup
+from labeler.utils.fs import atomic_write
+
+SNAPSHOT_VERSION = 2
+
+
+def _path_fingerprint(path, shallow=False):
+    """Fingerprint a file by its size and mtime, or a directory by the names
+    of all entries in its tree (or, if shallow, by its own mtime)."""
+    stat = os.stat(path)
+    if not os.path.isdir(path):
+        return [stat.st_size, stat.st_mtime_ns]
+    if shallow:
+        return stat.st_mtime_ns
+    digest = hashlib.sha1()
+    for directory, subdirectories, files in os.walk(path):
+        subdirectories.sort()
+        relative = os.path.relpath(directory, path)
+        for name in sorted(files) + [''] + subdirectories:
+            digest.update(f'{relative}/{name}\0'.encode(
+                'utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def _code_fingerprint():
+    package = Path(__file__).resolve().parents[1]
+    digest = hashlib.sha1()
+    for path in sorted(package.rglob('*.py')):
+        stat = path.stat()
+        digest.update(f'{path.relative_to(package)}\0{stat.st_size}\0'
+                      f'{stat.st_mtime_ns}\0'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def input_fingerprint(labeler_type, labeler_args, shallow=False):
+    """Fingerprint the inputs of a labeler, for validating snapshots.
+
+    Args:
+        shallow (bool): Fingerprint directories by their own mtime, rather
+            than by all entries in their tree.
+    """
+    paths = {}
+    for name, value in sorted(labeler_args.items()):
+        # The output directory changes as labels are written; labels are
+        # checked separately when loading a snapshot.
+        if name == 'output_dir' or not isinstance(value, (str, os.PathLike)):
+            continue
+        if os.path.exists(value):
+            paths[name] = _path_fingerprint(value, shallow)
+    return {
+        'version': SNAPSHOT_VERSION,
+        'python': platform.python_version(),
+        'code': _code_fingerprint(),
+        'labeler_type': labeler_type,
+        'labeler_args': json.dumps(labeler_args, sort_keys=True, default=str),
+        'paths': paths,
+        'shallow': shallow,
+        # Whether label stores lock and reload labels; see shared_by_default.
+        'shared_label_store': shared_by_default()
+    }
+
+
+def snapshot_path(output_dir):
+    return Path(output_dir) / 'labeler_snapshot.pkl'
+
+
+def save_snapshot(labeler, path, fingerprint):
+    with startup.phase('save_snapshot'):
+        with atomic_write(path, 'wb') as f:
+            pickle.dump(fingerprint, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(labeler, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(path, fingerprint):
+    """Load labeler from snapshot at `path`.
+
+    Returns:
+        labeler (Labeler, None): None if there is no valid snapshot for
+            `fingerprint`.
+    """
+    with startup.phase('load_snapshot'):
+        try:
+            with open(path, 'rb') as f:
+                if pickle.load(f) != fingerprint:
+                    logging.info('Inputs changed since snapshot %s was saved.',
+                                 path)
+                    return None
+                labeler = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning('Could not load snapshot %s: %s', path, e)
+            return None
+    with startup.phase('reload_labels'):
+        try:
+            labeler.label_store.reload_if_changed()
+        except Exception as e:
+            logging.warning('Could not reload labels for snapshot %s: %s',
+                            path, e)
+            return None
+    return labeler
+
+
+def _prepare(labeler):
+    label_store = getattr(labeler, 'label_store', None)
+    if label_store is not None:
+        label_store.prepare()
+
+
+def load_labeler(labeler_type,
+                 labeler_args,
+                 use_snapshot=False,
+                 shallow_fingerprint=False):
+    """Construct labeler, or restore it from a snapshot in its output_dir.
+
+    Args:
+        labeler_type (str): Key in labeler_dict.
+        labeler_args (dict)
+        use_snapshot (bool): If True, restore the labeler from a snapshot if
+            its inputs haven't changed, or construct it and save a snapshot
+            if they have.
+        shallow_fingerprint (bool): Only check input directories themselves
+            for changes, rather than their whole tree; see the module
+            docstring.
+    """
+    with startup.phase('labeler'):
+        if not use_snapshot or 'output_dir' not in labeler_args:
+            labeler = labeler_dict[labeler_type](**labeler_args)
+            _prepare(labeler)
+            return labeler
+
+        path = snapshot_path(labeler_args['output_dir'])
+        with startup.phase('fingerprint_inputs'):
+            fingerprint = input_fingerprint(labeler_type, labeler_args,
+                                            shallow_fingerprint)
+        labeler = load_snapshot(path, fingerprint)
+        if labeler is not None:
+            logging.info('Restored labeler from snapshot %s', path)
+            _prepare(labeler)
+            return labeler
+        with startup.phase('construct'):
+            labeler = labeler_dict[labeler_type](**labeler_args)
+            _prepare(labeler)
+        try:
+            save_snapshot(labeler, path, fingerprint)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.warning('Could not save snapshot of %s: %s', labeler_type,
+                            e)
+        return labeler
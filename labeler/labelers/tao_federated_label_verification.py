@@ -3,8 +3,6 @@ import logging
 from collections import defaultdict
 from pathlib import Path
 
-from flask import abort, render_template
-
 from labeler.labelers.single_file import SingleFileLabeler, LabelSpec
 from labeler.label_stores.json_label_store import JsonLabelStore
 
@@ -98,28 +96,14 @@ class TaoFederatedLabelVerifier(SingleFileLabeler):
         self.template = template
         self.template_extra_args = template_extra_args
 
-    def index(self):
-        if self.template is None:
-            abort(404)
-
-        keys = self.label_store.get_unlabeled(self.num_items)
-        total = self.label_store.num_total()
-        num_complete = self.label_store.num_completed()
-        percent_complete = '%.2f' % (100 * num_complete / total)
-
+    def template_args(self, keys, num_pending=0):
         to_label = [(self.escape_key(key), self.key_to_url(key),
                      self.label_query_map[key],
                      self.label_store.get_initial_label(key)) for key in keys]
-        template_kwargs = {
-            'num_left': total - num_complete,
-            'num_total': total,
-            'percent_complete': percent_complete,
-            'to_label': to_label,
-        }
+        template_kwargs = self.progress_args(num_pending)
+        template_kwargs['to_label'] = to_label
         template_kwargs = self.update_template_args(template_kwargs)
-        return render_template(self.template,
-                               **template_kwargs,
-                               **self.template_extra_args)
+        return {**template_kwargs, **self.template_extra_args}
 
     def parse_form(self, form):
         # request.form is a dictionary that maps from '<file>__<label_id>' to
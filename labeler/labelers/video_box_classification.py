@@ -6,15 +6,21 @@ import json
 import math
 import random
 import shutil
+import threading
 from math import ceil, floor
 from pathlib import Path
 
+import flask
 import numpy as np
 from tqdm import tqdm
 
 from .single_file import SingleFileLabeler
 from ..label_stores.grouped_label_store import GroupedLabelStore
 from ..utils.fs import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS
+from ..utils.image import resize_image
+from ..utils import startup
+from ..utils.media_cache import MediaCache
+from ..utils.video import extract_frame, extract_frames
 
 
 class VideoBoxClassification(SingleFileLabeler):
@@ -40,7 +46,7 @@ class VideoBoxClassification(SingleFileLabeler):
         if isinstance(boxes_json, dict):
             self.boxes = boxes_json
         else:
-            with open(boxes_json, 'r') as f:
+            with startup.phase('load_boxes'), open(boxes_json, 'r') as f:
                 self.boxes = json.load(f)
 
         super().__init__(root,
@@ -50,6 +56,15 @@ class VideoBoxClassification(SingleFileLabeler):
                          template='video_box_classification.html',
                          num_items=num_items)
 
+        # Map video key to JSON string returned by video_data(). Built here,
+        # rather than when a video is requested, so it is timed as part of
+        # startup and saved in snapshots.
+        with startup.phase('encode_boxes'):
+            self._video_data = {
+                key: self._encode_video_data(key)
+                for key in self.label_store.keys
+            }
+
     def init_with_keys(self,
                        root,
                        keys,
@@ -66,13 +81,14 @@ class VideoBoxClassification(SingleFileLabeler):
         self.labels = SingleFileLabeler.load_label_spec(labels_csv)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True, parents=True)
-        self.label_store = GroupedLabelStore(
-            grouped_keys=grouped_keys,
-            extra_fields=['notes', 'other_labels'],
-            labels=[x.name for x in self.labels],
-            output_json=self.output_dir / 'labels.json',
-            initial_labels=review_labels,
-            initial_keys_only=review_labels is not None)
+        with startup.phase('label_store'):
+            self.label_store = GroupedLabelStore(
+                grouped_keys=grouped_keys,
+                extra_fields=['notes', 'other_labels'],
+                labels=[x.name for x in self.labels],
+                output_json=self.output_dir / 'labels.json',
+                initial_labels=review_labels,
+                initial_keys_only=review_labels is not None)
 
         self.num_items = num_items
 
@@ -87,16 +103,81 @@ class VideoBoxClassification(SingleFileLabeler):
 
     def update_template_args(self, template_kwargs):
         template_kwargs = template_kwargs.copy()
+        template_kwargs.setdefault('vocabulary', [])
+        # Only send track ids and colors with the page; boxes are fetched from
+        # /api/boxes/<video> when a video is focused.
         template_kwargs['video_boxes'] = {}
-        template_kwargs['video_steps'] = {}
         for escaped_key, _, _ in template_kwargs['to_label']:
             key = self.unescape_key(escaped_key)
             template_kwargs['video_boxes'][escaped_key] = {
-                self.escape_key(k): v
+                self.escape_key(k): {'color': v.get('color')}
                 for k, v in self.boxes[key].items()
             }
         return template_kwargs
 
+    def video_steps_info(self, key):
+        """Return (step times, step frame URLs) for video `key`.
+
+        Empty lists mean the client should infer steps from the video
+        duration."""
+        return [], []
+
+    def step_frame_manifest(self, key):
+        """Return URLs of frame images for all steps of video `key`.
+
+        video_steps_info() returns the original frames, which identify each
+        step; these are the images that are displayed, and may be smaller.
+        They should be ready to be fetched immediately, so the client can
+        preload all of a video's frames before playing its steps."""
+        return self.video_steps_info(key)[1]
+
+    def video_data(self, key):
+        """Return JSON with compact box data for video `key`.
+
+        Structure:
+        {
+            'tracks': <see encode_step_index()>,
+            'index': <see encode_step_index()>,
+            'steps': List[float],  # Time of each step, in seconds.
+            'step_frames': List[str]  # URL of frame image for each step.
+        }
+        """
+        return self._video_data[key]
+
+    def _encode_video_data(self, key):
+        steps, step_frames = self.video_steps_info(key)
+        tracks, index = encode_step_index({
+            self.escape_key(k): v
+            for k, v in self.boxes[key].items()
+        })
+        return json.dumps(
+            {
+                'tracks': tracks,
+                'index': index,
+                'steps': steps,
+                'step_frames': step_frames
+            },
+            separators=(',', ':'))
+
+    def api(self, api_request):
+        try:
+            request, key = api_request.split('/', 1)
+        except ValueError:
+            flask.abort(404)
+
+        key = self.unescape_key(key)
+        if request == 'boxes' and key in self._video_data:
+            response = flask.Response(self.video_data(key),
+                                      mimetype='application/json')
+            response.cache_control.private = True
+            response.cache_control.max_age = 3600
+            response.add_etag()
+            return response.make_conditional(flask.request)
+        elif request == 'frames' and key in self.boxes:
+            return flask.jsonify(self.step_frame_manifest(key))
+        else:
+            flask.abort(404)
+
     def parse_form(self, form):
         # request.form is a dictionary that maps from '<file>__<label_id>' to
         # 'on' if the user labeled this file as containing label id.
@@ -147,14 +228,27 @@ class CocoVideoBoxClassification(VideoBoxClassification):
                  portion_seed='NO_SHUFFLE',
                  annotation_fps=1,
                  num_items=10,
-                 extensions=VIDEO_EXTENSIONS):
+                 extensions=VIDEO_EXTENSIONS,
+                 frame_width=960,
+                 num_frame_workers=4,
+                 extract_missing_frames=False):
         """
         Args:
+            frames_root (str, Path, None): Directory containing the images
+                in coco_json. May be None if extract_missing_frames is True.
             portion (start, end): Used to split up annotation tasks into
                 multiple servers (e.g., to split up tasks across 2 workers,
                 one server can be started with (0, 0.5), and another with (0.5, 1.0).
+            frame_width (int): Width of downscaled step frames shown while
+                stepping through a video. Set to 0 to show original frames.
+            num_frame_workers (int): Number of processes for resizing frames,
+                and of ffmpeg processes for extracting frames.
+            extract_missing_frames (bool): If True, videos whose frames are
+                not in frames_root have their step frames extracted from the
+                video with ffmpeg, when first requested, and cached in
+                output_dir.
         """
-        with open(coco_json, 'r') as f:
+        with startup.phase('load_coco'), open(coco_json, 'r') as f:
             data = json.load(f)
         with open(vocabulary_json, 'r') as f:
             self.vocabulary = json.load(f)['categories']
@@ -189,7 +283,11 @@ class CocoVideoBoxClassification(VideoBoxClassification):
             }
         """
         root = Path(root)
-        self.frames_root = Path(frames_root)
+        self.frames_root = Path(frames_root) if frames_root else None
+        if self.frames_root is None and not extract_missing_frames:
+            raise ValueError(
+                'frames_root must be specified if extract_missing_frames is '
+                'False.')
         # Map video to list of frames that were sent for annotation (`steps`)
         video_frames = {}
         images = {}
@@ -231,61 +329,71 @@ class CocoVideoBoxClassification(VideoBoxClassification):
         frame_to_step = {}
         # For each video, map step index to time
         self.video_steps = {}
-        # For each video, map step index to frame path.
+        # For each video, map step index to frame path relative to
+        # frames_root (or to the extracted frames directory).
         self.video_step_frames = {}
+        # For each video, map step index to frame index.
+        self.video_step_frame_indices = {}
+        # Videos whose frames are extracted from the video.
+        self.extracted_videos = set()
         video_with_extension = {}
-        for video, frames in tqdm(video_frames.items()):
-            orig_video = video
-            if not (root / video).exists():
-                # Add extension if necessary
-                try:
-                    ext = next(x for x in VIDEO_EXTENSIONS
-                               if (root / f'{video}{x}').exists())
-                except StopIteration:
-                    raise ValueError(f'Could not find video {video} in {root}')
-                video = f'{video}{ext}'
-            video_with_extension[orig_video] = video
-            video_info[video] = get_video_info(str(root / video))
-            frame_to_step[video] = {}
-            self.video_steps[video] = {}
-            self.video_step_frames[video] = {}
-            frame0_path = Path(self.frames_root / frames[0]['file_name'])
-            if frame0_path.exists():
-                frame_ext = frame0_path.suffix
-            else:
-                try:
-                    frame_ext = next(x for x in IMAGE_EXTENSIONS
-                                     if frame0_path.with_suffix(x).exists())
-                except StopIteration:
-                    raise ValueError(
-                        f'Could not find frame {frame0_path} with any '
-                        f'extension')
-            for i, frame in enumerate(
-                    sorted(frames, key=lambda x: x['frame_index'])):
-                frame_idx = frame['frame_index']
-                frame_to_step[video][frame_idx] = i
-                self.video_steps[video][i] = (frame_idx /
-                                              video_info[video]['fps'])
-                frame_path = ('file/frame/' +
-                              frame['file_name'].rsplit('.', 1)[0] + frame_ext)
-                # assert frame_path.exists(), (
-                #     f'Could not find frame at {frame_path}')
-                self.video_step_frames[video][i] = frame_path
-
-        for annotation in tqdm(data['annotations'], desc='Processing videos'):
-            video, frame_name, frame_index = images[annotation['image_id']]
-            video = video_with_extension[video]
-            track_id = str(annotation['track_id'])
-            box = annotation['bbox']
-            if video not in boxes:
-                boxes[video] = {}
-            if track_id not in boxes[video]:
-                boxes[video][track_id] = {
-                    'boxes': {},
-                    'color': next(video_colors[video])
-                }
-            step_index = frame_to_step[video][frame_index]
-            boxes[video][track_id]['boxes'][str(step_index)] = box
+        with startup.phase('probe_videos'):
+            for video, frames in tqdm(video_frames.items()):
+                orig_video = video
+                if not (root / video).exists():
+                    # Add extension if necessary
+                    try:
+                        ext = next(x for x in VIDEO_EXTENSIONS
+                                   if (root / f'{video}{x}').exists())
+                    except StopIteration:
+                        raise ValueError(
+                            f'Could not find video {video} in {root}')
+                    video = f'{video}{ext}'
+                video_with_extension[orig_video] = video
+                video_info[video] = get_video_info(str(root / video))
+                frame_to_step[video] = {}
+                self.video_steps[video] = {}
+                self.video_step_frames[video] = {}
+                self.video_step_frame_indices[video] = {}
+                frame_ext = self._find_frame_ext(frames[0]['file_name'])
+                if frame_ext is None:
+                    if not extract_missing_frames:
+                        raise ValueError(
+                            f'Could not find frame '
+                            f'{frames[0]["file_name"]} in {self.frames_root} '
+                            f'with any extension')
+                    self.extracted_videos.add(video)
+                    frame_ext = '.jpg'
+
+                for i, frame in enumerate(
+                        sorted(frames, key=lambda x: x['frame_index'])):
+                    frame_idx = frame['frame_index']
+                    frame_to_step[video][frame_idx] = i
+                    self.video_step_frame_indices[video][i] = frame_idx
+                    self.video_steps[video][i] = (frame_idx /
+                                                  video_info[video]['fps'])
+                    frame_path = (frame['file_name'].rsplit('.', 1)[0] +
+                                  frame_ext)
+                    # assert frame_path.exists(), (
+                    #     f'Could not find frame at {frame_path}')
+                    self.video_step_frames[video][i] = frame_path
+
+        with startup.phase('group_boxes'):
+            for annotation in tqdm(data['annotations'],
+                                   desc='Processing videos'):
+                video, frame_name, frame_index = images[annotation['image_id']]
+                video = video_with_extension[video]
+                track_id = str(annotation['track_id'])
+                box = annotation['bbox']
+                if video not in boxes:
+                    boxes[video] = {}
+                if track_id not in boxes[video]:
+                    boxes[video][track_id] = {
+                        'boxes': {},
+                        'color': next(video_colors[video])
+                    }
+                step_index = frame_to_step[video][frame_index]
+                boxes[video][track_id]['boxes'][str(step_index)] = box
 
         # for video, info in video_info.items():
         #     frames_between_steps = int(round(info['fps'])) * annotation_fps
@@ -299,26 +407,250 @@ class CocoVideoBoxClassification(VideoBoxClassification):
         super().__init__(root, boxes, labels_csv, output_dir, num_items,
                          extensions)
 
+        if frame_width:
+            self.frame_variants = MediaCache(
+                self.output_dir / 'frames' / f'w{frame_width}',
+                resize_image,
+                suffix='.jpg',
+                generate_kwargs={'width': frame_width},
+                num_workers=num_frame_workers)
+        else:
+            self.frame_variants = None
+        self.num_frame_workers = num_frame_workers
+        if self.extracted_videos:
+            self.extracted_frames = MediaCache(
+                self.output_dir / 'extracted_frames',
+                extract_frame,
+                suffix='',
+                num_workers=num_frame_workers,
+                use_processes=False)
+        else:
+            self.extracted_frames = None
+        # Map video key to future extracting its step frames.
+        self._pending_extractions = {}
+        self._extraction_lock = threading.RLock()
+
+    def __getstate__(self):
+        # Pending extractions and locks can't be pickled (e.g., in labeler
+        # snapshots).
+        state = self.__dict__.copy()
+        state.update({'_pending_extractions': {}, '_extraction_lock': None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._extraction_lock = threading.RLock()
+
+    def _find_frame_ext(self, file_name):
+        """Return extension of frame `file_name` in frames_root, or None."""
+        if self.frames_root is None:
+            return None
+        frame_path = self.frames_root / file_name
+        if frame_path.exists():
+            return frame_path.suffix
+        return next((x for x in IMAGE_EXTENSIONS
+                     if frame_path.with_suffix(x).exists()), None)
+
     def public_directories(self):
-        return {
-            'file': self.root,
-            'frame': self.frames_root
-        }
+        dirs = {'file': self.root}
+        if self.frames_root is not None:
+            dirs['frame'] = self.frames_root
+        if self.frame_variants is not None:
+            dirs['frame_variant'] = self.frame_variants.cache_dir
+        if self.extracted_frames is not None:
+            dirs['extracted_frame'] = self.extracted_frames.cache_dir
+        return dirs
+
+    def step_frame_path(self, key, step):
+        """Return path of the full size frame for `step` of video `key`.
+
+        Extracts the frame from the video if necessary."""
+        frame = self.video_step_frames[key][step]
+        if key not in self.extracted_videos:
+            return self.frames_root / frame
+        return self.extracted_frames.get(
+            self.root / key,
+            frame,
+            index=self.video_step_frame_indices[key][step])
+
+    def extract_step_frames(self, key):
+        """Extract all uncached step frames of video `key` in one pass."""
+        if key not in self.extracted_videos:
+            return
+        outputs = {}
+        for step, frame in self.video_step_frames[key].items():
+            output = self.extracted_frames.path(frame)
+            if not output.exists():
+                outputs[self.video_step_frame_indices[key][step]] = output
+        extract_frames(self.root / key, outputs)
+
+    def submit_step_frames(self, key):
+        """Start extracting step frames of video `key`, without waiting.
+
+        Extraction runs in the extracted_frames worker pool; concurrent
+        requests for the same video share a single job.
+
+        Returns:
+            future (concurrent.futures.Future, None): None if the video's
+                frames are not extracted.
+        """
+        if key not in self.extracted_videos:
+            return None
+        with self._extraction_lock:
+            future = self._pending_extractions.get(key)
+            if future is None:
+                future = self.extracted_frames.executor.submit(
+                    self.extract_step_frames, key)
+                self._pending_extractions[key] = future
+                # Runs immediately (under the reentrant lock) if the job is
+                # already done.
+                future.add_done_callback(
+                    lambda _: self._extraction_done(key))
+        return future
+
+    def _extraction_done(self, key):
+        with self._extraction_lock:
+            self._pending_extractions.pop(key, None)
+
+    def step_frame_url(self, key, step, generate=False):
+        """Return URL of the frame image for `step` of video `key`.
+
+        Args:
+            generate (bool): If True, wait until the downscaled frame (if
+                any) is cached, and return its URL. Otherwise, return a URL
+                that generates it on request if it is not cached yet.
+        """
+        frame = self.video_step_frames[key][step]
+        if generate:
+            source = self.step_frame_path(key, step)
+            if self.frame_variants is not None:
+                self.frame_variants.get(source, frame)
+        if self.frame_variants is not None:
+            if self.frame_variants.path(frame).exists():
+                return (f'/file/frame_variant/{frame}'
+                        f'{self.frame_variants.suffix}')
+        elif key not in self.extracted_videos:
+            return f'/file/frame/{frame}'
+        elif self.extracted_frames.path(frame).exists():
+            return f'/file/extracted_frame/{frame}'
+        return f'/api/frame/{self.escape_key(key)}/{step}'
+
+    def step_frame_manifest(self, key):
+        num_steps = len(self.video_step_frames[key])
+        future = self.submit_step_frames(key)
+        if future is not None:
+            future.result()
+        if self.frame_variants is not None:
+            # Resize all of the video's frames in parallel.
+            futures = [
+                self.frame_variants.submit(self.step_frame_path(key, step),
+                                           frame)
+                for step, frame in self.video_step_frames[key].items()
+            ]
+            for future in futures:
+                if future is not None:
+                    future.result()
+        return [self.step_frame_url(key, i) for i in range(num_steps)]
+
+    def api(self, api_request):
+        if api_request.startswith('frame/'):
+            try:
+                key, step = api_request[len('frame/'):].rsplit('/', 1)
+                key, step = self.unescape_key(key), int(step)
+            except ValueError:
+                flask.abort(404)
+            if step not in self.video_step_frames.get(key, {}):
+                flask.abort(404)
+            return flask.redirect(self.step_frame_url(key, step,
+                                                      generate=True))
+        return super().api(api_request)
+
+    def precompute_media(self):
+        if self.extracted_videos:
+            futures = [
+                self.submit_step_frames(x) for x in self.extracted_videos
+            ]
+            for future in tqdm(futures, desc='Extracting frames'):
+                future.result()
+        if self.frame_variants is not None:
+            self.frame_variants.precompute(
+                ((self.step_frame_path(key, step), frame)
+                 for key, frames in self.video_step_frames.items()
+                 for step, frame in frames.items()),
+                desc='Resizing frames')
 
     def update_template_args(self, template_kwargs):
         template_kwargs = template_kwargs.copy()
         template_kwargs['vocabulary'] = self.vocabulary
-        template_kwargs = super().update_template_args(template_kwargs)
-        keys = {x[0] for x in template_kwargs['to_label']}
-        template_kwargs['video_steps'] = {
-            k: self.video_steps[self.unescape_key(k)]
-            for k in keys
-        }
-        template_kwargs['video_step_frames'] = {
-            k: self.video_step_frames[self.unescape_key(k)]
-            for k in keys
-        }
-        return template_kwargs
+        return super().update_template_args(template_kwargs)
+
+    def video_steps_info(self, key):
+        num_steps = len(self.video_steps[key])
+        return ([self.video_steps[key][i] for i in range(num_steps)],
+                [self.step_frame_original_url(key, i)
+                 for i in range(num_steps)])
+
+    def step_frame_original_url(self, key, step):
+        frame = self.video_step_frames[key][step]
+        if key in self.extracted_videos:
+            return f'/file/extracted_frame/{frame}'
+        return f'/file/frame/{frame}'
+
+
+def encode_step_index(tracks):
+    """Encode tracks as a step-major index of delta-coded integer arrays.
+
+    The client draws boxes step by step, so boxes are grouped by step, with
+    the tracks active at each step. Steps and box coordinates change little
+    from one step to the next, so storing differences makes for much smaller
+    (and more compressible) JSON than nested dicts. Boxes are rounded to
+    integer pixels.
+
+    Args:
+        tracks (dict): Map track id to
+            {'boxes': {<step>: [x0, y0, w, h]}, 'color': <css-color>}.
+
+    Returns:
+        tracks (dict): Contains lists with one entry per track:
+            'ids': Track id.
+            'colors': Track color (or None).
+            'ranges': [first step, last step] with a box in the track, or
+                None if the track has no boxes.
+        index (dict): Contains
+            'steps': Delta-coded sorted steps with at least one box.
+            'counts': Number of boxes at each step in 'steps'.
+            'track_idx': Flattened index (into tracks['ids']) of the track of
+                each box, ordered by step.
+            'boxes': Flattened [x0, y0, w, h, ...] boxes in the same order as
+                'track_idx', where each box is delta-coded with respect to
+                the previous box of the same track.
+    """
+    encoded_tracks = {'ids': [], 'colors': [], 'ranges': []}
+    boxes_by_step = collections.defaultdict(list)
+    for t, (track_id, track) in enumerate(tracks.items()):
+        steps = sorted(int(x) for x in track['boxes'].keys())
+        encoded_tracks['ids'].append(track_id)
+        encoded_tracks['colors'].append(track.get('color'))
+        encoded_tracks['ranges'].append([steps[0], steps[-1]]
+                                        if steps else None)
+        boxes = {int(k): v for k, v in track['boxes'].items()}
+        for step in steps:
+            boxes_by_step[step].append(
+                (t, [int(round(x)) for x in boxes[step]]))
+
+    index = {'steps': [], 'counts': [], 'track_idx': [], 'boxes': []}
+    previous_step = 0
+    previous_boxes = collections.defaultdict(lambda: [0, 0, 0, 0])
+    for step in sorted(boxes_by_step.keys()):
+        index['steps'].append(step - previous_step)
+        index['counts'].append(len(boxes_by_step[step]))
+        previous_step = step
+        for t, box in boxes_by_step[step]:
+            index['track_idx'].append(t)
+            index['boxes'].extend(
+                b - p for b, p in zip(box, previous_boxes[t]))
+            previous_boxes[t] = box
+    return encoded_tracks, index
 
 
 def get_video_info(video):
@@ -0,0 +1,373 @@
+"""Simulate concurrent annotators to load test a labeler.
+
+Each simulated annotator repeatedly loads a page (/), fetches the media on
+it, prefetches the next page (/batch) as the browser does, and submits
+random labels for the page's items. Annotators run either against the Flask
+app in this process (--config), or against a running server (--url).
+
+Labels are written to the labeler's output_dir, so run this on a copy of
+the config with a scratch output_dir."""
+
+import argparse
+import collections
+import functools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from pathlib import Path
+
+import numpy as np
+
+
+class _PageParser(HTMLParser):
+    """Collect media URLs and label inputs on a page."""
+    def __init__(self):
+        super().__init__()
+        self.media = []
+        # Map (escaped) key to list of label ids that can be checked.
+        self.checkboxes = collections.defaultdict(list)
+        self.notes = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        for attr in ('src', 'poster'):
+            url = attrs.get(attr)
+            if (tag in ('img', 'video', 'source') and url
+                    and url.startswith('/') and url not in self.media):
+                self.media.append(url)
+        name = attrs.get('name')
+        if tag != 'input' or not name or '__' not in name:
+            return
+        key, info = name.rsplit('__', 1)
+        if attrs.get('type') == 'checkbox':
+            self.checkboxes[key].append(info)
+        elif info == 'notes':
+            self.notes.append(key)
+
+
+def _page_json(html, variable):
+    """Return value of `variable = <json>;` in a page's scripts, or None."""
+    match = re.search(rf'^\s*{variable} = (.*);\s*$', html, re.MULTILINE)
+    return json.loads(match.group(1)) if match else None
+
+
+def route_label(url):
+    """Group URLs by route, as in label.route_label()."""
+    path = urllib.parse.urlsplit(url).path
+    parts = path.split('/')
+    if len(parts) > 2 and parts[1] in ('api', 'file'):
+        return '/'.join(parts[:3])
+    return path
+
+
+class FlaskClient:
+    """Makes requests to label.py's app in this process."""
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, url):
+        response = self.client.get(url, follow_redirects=True)
+        return response.status_code, response.get_data()
+
+    def post(self, url, form):
+        response = self.client.post(
+            url, data=form, headers={'Accept': 'application/json'})
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """Makes requests to a running server."""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def _open(self, request):
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def get(self, url):
+        return self._open(self.base_url + url)
+
+    def post(self, url, form):
+        return self._open(
+            urllib.request.Request(
+                self.base_url + url,
+                data=urllib.parse.urlencode(form).encode('utf-8'),
+                headers={'Accept': 'application/json'}))
+
+
+class LoadTest:
+    def __init__(self, client_fn, num_pages, fetch_media=True,
+                 think_time=0, seed=0):
+        """
+        Args:
+            client_fn (Callable[[], Client]): Creates a client for an
+                annotator.
+            num_pages (int): Number of pages each annotator submits.
+            fetch_media (bool): Whether to fetch media on each page.
+            think_time (float): Mean time annotators spend on a page before
+                submitting it, in seconds.
+        """
+        self.client_fn = client_fn
+        self.num_pages = num_pages
+        self.fetch_media = fetch_media
+        self.think_time = think_time
+        self.seed = seed
+        self.lock = threading.Lock()
+        # Map route to list of request durations, in seconds.
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        # Map key to annotators it was shown to.
+        self.shown = collections.defaultdict(set)
+        # Map key to number of times it was submitted.
+        self.submitted = collections.Counter()
+
+    def _request(self, method, url, *args):
+        start = time.perf_counter()
+        status, body = method(url, *args)
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.latencies[route_label(url)].append(duration)
+            if status >= 400:
+                self.errors[f'{route_label(url)} {status}'] += 1
+        return status, body
+
+    def _form(self, html, parser, rng):
+        """Return (keys on page, form with random labels for them)."""
+        form = {}
+        video_boxes = _page_json(html, 'videoBoxes')
+        if video_boxes is not None:
+            # Video box pages add a label select for each box in javascript.
+            categories = [x['name'] for x in _page_json(html, 'categories')
+                          or []] or ['unknown']
+            for video, boxes in video_boxes.items():
+                for box in boxes:
+                    form[f'{video}__{box}'] = rng.choice(categories)
+            keys = list(video_boxes)
+        else:
+            keys = list(parser.checkboxes)
+            for key, label_ids in parser.checkboxes.items():
+                form[f'{key}__{rng.choice(label_ids)}'] = 'on'
+        for key in parser.notes:
+            form[f'{key}__notes'] = ''
+            if key not in keys:
+                keys.append(key)
+        return keys, form
+
+    def annotate(self, annotator):
+        client = self.client_fn()
+        rng = random.Random(f'{self.seed}-{annotator}')
+        for _ in range(self.num_pages):
+            status, body = self._request(client.get, '/')
+            if status != 200:
+                return
+            html = body.decode('utf-8')
+            parser = _PageParser()
+            parser.feed(html)
+            keys, form = self._form(html, parser, rng)
+            if not keys:  # Everything is labeled.
+                return
+            with self.lock:
+                for key in keys:
+                    self.shown[key].add(annotator)
+
+            if self.fetch_media:
+                for url in parser.media:
+                    self._request(client.get, url)
+                if _page_json(html, 'videoBoxes') is not None:
+                    for key in keys:
+                        quoted = urllib.parse.quote(key)
+                        self._request(client.get, f'/api/boxes/{quoted}')
+                        self._request(client.get, f'/api/frames/{quoted}')
+            self._request(client.get, '/batch?page=1')
+            if self.think_time:
+                time.sleep(rng.uniform(0, 2 * self.think_time))
+
+            status, _ = self._request(client.post, '/submit', form)
+            if status < 400:
+                with self.lock:
+                    self.submitted.update(keys)
+
+    def run(self, num_annotators):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(num_annotators) as executor:
+            for future in [
+                    executor.submit(self.annotate, i)
+                    for i in range(num_annotators)
+            ]:
+                future.result()
+        return time.perf_counter() - start
+
+    def report(self, duration):
+        num_shown = sum(len(x) for x in self.shown.values())
+        # Times keys were shown to an annotator after being shown to another.
+        duplicates = sum(len(x) - 1 for x in self.shown.values())
+        latencies = {}
+        for route, times in sorted(self.latencies.items()):
+            latencies[route] = {
+                'count': len(times),
+                'p50_ms': 1000 * float(np.percentile(times, 50)),
+                'p99_ms': 1000 * float(np.percentile(times, 99))
+            }
+        return {
+            'duration_seconds': duration,
+            'items_submitted': sum(self.submitted.values()),
+            'items_per_minute': 60 * sum(self.submitted.values()) / duration,
+            'duplicate_assignment_rate': duplicates / max(num_shown, 1),
+            'keys_submitted_more_than_once': sum(
+                1 for x in self.submitted.values() if x > 1),
+            'errors': dict(self.errors),
+            'latencies': latencies
+        }
+
+
+def check_store(labels_json, num_before, num_submitted, valid_keys=None):
+    """Check that labels_json is intact after the load test.
+
+    Returns:
+        problems (List[str]): Empty if the store is intact.
+    """
+    try:
+        with open(labels_json, 'r') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        return [f'Could not load {labels_json}: {e}']
+    problems = []
+    if set(data.keys()) != {'annotations', 'labels'}:
+        problems.append(f'Unexpected fields {sorted(data.keys())}')
+        return problems
+    num_added = len(data['annotations']) - num_before
+    # Labelers may add more than one annotation per item (e.g., by
+    # propagating labels), but never fewer.
+    if num_added < num_submitted:
+        problems.append(f'{num_submitted} items were submitted, but only '
+                        f'{num_added} annotations were added.')
+    if valid_keys is not None:
+        unknown = [
+            x['key'] for x in data['annotations'] if x['key'] not in valid_keys
+        ]
+        if unknown:
+            problems.append(f'{len(unknown)} annotations have unknown keys, '
+                            f'e.g. {unknown[0]}')
+    num_labels = len(data['labels'])
+    for annotation in data['annotations']:
+        labels = annotation.get('labels')
+        if isinstance(labels, dict):  # Grouped labels
+            labels = [x for y in labels.values() for x in y]
+        if labels is None or not all(0 <= x < num_labels for x in labels):
+            problems.append(f'Invalid labels in annotation {annotation}')
+            break
+    return problems
+
+
+def _num_annotations(labels_json):
+    try:
+        with open(labels_json, 'r') as f:
+            return len(json.load(f)['annotations'])
+    except FileNotFoundError:
+        return 0
+
+
+def main():
+    # Use first line of file docstring as description if it exists.
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0] if __doc__ else '',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--config',
+                        type=Path,
+                        help='Config file, as passed in FLASK_CONFIG. Runs '
+                        'the app in this process.')
+    target.add_argument('--url',
+                        help='URL of a running server, e.g. '
+                        'http://localhost:5000.')
+    parser.add_argument('--labels-json',
+                        type=Path,
+                        help='Labels JSON to check after the test. Defaults '
+                        'to the labeler\'s output with --config.')
+    parser.add_argument('--num-annotators', type=int, default=8)
+    parser.add_argument('--num-pages',
+                        type=int,
+                        default=10,
+                        help='Pages submitted by each annotator.')
+    parser.add_argument('--think-time',
+                        type=float,
+                        default=0,
+                        help='Mean seconds spent labeling each page.')
+    parser.add_argument('--no-media',
+                        action='store_true',
+                        help='Don\'t fetch media on pages.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path,
+                        help='Save report as JSON to this file.')
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+
+    labels_json = args.labels_json
+    valid_keys = None
+    if args.config is not None:
+        os.environ['FLASK_CONFIG'] = str(args.config.resolve())
+        from labeler import label
+        app = label.app
+        label_store = label.labeler.label_store
+        if labels_json is None:
+            labels_json = label_store.output
+        valid_keys = label_store.keys
+        client_fn = functools.partial(FlaskClient, app)
+    else:
+        client_fn = functools.partial(HttpClient, args.url)
+
+    num_before = (_num_annotations(labels_json)
+                  if labels_json is not None else 0)
+    load_test = LoadTest(client_fn,
+                         args.num_pages,
+                         fetch_media=not args.no_media,
+                         think_time=args.think_time,
+                         seed=args.seed)
+    logging.info('Running %s annotators for %s pages each',
+                 args.num_annotators, args.num_pages)
+    duration = load_test.run(args.num_annotators)
+    report = load_test.report(duration)
+    if labels_json is not None:
+        problems = check_store(labels_json, num_before,
+                               report['items_submitted'], valid_keys)
+        report['store_intact'] = not problems
+        report['store_problems'] = problems
+
+    print(f'Items submitted: {report["items_submitted"]} in '
+          f'{duration:.1f}s ({report["items_per_minute"]:.1f} / minute)')
+    print(f'Duplicate assignment rate: '
+          f'{100 * report["duplicate_assignment_rate"]:.1f}% '
+          f'({report["keys_submitted_more_than_once"]} keys submitted more '
+          f'than once)')
+    if report['errors']:
+        print(f'Errors: {report["errors"]}')
+    if 'store_intact' in report:
+        print('Store intact' if report['store_intact'] else
+              'Store problems:\n  ' + '\n  '.join(report['store_problems']))
+    print(f'{"route":<30} {"count":>7} {"p50 ms":>9} {"p99 ms":>9}')
+    for route, stats in report['latencies'].items():
+        print(f'{route:<30} {stats["count"]:>7} {stats["p50_ms"]:>9.1f} '
+              f'{stats["p99_ms"]:>9.1f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Precompute cached media (resized images, etc.) for a labeler config."""
+
+import argparse
+import logging
+from pathlib import Path
+
+import flask
+
+from labeler.labelers.snapshot import load_labeler
+from labeler.utils import startup
+from labeler.utils.log import setup_logging
+
+
+def main():
+    # Use first line of file docstring as description if it exists.
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0] if __doc__ else '',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('config', type=Path,
+                        help='Config file, as passed in FLASK_CONFIG.')
+
+    args = parser.parse_args()
+    cfg = flask.Config(args.config.parent)
+    cfg.from_pyfile(args.config.name)
+
+    labeler = load_labeler(cfg['LABELER_TYPE'], cfg['LABELER_ARGS'])
+    setup_logging(str(labeler.output_dir / 'precompute_media.log'))
+    logging.info('Args:\n%s', vars(args))
+    logging.info(startup.format_phases())
+    if not hasattr(labeler, 'precompute_media'):
+        logging.info('%s has no media to precompute.', cfg['LABELER_TYPE'])
+        return
+    labeler.precompute_media()
+    logging.info('Finished precomputing media.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Summarize hotspots across request profiles saved by label.py.
+
+Profiles are saved when PROFILE_REQUESTS is set in the config (or
+LABELER_PROFILE_REQUESTS in the environment); see README."""
+
+import argparse
+import pstats
+from collections import defaultdict
+from pathlib import Path
+
+from labeler.utils.profiling import PROFILE_NAME_RE
+
+
+def main():
+    # Use first line of file docstring as description if it exists.
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0] if __doc__ else '',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('profiles',
+                        type=Path,
+                        nargs='+',
+                        help='Profile files, or directories containing them.')
+    parser.add_argument('--route',
+                        help='Only include profiles of routes containing this '
+                        'string, e.g. "api_boxes".')
+    parser.add_argument('--min-ms',
+                        type=int,
+                        default=0,
+                        help='Only include requests that took at least this '
+                        'long.')
+    parser.add_argument('--sort',
+                        default='cumulative',
+                        choices=['cumulative', 'tottime', 'ncalls'])
+    parser.add_argument('--top',
+                        type=int,
+                        default=30,
+                        help='Number of functions to show.')
+    parser.add_argument('--callers',
+                        help='Also show callers of functions matching this '
+                        'regex.')
+
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.profiles:
+        if path.is_dir():
+            paths.extend(sorted(path.glob('*.prof')))
+        else:
+            paths.append(path)
+
+    # Map route to list of request durations, in ms.
+    durations = defaultdict(list)
+    selected = []
+    for path in paths:
+        match = PROFILE_NAME_RE.match(path.name)
+        route, ms = (match.group('route'),
+                     int(match.group('ms'))) if match else ('unknown', 0)
+        if args.route is not None and args.route not in route:
+            continue
+        if ms < args.min_ms:
+            continue
+        durations[route].append(ms)
+        selected.append(path)
+
+    if not selected:
+        print('No profiles found.')
+        return
+
+    print(f'{len(selected)} profiles')
+    print(f'{"route":<40} {"count":>6} {"median ms":>10} {"max ms":>10}')
+    for route, times in sorted(durations.items(),
+                               key=lambda x: -sum(x[1])):
+        times = sorted(times)
+        print(f'{route:<40} {len(times):>6} {times[len(times) // 2]:>10} '
+              f'{times[-1]:>10}')
+    print()
+
+    stats = pstats.Stats(str(selected[0]))
+    for path in selected[1:]:
+        stats.add(str(path))
+    # Don't list every profile file in the report.
+    stats.files = []
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.top)
+    if args.callers:
+        stats.print_callers(args.callers)
+
+
+if __name__ == "__main__":
+    main()
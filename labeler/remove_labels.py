@@ -1,10 +1,16 @@
-"""Remove labels in one CSV from another CSV."""
+"""Remove labels in one CSV from another CSV.
+
+Kept for compatibility; like
+    python -m labeler.label_sets difference <input> <to-remove> --output ...
+which also supports labels.json and JSONL files, but always writes the
+video, labels and notes columns. As with label_sets, only the last row of
+each video in the input is kept."""
 
 import argparse
-import csv
 import logging
 from pathlib import Path
 
+from labeler.label_sets import combine
 from labeler.utils.log import setup_logging
 
 
@@ -25,25 +31,12 @@ def main():
     logging.info('Path to script: %s' % Path(__file__).resolve())
     logging.info('Args:\n%s', vars(args))
 
-    to_remove_videos = set()
-    with open(args.to_remove_csv, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            to_remove_videos.add(row['video'])
-
-    output_data = []
-    with open(args.input_labels_csv, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if row['video'] not in to_remove_videos:
-                output_data.append(row)
-
-    with open(args.output_csv, 'w') as f:
-        fieldnames = ['video', 'labels', 'notes']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in output_data:
-            writer.writerow(row)
+    num_rows = combine('difference',
+                       [args.input_labels_csv, args.to_remove_csv],
+                       args.output_csv,
+                       key_column='video',
+                       fieldnames=['video', 'labels', 'notes'])
+    logging.info('Wrote %s rows to %s', num_rows, args.output_csv)
 
     file_logger = logging.getLogger(args.output_csv + '.log')
     file_logger.info('Source:')
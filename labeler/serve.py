@@ -0,0 +1,105 @@
+"""Serve a labeler config with multiple worker processes (needs gunicorn)."""
+
+import argparse
+import multiprocessing
+import os
+from pathlib import Path
+
+
+def nginx_config(public_directories, accel_prefix, upstream):
+    """Return nginx server config that serves media files directly.
+
+    Requests are proxied to the labeler at `upstream`; responses from
+    label.py's /file route with an X-Accel-Redirect header (i.e., when
+    MEDIA_ACCEL_REDIRECT is set in the config) are served by nginx from the
+    labeler's public directories."""
+    accel_prefix = accel_prefix.rstrip('/')
+    locations = []
+    for key, directory in public_directories.items():
+        if directory is None:
+            continue
+        directory = str(Path(directory).resolve()).rstrip('/')
+        locations.append(f'''
+    location {accel_prefix}/{key}/ {{
+        internal;
+        alias {directory}/;
+        expires 1h;
+    }}''')
+    static_dir = Path(__file__).resolve().parent / 'static'
+    return f'''server {{
+    listen 80;
+    client_max_body_size 64m;
+
+    location / {{
+        proxy_pass http://{upstream};
+        proxy_set_header Host $host;
+        proxy_read_timeout 300s;
+    }}
+
+    location /static/ {{
+        alias {static_dir}/;
+        expires 1h;
+    }}
+{''.join(locations)}
+}}
+'''
+
+
+def main():
+    # Use first line of file docstring as description if it exists.
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0] if __doc__ else '',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('config', type=Path,
+                        help='Config file, as passed in FLASK_CONFIG.')
+    parser.add_argument('--bind', default='0.0.0.0:8000')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Threads per worker process.')
+    parser.add_argument('--timeout', type=int, default=300,
+                        help=('Worker timeout in seconds; generating media '
+                              'on the fly can take a while.'))
+    parser.add_argument(
+        '--no-preload',
+        action='store_true',
+        help=('Build the labeler separately in each worker, instead of once '
+              'before forking workers.'))
+    parser.add_argument(
+        '--print-nginx-config',
+        action='store_true',
+        help=('Print nginx config for serving static and media files, and '
+              'exit. Set MEDIA_ACCEL_REDIRECT in the labeler config to '
+              'have media files served by nginx.'))
+    args = parser.parse_args()
+
+    os.environ['FLASK_CONFIG'] = str(args.config.resolve())
+    # Workers share labels through the labels JSON files on disk.
+    os.environ['LABELER_SHARED_LABEL_STORE'] = '1'
+
+    if args.print_nginx_config:
+        from labeler.label import cfg, labeler
+        accel_prefix = cfg.get('MEDIA_ACCEL_REDIRECT') or '/_media'
+        print(nginx_config(labeler.public_directories(), accel_prefix,
+                           upstream=args.bind.replace('0.0.0.0', '127.0.0.1')))
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class LabelerApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', args.bind)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('preload_app', not args.no_preload)
+
+        def load(self):
+            from labeler.label import app
+            return app
+
+    LabelerApplication().run()
+
+
+if __name__ == "__main__":
+    main()
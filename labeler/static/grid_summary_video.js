@@ -0,0 +1,97 @@
+// Summary videos are only attached to the page when their cell is active, or,
+// when all videos are playing, when their cell is visible. Other cells show a
+// poster frame, so the number of open videos does not grow with grid size.
+var allPlaying = false;
+var visibleContainers = new Set();
+
+function attachVideo(container) {
+  let poster = $(container).find('img.summary-poster');
+  if (poster.length == 0 || $(container).find('video').length > 0) {
+    return;
+  }
+  let video = $(
+    `<video muted autoplay loop playsinline class='to-label summary-video'>
+     </video>`);
+  video.attr({
+    src: poster.attr('data-video'),
+    poster: poster.attr('src'),
+    'data-preview': poster.attr('data-preview')
+  });
+  video[0].playbackRate = 2.0;
+  poster.hide().after(video);
+}
+
+function detachVideo(container) {
+  $(container).find('video.summary-video').each(function() {
+    this.pause();
+    // Release the decoder and any buffered data.
+    this.removeAttribute('src');
+    this.load();
+    $(this).remove();
+  });
+  $(container).find('img.summary-poster').show();
+}
+
+function updateAttachedVideos() {
+  let active = $('.data-label-container.active')[0];
+  $('.data-label-container').each(function() {
+    if (this === active || (allPlaying && visibleContainers.has(this))) {
+      attachVideo(this);
+    } else {
+      detachVideo(this);
+    }
+  });
+}
+
+var visibilityObserver = null;
+
+function observeContainers() {
+  if (!('IntersectionObserver' in window)) {
+    return;
+  }
+  if (visibilityObserver === null) {
+    visibilityObserver = new IntersectionObserver(entries => {
+      for (const entry of entries) {
+        if (entry.isIntersecting) {
+          visibleContainers.add(entry.target);
+        } else {
+          visibleContainers.delete(entry.target);
+        }
+      }
+      if (allPlaying) {
+        updateAttachedVideos();
+      }
+    });
+  }
+  visibilityObserver.disconnect();
+  visibleContainers.clear();
+  $('.data-label-container').each(function() {
+    visibilityObserver.observe(this);
+  });
+}
+
+$(function() {
+  observeContainers();
+  updateAttachedVideos();
+});
+
+window.addEventListener("batchSwapped", event => {
+  observeContainers();
+  updateAttachedVideos();
+});
+
+window.addEventListener("unhandledKey", event => {
+  let rawEvent = event;
+  event = rawEvent.detail;  // original key event
+  if (event.key == 'p') {
+    allPlaying = !allPlaying;
+    updateAttachedVideos();
+  }
+});
+
+window.addEventListener("activeContainerUpdated", event => {
+  updateAttachedVideos();
+  if (allPlaying) {
+    $('video').each(function () { this.play(); });
+  }
+});
@@ -25,7 +25,8 @@ function updateContainer(container, updateFocus) {
   if (updateFocus) {
     $(container).focus();
   }
-  $('video').each(function() { this.pause(); });
+  // Videos converted from gifs keep playing, like the gifs would.
+  $('video').not('.gif-video').each(function() { this.pause(); });
   $(container).find('video').each(function() { this.play(); });
   var event = new CustomEvent('activeContainerUpdated');
   window.dispatchEvent(event);
@@ -39,24 +40,111 @@ function scrollToContainer(container) {
   }, 100);
 }
 
+function initPage() {
+  // Setup for the items on the current page. Called on page load, and when
+  // a prefetched page is swapped in. Event handlers for items are delegated
+  // in $(function() {...}) below, so they need no setup here.
+  $('video.to-label').not('.gif-video').each(function() {
+    this.playbackRate = 2.0;
+  });
+
+  updateContainer($('.data-label-container').eq(0));
+}
+
+// Promise for the next page's batch (see /batch in label.py), or null if we
+// are not prefetching.
+var nextBatch = null;
+// Elements used to prefetch media; kept so they are not garbage collected.
+var prefetchedMedia = [];
+
+function prefetchNextBatch() {
+  for (const elem of prefetchedMedia) {
+    elem.removeAttribute('src');
+  }
+  prefetchedMedia = [];
+  nextBatch = Promise.resolve($.getJSON('/batch', {page: 1})).then(batch => {
+    for (const media of batch.media) {
+      let elem;
+      if (media.type == 'video') {
+        elem = document.createElement('video');
+        elem.muted = true;
+        elem.preload = 'auto';
+      } else {
+        elem = new Image();
+      }
+      elem.src = media.url;
+      prefetchedMedia.push(elem);
+    }
+    return batch;
+  });
+  // If prefetching fails, fall back to regular form submission.
+  let thisBatch = nextBatch;
+  thisBatch.catch(() => {
+    if (nextBatch === thisBatch) {
+      nextBatch = null;
+    }
+  });
+}
+
+function swapInBatch(batch) {
+  let page = $(new DOMParser().parseFromString(batch.html, 'text/html'));
+  $('#progress').replaceWith(page.find('#progress'));
+  $('form').empty().append(page.find('form').children());
+  $('#preview-container').hide();
+  $(window).scrollTop(0);
+  initPage();
+  let event = new CustomEvent('batchSwapped', { detail: batch });
+  window.dispatchEvent(event);
+}
+
+function submitInBackground(form) {
+  // Submit labels for the current page, and immediately show the prefetched
+  // next page.
+  let submitted = fetch('/submit', {
+    method: 'POST',
+    body: new URLSearchParams(new FormData(form)),
+    headers: {'Accept': 'application/json'}
+  }).then(response => {
+    if (!response.ok) {
+      throw new Error(response.status + ' ' + response.statusText);
+    }
+  });
+  let batch = nextBatch;
+  nextBatch = null;
+  batch.then(batch => {
+    swapInBatch(batch);
+    // Only prefetch the page after this one once the labels are saved, so
+    // that it does not include items from the page we just submitted.
+    submitted.then(prefetchNextBatch, error => {
+      alert('Failed to submit labels (' + error.message + '), reloading.');
+      window.location.reload();
+    });
+  }, () => {
+    // Prefetching failed; show the next page once labels are saved.
+    submitted.then(() => window.location.reload());
+  });
+}
+
 $(function() {
   // var topSpace = 5;
   $('#preview-container').hide();
   $('body').click(() => $('#preview-container').hide());
 
-  $('video.to-label').each(function() {
-    this.playbackRate = 2.0;
-  });
-
-  updateContainer($('.data-label-container').eq(0));
+  initPage();
+  if ($('form').attr('data-prefetch') != 'false' && window.fetch) {
+    prefetchNextBatch();
+  }
 
-  $(".data-label-container").focusin(function() {
+  $('body').on('focusin', '.data-label-container', function() {
     if (!$(this).hasClass("active")) {
       updateContainer($(this), false /*updateFocus*/);
     }
   });
 
-  $(".data-label-container").focus(function() {
+  $('body').on('focus', '.data-label-container', function(event) {
+    if (event.target !== this) {
+      return;  // A child element was focused.
+    }
     updateContainer($(this), false /*updateFocus*/);
     scrollToContainer($(this));
   });
@@ -97,7 +185,7 @@ $(function() {
       updateContainer(toSelect);
       // toSelect.scrollIntoView({'behavior': 'instant'});
     } else if (event.key == 'o') {
-      $('.active').find('.to-label').click();  // open preview
+      $('.active').find('.to-label:visible').click();  // open preview
     } else if (!isNaN(event.key)) {
       var label_index = parseInt(event.key);
       if (label_index == 0) {
@@ -122,7 +210,7 @@ $(function() {
     }
   });
 
-  $("label").keypress(function(event) {
+  $('body').on('keypress', 'label', function(event) {
     if (event.which == 32) { // space bar
       $(this).click();
       event.preventDefault();
@@ -149,7 +237,11 @@ $(function() {
       return false;
     } else {
       $('#error').hide();
-      return true;
+      if (nextBatch === null) {
+        return true;
+      }
+      submitInBackground(this);
+      return false;
     }
   });
 
@@ -169,7 +261,9 @@ $(function() {
   });
 
   var addedHandler = false;
-  $('.to-label, .to-label-container .thumbnail').click(function() {
+  // Delegated, so elements added after page load (e.g., videos attached
+  // lazily) also open the preview.
+  $('body').on('click', '.to-label, .to-label-container .thumbnail', function() {
     var preview = $('#preview'),
         container = $('#preview-container');
     if (!addedHandler) {
@@ -189,7 +283,7 @@ $(function() {
       container.hide();
     } else {
       container.show();
-      let elementType = currentSrc.endsWith('.mp4') && 'video' || 'img';
+      let elementType = currentSrc.match(/\.(mp4|webm)$/) && 'video' || 'img';
 
       if (
         preview.length == 0 ||
@@ -228,7 +322,7 @@ $(function() {
   });
   $("#preview").hide();
 
-  $(".label-search").on("input", function() {
+  $('body').on('input', '.label-search', function() {
     let text = $(this).val();
     let labels = $(this).closest(".data-label-container").find("label");
     labels.each(function() {
@@ -15,6 +15,141 @@ function getVideoKey(elem) {
     return elem.closest('.data-label-container').attr('id');
 }
 
+function getVideoElem(video) {
+    return $(`#${$.escapeSelector(video)} video`)[0];
+}
+
+function decodeStepIndex(tracks, index) {
+    // Inverse of encode_step_index() in video_box_classification.py. Returns
+    //   steps: Map step to {tracks: [track index], boxes: [[x0, y0, w, h]]},
+    //       with boxes in video pixels.
+    //   trackSteps: Map track id to sorted steps with a box in the track.
+    let steps = {};
+    let trackSteps = {};
+    tracks.ids.forEach(id => { trackSteps[id] = []; });
+    let previousBoxes = tracks.ids.map(() => [0, 0, 0, 0]);
+    let step = 0, b = 0;
+    index.steps.forEach(function(stepDelta, i) {
+        step += stepDelta;
+        let entry = {tracks: [], boxes: []};
+        for (let j = 0; j < index.counts[i]; ++j, ++b) {
+            let t = index.track_idx[b];
+            let box = previousBoxes[t].map((x, k) => x + index.boxes[4 * b + k]);
+            previousBoxes[t] = box;
+            entry.tracks.push(t);
+            entry.boxes.push(box);
+            trackSteps[tracks.ids[t]].push(step);
+        }
+        steps[step] = entry;
+    });
+    return {steps: steps, trackSteps: trackSteps};
+}
+
+// Map video key to promise that resolves once the video's boxes and steps
+// are loaded.
+let videoDataPromises = {};
+let videoDataLoaded = {};
+// Map video key to track info and step index from /api/boxes.
+let videoTracks = {};
+window.videoStepImages = {};
+
+function videoApiUrl(request, video) {
+    return `/api/${request}/` +
+        video.split('/').map(encodeURIComponent).join('/');
+}
+
+function loadVideoData(video) {
+    if (!videoDataPromises.hasOwnProperty(video)) {
+        let url = videoApiUrl('boxes', video);
+        let promise = Promise.resolve($.getJSON(url)).then(data => {
+            videoTracks[video] = Object.assign(
+                {ids: data.tracks.ids, colors: data.tracks.colors,
+                 ranges: data.tracks.ranges},
+                decodeStepIndex(data.tracks, data.index));
+            return setupSteps(video, data.steps, data.step_frames);
+        }).then(() => {
+            videoDataLoaded[video] = true;
+            preloadStepFrames(video);
+        });
+        // Allow retrying if loading failed.
+        promise.catch(() => { delete videoDataPromises[video]; });
+        videoDataPromises[video] = promise;
+    }
+    return videoDataPromises[video];
+}
+
+// Map video key to promise that resolves once all of the video's step frames
+// are loaded.
+let stepFramePromises = {};
+
+function preloadStepFrames(video) {
+    if (!stepFramePromises.hasOwnProperty(video)) {
+        let url = videoApiUrl('frames', video);
+        let promise = Promise.resolve($.getJSON(url)).then(frames => {
+            videoStepImages[video] = {};
+            return Promise.all(frames.map((frame, step) => {
+                let image = new Image;
+                image.src = frame;
+                videoStepImages[video][step] = image;
+                // Don't hold up playback because of one broken frame.
+                return image.decode().catch(() => {});
+            }));
+        });
+        promise.catch(() => { delete stepFramePromises[video]; });
+        stepFramePromises[video] = promise;
+    }
+    return stepFramePromises[video];
+}
+
+function setupSteps(video, steps, stepFrames) {
+    let videoElem = getVideoElem(video);
+    return new Promise(resolve => {
+        if (steps.length > 0 || videoElem.readyState >= 1) {
+            resolve();
+        } else {
+            // Need the duration to infer steps.
+            videoElem.addEventListener('loadedmetadata', resolve,
+                                       {once: true});
+        }
+    }).then(() => {
+        videoSteps[video] = {};
+        videoStepFrames[video] = {};
+        if (steps.length > 0) {
+            steps.forEach((time, i) => { videoSteps[video][i] = time; });
+            stepFrames.forEach((frame, i) => {
+                videoStepFrames[video][i] = frame;
+            });
+        } else {
+            let numSteps = Math.round(videoElem.duration * ANNOTATION_FPS);
+            for (let i = 0; i < numSteps; ++i) {
+                videoSteps[video][i] = videoElem.duration / numSteps * i;
+            }
+        }
+        buildTimeline(video);
+    });
+}
+
+function buildTimeline(video) {
+    let videoSelector = $.escapeSelector(video);
+    let timeline = $(`#${videoSelector} .timeline`);
+    for (const step in videoSteps[video]) {
+        let frame = videoStepFrames[video][step];
+        let title = `t=${videoSteps[video][step]}, ` +
+                    `scaleStep=${parseInt(step)+1}`;
+        if (frame !== undefined) {
+            let parts = frame.split('/');
+            title = `frame=${parts[parts.length - 1]}, ` + title;
+        }
+        timeline.append(
+          `<div data-time='${videoSteps[video][step]}'
+                data-step='${step}'
+                title='${title}'
+                class='timeline-step timeline-step-${step}
+                    timeline-step-valid'></div>`
+        );
+    }
+}
+
 function seekToStep(container, step, drawOriginalFrame) {
     drawBoxes(container, step, drawOriginalFrame);
     let time = container
@@ -63,42 +198,48 @@ function getActiveContainer() {
 }
 
 function drawBoxesHelper(canvas, activeBoxes, step) {
+    if (activeBoxes.length == 0) {
+        return;
+    }
+    let video = $(activeBoxes[0]).attr('data-video');
+    let tracks = videoTracks[video];
+    if (tracks === undefined || !(step in tracks.steps)) {
+        return;
+    }
+    let active = new Set(
+        activeBoxes.map(function() { return $(this).attr('data-box-id'); })
+                   .get());
+    // Boxes are in video pixels; the canvas is usually the same size as the
+    // video.
+    let videoElem = getVideoElem(video);
+    let sx = canvas.width / (videoElem.videoWidth || canvas.width),
+        sy = canvas.height / (videoElem.videoHeight || canvas.height);
     let ctx = canvas.getContext('2d');
-    ctx.fillStyle = 'black';
-    // if (activeBoxes.length > 0) {
-    //     ctx.globalAlpha = 0.1;
-    //     ctx.rect(0, 0, canvas.width, canvas.height);
-    //     ctx.fill();
-    // }
-    for (const boxElem of activeBoxes) {
-        jBoxElem = $(boxElem);
-        let videoSelector = jBoxElem.attr('data-video');
-        let boxId = jBoxElem.attr('data-box-id');
-        let boxInfo = videoBoxes[videoSelector][boxId];
-        if (step in boxInfo['boxes']) {
-            let box = boxInfo['normalizedBoxes'][step];
-            ctx.globalAlpha = 0.3;
-            ctx.beginPath();
-            ctx.fillStyle = boxInfo['color'];
-            [x0, y0, w, h] = [
-              box[0] * canvas.width,
-              box[1] * canvas.height,
-              box[2] * canvas.width,
-              box[3] * canvas.height
-            ];
-            ctx.rect(x0, y0, w, h);
-            ctx.fill();
-            ctx.closePath();
-
-            ctx.globalAlpha = 0.9;
-            ctx.beginPath();
-            ctx.strokeStyle = boxInfo['color'];
-            ctx.lineWidth = 3;
-            ctx.rect(x0, y0, w, h);
-            ctx.stroke();
-            ctx.closePath();
+    let entry = tracks.steps[step];
+    entry.tracks.forEach(function(t, i) {
+        if (!active.has(tracks.ids[t])) {
+            return;
         }
-    }
+        let box = entry.boxes[i];
+        let color = tracks.colors[t];
+        let [x0, y0, w, h] = [
+            box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy
+        ];
+        ctx.globalAlpha = 0.3;
+        ctx.beginPath();
+        ctx.fillStyle = color;
+        ctx.rect(x0, y0, w, h);
+        ctx.fill();
+        ctx.closePath();
+
+        ctx.globalAlpha = 0.9;
+        ctx.beginPath();
+        ctx.strokeStyle = color;
+        ctx.lineWidth = 3;
+        ctx.rect(x0, y0, w, h);
+        ctx.stroke();
+        ctx.closePath();
+    });
 }
 
 function drawBoxes(container, step, drawOriginalFrame) {
@@ -122,7 +263,11 @@ function drawBoxes(container, step, drawOriginalFrame) {
     if (drawOriginalFrame) {
         // https://stackoverflow.com/a/4776378/1291812
         let videoName = getVideoKey(container);
-        let img = videoStepImages[videoName][step];
+        let img = (videoStepImages[videoName] || {})[step];
+        if (img === undefined) {
+            drawBoxesHelper(canvas, activeBoxes, step);
+            return;
+        }
         let imgLoaded = img.complete && img.naturalHeight !== 0;
         if (imgLoaded) {
             ctx.globalAlpha = 1.0;
@@ -152,6 +297,14 @@ function stopStepPlayback(container) {
 }
 
 function playVideoSteps(container) {
+    // Wait for all step frames, so playback does not stall on fetching them.
+    let video = getVideoKey(container);
+    loadVideoData(video)
+        .then(() => preloadStepFrames(video))
+        .then(() => playVideoStepsLoaded(container));
+}
+
+function playVideoStepsLoaded(container) {
     stopStepPlayback(container);
     let jVideo = container.find('video'),
         video = jVideo[0];
@@ -191,6 +344,11 @@ function selectBox(boxElement) {
     jBox.siblings('.box-element').removeClass('box-element-active');
     jBox.addClass('box-element-active');
 
+    let video = jBox.attr('data-video');
+    loadVideoData(video).then(() => selectLoadedBox(jBox));
+}
+
+function selectLoadedBox(jBox) {
     // Set all timeline steps to be invalid
     let container = getContainer(jBox);
     let timeline = container.find('.timeline');
@@ -199,17 +357,21 @@ function selectBox(boxElement) {
     // Set valid timeline steps for this box
     let video = jBox.attr('data-video');
     let boxid = jBox.attr('data-box-id');
-    let boxSteps = Object.keys(videoBoxes[video][boxid]['boxes']);
-    boxSteps.forEach(i =>
+    let tracks = videoTracks[video];
+    tracks.trackSteps[boxid].forEach(i =>
         timeline.find(`.timeline-step-${i}`).addClass("timeline-step-valid")
     );
+    // [first step, last step] of the track, from the server.
+    let range = tracks.ranges[tracks.ids.indexOf(boxid)];
 
     // Start playing the video.
     // playVideoSteps(container);
     console.log('Setting time')
     let jVideo = container.find('video');
     jVideo[0].pause();
-    seekToStep(container, boxSteps[0], /*drawOriginalFrame=*/true);
+    if (range) {
+        seekToStep(container, range[0], /*drawOriginalFrame=*/true);
+    }
     jVideo[0].play();
 }
 
@@ -221,8 +383,6 @@ function setupCanvas(canvas) {
         height: vh,
         width: vw
     });
-    let videoName = getContainer(jCanvas).parent().attr('id');
-    normalizeBoxes(videoName);
 
     /*
     // 
@@ -242,25 +402,6 @@ function setupCanvas(canvas) {
     */
 }
 
-function normalizeBoxes(videoName) {
-    let videoSelector = $.escapeSelector(videoName);
-    let videoElem = $(`#${videoSelector} video`)[0];
-    let boxes = videoBoxes[videoName];
-    for (const [_, boxInfo] of Object.entries(boxes)) {
-        let boxSteps = boxInfo['boxes']
-        let normalized = {}
-        Object.entries(boxSteps).forEach(function([step, box]) {
-            normalized[step] = [
-                box[0] / videoElem.videoWidth,
-                box[1] / videoElem.videoHeight,
-                box[2] / videoElem.videoWidth,
-                box[3] / videoElem.videoHeight
-            ];
-        })
-        boxInfo['normalizedBoxes'] = normalized;
-    }
-}
-
 $(function() {
     if ($('.data-label-container').length == 0) {
         $('body').append('<h1 class="congrats">Congratulations. You\'re done!</h1>')
@@ -293,16 +434,10 @@ $(function() {
           .join("\n");
         console.log('Appending boxHtml');
         $(`#${videoSelector} .boxes`).append(boxHtml);
-        console.log(video);
-        console.log(videoSteps);
-        if (!videoSteps.hasOwnProperty(video)) {
-            videoSteps[video] = {};
-            let videoElem = $(`#${videoSelector} video`)[0]
-            let numSteps = Math.round(videoElem.duration * ANNOTATION_FPS);
-            for (let i = 0; i < numSteps; ++i) {
-                videoSteps[video][i] = videoElem.duration / numSteps * i;
-            }
-        }
+    }
+    let activeContainer = $('.data-label-container.active');
+    if (activeContainer.length > 0) {
+        loadVideoData(activeContainer.attr('id'));
     }
     $('.box-element').addClass('box-element-active');
 
@@ -317,32 +452,8 @@ $(function() {
         }
     });
 
-    window.videoStepImages = {}
-    for (const video in videoSteps) {
-        let videoSelector = $.escapeSelector(video);
-        let timeline = $(`#${videoSelector} .timeline`);
-        videoStepImages[video] = {};
-        for (const step in videoSteps[video]) {
-            let parts = videoStepFrames[video][step].split('/');
-            let frameName = parts[parts.length - 1];
-            let title = `frame=${frameName}, ` + 
-                        `t=${videoSteps[video][step]}, ` +
-                        `scaleStep=${parseInt(step)+1}`;
-            timeline.append(
-              `<div data-time='${videoSteps[video][step]}'
-                    data-step='${step}'
-                    title='${title}'
-                    class='timeline-step timeline-step-${step}
-                        timeline-step-valid'></div>`
-            );
-            // Preload step image
-            let image = new Image;
-            image.src = videoStepFrames[video][step];
-            videoStepImages[video][step] = image;
-        }
-    }
-
-    $('.timeline-step').click(function(e) {
+    // Delegated, as timelines are built once each video's data is loaded.
+    $('body').on('click', '.timeline-step', function(e) {
         let jThis = $(this);
         let step = jThis.attr('data-step');
         let container = getContainer(jThis);
@@ -396,6 +507,9 @@ $(function() {
         let container = getContainer(jThis);
         container.find('.timeline-step').removeClass('timeline-step-active');
         let videoName = getVideoKey(container);
+        if (!videoDataLoaded[videoName]) {
+            return;
+        }
         let time = this.currentTime;
         let closestStep, closestStepDistance = Infinity;
         for ([step, stepTime] of Object.entries(videoSteps[videoName])) {
@@ -581,6 +695,17 @@ $(function() {
             });
     });
 
+    window.addEventListener("activeContainerUpdated", event => {
+        // Load boxes for the active video, and prefetch the next one.
+        let active = $('.data-label-container.active');
+        let next = active.next('.data-label-container');
+        [active, next].forEach(container => {
+            if (container.length > 0) {
+                loadVideoData(container.attr('id'));
+            }
+        });
+    });
+
     window.addEventListener("unhandledKey", event => {
       let rawEvent = event;
       event = rawEvent.detail;  // original key event
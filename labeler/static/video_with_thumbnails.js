@@ -164,11 +164,14 @@ class ThumbnailCreator {
 }
 
 let thumbnailer = new ThumbnailCreator();
-$(function() {
+function createAllThumbnails() {
   // Wait a few seconds for videos to load, then start generating thumbnails 
   // Ideally we would run this after 'loadedmetadata' is fired on all videos,
   // but I can't find an easy way to listen for all of those events to fire.
-  $('body').prepend('<div id="loading-thumbnails">Loading...</div>')
+  if ($('#loading-thumbnails').length == 0) {
+    $('body').prepend('<div id="loading-thumbnails">Loading...</div>')
+  }
+  $('#loading-thumbnails').show();
   let thumbnailPromise = Promise.resolve();
   var firstThumbnailsLoaded = false;
   $('video').each(function() { this.pause() });
@@ -184,7 +187,10 @@ $(function() {
       });
     }
   });
-});
+}
+
+$(createAllThumbnails);
+window.addEventListener("batchSwapped", createAllThumbnails);
 
 window.addEventListener(
   "activeContainerUpdated",
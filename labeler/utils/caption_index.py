@@ -0,0 +1,148 @@
+"""Caption lookup from a memory-mapped index, instead of a JSON dict."""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+from . import startup
+from .fs import atomic_write
+
+
+class CaptionIndex(Mapping):
+    """Read-only map from keys to captions in a JSON file.
+
+    The JSON file (a dict mapping keys to captions) is converted once to an
+    index in `index_dir`: a data file containing each key followed by its
+    JSON-encoded caption, with keys sorted by their UTF-8 encoding, and an
+    array of offsets into it. Both are memory-mapped, so captions are only
+    read from disk when they are looked up. The index is rebuilt if the JSON
+    file changes.
+    """
+    VERSION = 1
+
+    def __init__(self, json_path, index_dir):
+        """
+        Args:
+            json_path (str, Path): JSON file mapping keys to captions.
+            index_dir (str, Path): Directory to store the index in.
+        """
+        self.json_path = Path(json_path)
+        index_dir = Path(index_dir)
+        index_dir.mkdir(exist_ok=True, parents=True)
+        # Include a hash of the source path, so caption files with the same
+        # name don't share an index.
+        source_hash = hashlib.sha1(
+            str(self.json_path.resolve()).encode('utf-8')).hexdigest()[:12]
+        name = f'{self.json_path.stem}_{source_hash}'
+        self.data_path = index_dir / f'{name}.data'
+        self.offsets_path = index_dir / f'{name}.offsets.npy'
+        self.info_path = index_dir / f'{name}.info.json'
+        with startup.phase('caption_index'):
+            if not self._is_current():
+                self._build()
+            self._open()
+
+    def _source_info(self):
+        stat = os.stat(self.json_path)
+        return {
+            'version': self.VERSION,
+            'source': str(self.json_path.resolve()),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns
+        }
+
+    def _is_current(self):
+        try:
+            with open(self.info_path, 'r') as f:
+                return json.load(f) == self._source_info()
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+    def _build(self):
+        logging.info(f'Building caption index for {self.json_path} in '
+                     f'{self.data_path.parent}')
+        source_info = self._source_info()
+        with open(self.json_path, 'r') as f:
+            captions = json.load(f)
+        items = sorted((k.encode('utf-8'), json.dumps(v).encode('utf-8'))
+                       for k, v in captions.items())
+        del captions
+
+        # offsets[2*i:2*i+3] are the start of the i-th key, the end of the
+        # i-th key (i.e., the start of its caption), and the end of its
+        # caption.
+        offsets = np.zeros(2 * len(items) + 1, dtype=np.int64)
+        position = 0
+        with atomic_write(self.data_path, 'wb') as f:
+            for i, (key, caption) in enumerate(items):
+                f.write(key)
+                position += len(key)
+                offsets[2 * i + 1] = position
+                f.write(caption)
+                position += len(caption)
+                offsets[2 * i + 2] = position
+        with atomic_write(self.offsets_path, 'wb') as f:
+            np.save(f, offsets)
+        # Written last, so an interrupted build is redone.
+        with atomic_write(self.info_path) as f:
+            json.dump(source_info, f)
+
+    def _open(self):
+        self._offsets = np.load(self.offsets_path, mmap_mode='r')
+        with open(self.data_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:  # Can't mmap empty files.
+                self._data = b''
+
+    def __getstate__(self):
+        # Memory maps can't be pickled; they are reopened on unpickling.
+        state = self.__dict__.copy()
+        del state['_offsets'], state['_data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _slice(self, start, end):
+        return self._data[int(self._offsets[start]):int(self._offsets[end])]
+
+    def _key(self, i):
+        return self._slice(2 * i, 2 * i + 1)
+
+    def _find(self, key):
+        """Return index of `key`, or None if it is not in the index."""
+        encoded = key.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < encoded:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self) and self._key(low) == encoded:
+            return low
+        return None
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return json.loads(self._slice(2 * i + 1, 2 * i + 2))
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._find(key) is not None
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._key(i).decode('utf-8')
+
+    def __len__(self):
+        return (len(self._offsets) - 1) // 2
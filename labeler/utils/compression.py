@@ -0,0 +1,120 @@
+"""Compression of Flask responses."""
+
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/javascript', 'application/json', 'text/css', 'text/html',
+    'text/javascript', 'text/plain'
+}
+MIN_COMPRESS_SIZE = 500
+
+# Map (ETag, encoding) to compressed body of files (e.g. static CSS and JS),
+# so they aren't compressed again on every request.
+_file_cache = {}
+_FILE_CACHE_SIZE = 256
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def choose_encoding(accept_encodings):
+    """Return 'br' or 'gzip', whichever the client accepts and we support
+    (preferring brotli), or None.
+
+    Args:
+        accept_encodings (werkzeug.datastructures.Accept)
+    """
+    if brotli is not None and 'br' in accept_encodings:
+        return 'br'
+    if 'gzip' in accept_encodings:
+        return 'gzip'
+    return None
+
+
+def _cache_compressed(cache_key, data, encoding):
+    if cache_key in _file_cache:
+        return _file_cache[cache_key]
+    compressed = _compress(data, encoding)
+    if len(_file_cache) >= _FILE_CACHE_SIZE:
+        _file_cache.clear()
+    _file_cache[cache_key] = compressed
+    return compressed
+
+
+def compress_file(path, encoding):
+    """Return the compressed contents of a file, or None if it is too small
+    to be worth compressing.
+
+    Cached by path and modification time, like compress_response() caches
+    files by ETag."""
+    stat = os.stat(path)
+    if stat.st_size < MIN_COMPRESS_SIZE:
+        return None
+    cache_key = (str(path), stat.st_mtime_ns, stat.st_size, encoding)
+    if cache_key in _file_cache:
+        return _file_cache[cache_key]
+    with open(path, 'rb') as f:
+        return _cache_compressed(cache_key, f.read(), encoding)
+
+
+def compress_response(response, accept_encodings):
+    """Compress response body with brotli or gzip, if the client accepts it.
+
+    Media files (which are already compressed), streamed responses and
+    partial responses are left as is. Compressed bodies of files (e.g. static
+    CSS and JS) are cached by ETag. Brotli is used if the `brotli` package is
+    installed.
+
+    Since the compressed body differs from the original, its ETag is made
+    weak; conditional requests still match it.
+
+    Args:
+        response (flask.Response)
+        accept_encodings (werkzeug.datastructures.MIMEAccept): Usually
+            flask.request.accept_encodings.
+    """
+    # Files are sent with direct_passthrough, and are only buffered to be
+    # compressed if they have a compressible type.
+    is_file = response.direct_passthrough
+    if (response.status_code != 200
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or (response.is_streamed and not is_file)
+            or 'Content-Encoding' in response.headers
+            or 'X-Accel-Redirect' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    etag, is_weak = response.get_etag()
+    cache_key = (etag, encoding)
+    if is_file and etag is not None and cache_key in _file_cache:
+        response.close()
+        compressed = _file_cache[cache_key]
+    else:
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        if is_file and etag is not None:
+            compressed = _cache_compressed(cache_key, data, encoding)
+        else:
+            compressed = _compress(data, encoding)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # Ranges would refer to the uncompressed body.
+    response.headers.pop('Accept-Ranges', None)
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
@@ -1,3 +1,7 @@
+import fcntl
+import os
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
 
 
@@ -14,3 +18,33 @@ def get_files(root, extensions, recursive=True):
 IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif',
                     '.tiff', '.webp', '.gif')
 VIDEO_EXTENSIONS = ('.mp4', )
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path` (created if necessary).
+
+    Used to coordinate writes between multiple server processes."""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open a temporary file that replaces `path` when closed successfully.
+
+    Readers (possibly in other processes) never see a partially written
+    file."""
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
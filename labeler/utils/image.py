@@ -0,0 +1,15 @@
+def resize_image(source, output, width, quality=85):
+    """Save a copy of `source` downscaled to `width` pixels wide.
+
+    Images narrower than `width` are re-encoded without resizing. The output
+    format is inferred from the suffix of `output` (e.g. .jpg or .webp).
+    """
+    from PIL import Image
+    with Image.open(source) as image:
+        image.draft('RGB', (width, width))  # Fast downscaled JPEG decoding.
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        image.save(output, quality=quality)
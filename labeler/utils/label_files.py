@@ -0,0 +1,277 @@
+"""Stream rows from and to label files.
+
+Supported formats, by extension:
+    .json: labels.json, as written by label stores:
+        {"annotations": [<row>, ...], "labels": [<label>, ...]}
+    .jsonl: One row per line. The first line may instead be
+        {"labels": [<label>, ...]}, giving the label vocabulary.
+    .csv: One row per line, with a header. Rows are keyed by the 'key'
+        column, or by the 'video' column in older CSVs.
+
+Rows are read and written one at a time, so files larger than memory can be
+processed."""
+
+import contextlib
+import csv
+import gc
+import json
+import re
+from pathlib import Path
+
+from labeler.utils.fs import atomic_write
+
+FORMATS = {
+    '.json': 'json',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.csv': 'csv'
+}
+
+_WHITESPACE = re.compile(r'\s*')
+# Separator after a value in an array, with surrounding whitespace.
+_ARRAY_SEPARATOR = re.compile(r'\s*([,\]])\s*')
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector.
+
+    Parsed JSON has no reference cycles, but the collector repeatedly scans
+    the millions of objects created while parsing large files, tripling
+    parse time."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def label_format(path):
+    suffix = Path(path).suffix.lower()
+    if suffix not in FORMATS:
+        raise ValueError(f'Unknown label file format for {path}; expected '
+                         f'one of {sorted(FORMATS)}.')
+    return FORMATS[suffix]
+
+
+class _JsonStream:
+    """Parse JSON values one at a time from a file."""
+    def __init__(self, f, chunk_size=2**20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Read more of the file; return False at the end of the file."""
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return next non-whitespace character, or '' at end of file."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters):
+        """Consume and return the next character, one of `characters`."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f'Expected one of {characters!r} in '
+                             f'{self.f.name}, found {character!r}')
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending at the end of the buffer (e.g. a number)
+                # may continue in the next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def array_values(self):
+        """Yield the values of an array whose '[' was just consumed.
+
+        Faster than alternating value() and expect() for large arrays."""
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        decode = self.decoder.raw_decode
+        while True:
+            try:
+                value, end = decode(self.buffer, self.pos)
+                separator = _ARRAY_SEPARATOR.match(self.buffer, end)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                separator = None
+            # The value, or the separator after it, may continue in the next
+            # chunk.
+            if separator is None or (separator.end() == len(self.buffer)
+                                     and not self.eof):
+                if not self._fill() and separator is None:
+                    raise ValueError(f"Expected ',' or ']' in {self.f.name}")
+                continue
+            self.pos = separator.end()
+            yield value
+            if separator.group(1) == ']':
+                return
+
+
+class LabelReader:
+    """Iterate over (key, row) for rows of a label file.
+
+    The label vocabulary, if the file has one, is available as
+    `labels_list` once iteration finishes: labels.json files list it after
+    the rows."""
+    def __init__(self, path, key_column=None):
+        """
+        Args:
+            path (str or Path)
+            key_column (str): Field containing keys. Defaults to 'key', or
+                to 'video' for CSVs without a 'key' column.
+        """
+        self.path = Path(path)
+        self.format = label_format(path)
+        self.key_column = key_column
+        self.labels_list = None
+        # Columns of CSV files.
+        self.fieldnames = None
+
+    def __iter__(self):
+        with open(self.path, 'r', newline='') as f:
+            if self.format == 'json':
+                yield from self._read_json(f)
+            elif self.format == 'jsonl':
+                yield from self._read_jsonl(f)
+            else:
+                yield from self._read_csv(f)
+
+    def _read_json(self, f):
+        key_column = self.key_column or 'key'
+        stream = _JsonStream(f)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            name = stream.value()
+            stream.expect(':')
+            if name == 'annotations':
+                stream.expect('[')
+                for row in stream.array_values():
+                    yield row[key_column], row
+            elif name == 'labels':
+                self.labels_list = stream.value()
+            else:
+                stream.value()
+            if stream.expect(',}') == '}':
+                break
+
+    def _read_jsonl(self, f):
+        key_column = self.key_column or 'key'
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if i == 0 and key_column not in row and 'labels' in row:
+                self.labels_list = row['labels']
+                continue
+            yield row[key_column], row
+
+    def _read_csv(self, f):
+        reader = csv.DictReader(f)
+        self.fieldnames = reader.fieldnames or []
+        key_column = self.key_column
+        if key_column is None:
+            key_column = 'key' if 'key' in self.fieldnames else 'video'
+        if key_column not in self.fieldnames:
+            raise ValueError(f'{self.path} has no {key_column} column.')
+        for row in reader:
+            yield row[key_column], row
+
+
+class LabelWriter:
+    """Write rows to an open label file; see write_labels()."""
+    def __init__(self, f, format, labels_list=None, fieldnames=None):
+        self.f = f
+        self.format = format
+        self.labels_list = labels_list
+        self.fieldnames = fieldnames
+        self.num_rows = 0
+        self._csv_writer = None
+        if format == 'json':
+            self.f.write('{"annotations": [')
+        elif format == 'jsonl' and labels_list is not None:
+            self.f.write(json.dumps({'labels': labels_list}) + '\n')
+
+    def write(self, row):
+        if self.format == 'json':
+            if self.num_rows:
+                self.f.write(', ')
+            self.f.write(json.dumps(row))
+        elif self.format == 'jsonl':
+            self.f.write(json.dumps(row) + '\n')
+        else:
+            if self._csv_writer is None:
+                self._start_csv(self.fieldnames or list(row.keys()))
+            self._csv_writer.writerow({
+                k: v if isinstance(v, str) else json.dumps(v)
+                for k, v in row.items()
+            })
+        self.num_rows += 1
+
+    def _start_csv(self, fieldnames):
+        self._csv_writer = csv.DictWriter(self.f,
+                                          fieldnames=fieldnames,
+                                          extrasaction='ignore')
+        self._csv_writer.writeheader()
+
+    def finish(self):
+        if self.format == 'json':
+            self.f.write('], "labels": %s}' % json.dumps(self.labels_list))
+        elif (self.format == 'csv' and self._csv_writer is None
+              and self.fieldnames):
+            self._start_csv(self.fieldnames)
+
+
+@contextlib.contextmanager
+def write_labels(path, labels_list=None, fieldnames=None):
+    """Open a LabelWriter for `path`, which is replaced once all rows are
+    written.
+
+    Args:
+        path (str or Path)
+        labels_list (List[str]): Label vocabulary. Required for labels.json
+            files.
+        fieldnames (List[str]): CSV columns. Defaults to the fields of the
+            first row.
+    """
+    format = label_format(path)
+    if format == 'json' and labels_list is None:
+        raise ValueError(f'A label vocabulary is required to write {path}; '
+                         f'write a .jsonl or .csv file for inputs without '
+                         f'one.')
+    with atomic_write(path) as f:
+        writer = LabelWriter(f, format, labels_list, fieldnames)
+        yield writer
+        writer.finish()
@@ -0,0 +1,166 @@
+"""Disk cache for media files derived from source files (resized images,
+transcoded videos, etc.)."""
+
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from tqdm import tqdm
+
+from . import metrics
+
+REQUESTS = metrics.counter(
+    'labeler_media_requests_total',
+    'Requests for generated media files, by whether they were cached.',
+    ['generator', 'result'])
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'labeler_media_queue_wait_seconds',
+    'Time media generation jobs wait for a worker.', ['generator'])
+GENERATE_SECONDS = metrics.histogram('labeler_media_generate_seconds',
+                                     'Time to generate media files.',
+                                     ['generator'])
+
+
+def _generate_atomic(generate_fn, source, output, kwargs):
+    """Run generate_fn(source, tmp_output, **kwargs) and move result to output.
+
+    Writing to a temporary file first ensures that partially generated files
+    are never served, even if the generating process is killed.
+
+    Returns:
+        (start, end): Wall clock times generation started and ended.
+    """
+    start = time.time()
+    output = Path(output)
+    output.parent.mkdir(exist_ok=True, parents=True)
+    tmp_output = output.with_name(
+        f'.{output.stem}.{uuid.uuid4().hex}.tmp{output.suffix}')
+    try:
+        generate_fn(source, tmp_output, **kwargs)
+        os.replace(tmp_output, output)
+    finally:
+        if tmp_output.exists():
+            tmp_output.unlink()
+    return start, time.time()
+
+
+class MediaCache:
+    """Lazily generates files derived from source media, cached on disk.
+
+    Cached files live at `<cache_dir>/<relative path of source><suffix>`.
+    Generation runs in a worker pool; concurrent requests for the same file
+    share a single generation job.
+    """
+    def __init__(self,
+                 cache_dir,
+                 generate_fn,
+                 suffix,
+                 generate_kwargs=None,
+                 num_workers=4,
+                 use_processes=True):
+        """
+        Args:
+            cache_dir (str, Path)
+            generate_fn (callable): Called as
+                generate_fn(source, output, **generate_kwargs). Must be a
+                module-level function if use_processes is True.
+            suffix (str): Suffix of generated files, e.g. '.jpg'.
+            generate_kwargs (dict)
+            num_workers (int)
+            use_processes (bool): Use a process pool for CPU-bound work
+                (e.g. decoding images in Python). Use threads if generation
+                is mostly waiting on a subprocess, like ffmpeg.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.generate_fn = generate_fn
+        self.suffix = suffix
+        self.generate_kwargs = dict(generate_kwargs or {})
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Workers and pending jobs can't be pickled (e.g., in labeler
+        # snapshots); they are recreated when needed.
+        state = self.__dict__.copy()
+        state.update({'_executor': None, '_pending': {}, '_lock': None})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(self.num_workers)
+            else:
+                self._executor = ThreadPoolExecutor(self.num_workers)
+        return self._executor
+
+    def path(self, relative):
+        """Path of cached file for source at `relative` path."""
+        return self.cache_dir / f'{relative}{self.suffix}'
+
+    def submit(self, source, relative, **kwargs):
+        """Start generating cached file if necessary, without waiting.
+
+        Args:
+            source (str, Path)
+            relative (str): Path of the cached file, relative to cache_dir
+                (without suffix).
+            **kwargs: Passed to generate_fn, in addition to generate_kwargs.
+
+        Returns:
+            future (concurrent.futures.Future, None): None if the file is
+                already cached.
+        """
+        output = self.path(relative)
+        generator = self.generate_fn.__name__
+        if output.exists():
+            REQUESTS.inc(generator=generator, result='hit')
+            return None
+        REQUESTS.inc(generator=generator, result='miss')
+        with self._lock:
+            if output in self._pending:
+                return self._pending[output]
+            submitted = time.time()
+            future = self.executor.submit(_generate_atomic, self.generate_fn,
+                                          str(source), str(output), {
+                                              **self.generate_kwargs,
+                                              **kwargs
+                                          })
+            self._pending[output] = future
+        future.add_done_callback(
+            lambda x: self._done(output, x, generator, submitted))
+        return future
+
+    def _done(self, output, future, generator, submitted):
+        with self._lock:
+            self._pending.pop(output, None)
+        if future.exception() is None:
+            start, end = future.result()
+            QUEUE_WAIT_SECONDS.observe(max(start - submitted, 0),
+                                       generator=generator)
+            GENERATE_SECONDS.observe(end - start, generator=generator)
+
+    def get(self, source, relative, **kwargs):
+        """Return path of cached file, generating it if necessary."""
+        future = self.submit(source, relative, **kwargs)
+        if future is not None:
+            future.result()
+        return self.path(relative)
+
+    def precompute(self, items, desc=None):
+        """Generate cached files for all (source, relative) pairs in items."""
+        futures = [self.submit(source, relative) for source, relative in items]
+        futures = [x for x in futures if x is not None]
+        for future in tqdm(futures, desc=desc):
+            future.result()
@@ -0,0 +1,179 @@
+"""Counters and histograms, exported in Prometheus' text format.
+
+Metrics are kept in memory, per process. When serving with multiple worker
+processes (see labeler.serve), each scrape of /metrics reports the metrics
+of the worker that handled it.
+
+Usage:
+    REQUESTS = metrics.counter('requests_total', 'Requests.', ['route'])
+    REQUESTS.inc(route='/')
+    with metrics.timer('render'):
+        ...
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds of histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"'
+                          for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Metric {self.name} expects labels '
+                             f'{self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[x]) for x in self.labelnames)
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} '
+            f'{_format_value(value)}'
+        ]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self,
+                 name,
+                 documentation,
+                 labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'count': 0,
+                    'sum': 0.0
+                }
+            state = self._values[key]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state['buckets'][index] += 1
+            state['count'] += 1
+            state['sum'] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the context, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, state):
+        labels = _format_labels(self.labelnames, key)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['buckets']):
+            cumulative += count
+            bucket_labels = _format_labels(self.labelnames, key,
+                                           [('le', _format_value(bound))])
+            lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+        bucket_labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+        lines.append(f'{self.name}_bucket{bucket_labels} {state["count"]}')
+        lines.append(f'{self.name}_sum{labels} {_format_value(state["sum"])}')
+        lines.append(f'{self.name}_count{labels} {state["count"]}')
+        return lines
+
+
+def _get_or_create(cls, name, *args, **kwargs):
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, *args, **kwargs)
+        metric = _metrics[name]
+    if not isinstance(metric, cls):
+        raise ValueError(f'Metric {name} already exists as a {metric.type}')
+    return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """Return counter `name`, creating it if necessary."""
+    return _get_or_create(Counter, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Return histogram `name`, creating it if necessary."""
+    return _get_or_create(Histogram,
+                          name,
+                          documentation,
+                          labelnames,
+                          buckets=buckets)
+
+
+PHASE_SECONDS = histogram('labeler_phase_duration_seconds',
+                          'Duration of internal phases of handling requests.',
+                          ['phase'])
+
+
+def timer(phase):
+    """Time a phase of handling requests (e.g. 'render')."""
+    return PHASE_SECONDS.time(phase=phase)
+
+
+def render():
+    """Return all metrics in Prometheus' text exposition format."""
+    with _metrics_lock:
+        metrics = sorted(_metrics.values(), key=lambda x: x.name)
+    return '\n'.join(x.render() for x in metrics) + '\n'
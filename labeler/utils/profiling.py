@@ -0,0 +1,78 @@
+"""Profile a sample of requests with cProfile."""
+
+import cProfile
+import itertools
+import os
+import random
+import re
+import time
+from pathlib import Path
+
+# Profile file names: <time>_<pid>-<n>_<route>_<duration>ms.prof, where n
+# counts profiles saved by the process.
+PROFILE_NAME_RE = re.compile(r'^(?P<time>\d{8}-\d{6})_(?P<pid>\d+)-\d+_'
+                             r'(?P<route>.*)_(?P<ms>\d+)ms\.prof$')
+
+
+def route_slug(route):
+    """Make route (e.g., /api/boxes) safe to use in a file name."""
+    slug = re.sub(r'[^A-Za-z0-9.-]+', '_', route).strip('_')
+    return slug or 'index'
+
+
+class RequestProfiler:
+    """Profiles a random sample of requests, saving profiles to a directory.
+
+    Usage:
+        profile = profiler.start()  # At the start of a request.
+        ...
+        profiler.finish(profile, route, duration)
+    """
+    def __init__(self, output_dir, rate=1.0, min_seconds=0):
+        """
+        Args:
+            output_dir (str, Path): Directory to save profiles in.
+            rate (float): Fraction of requests to profile.
+            min_seconds (float): Only save profiles of requests that took at
+                least this long.
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        self.rate = rate
+        self.min_seconds = min_seconds
+        self._count = itertools.count()
+
+    def start(self):
+        """Start profiling the current request, if it is sampled.
+
+        Returns:
+            profile (cProfile.Profile, None)
+        """
+        if random.random() >= self.rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Only one profiler can be active at a time (e.g., if another
+            # thread is profiling a request).
+            return None
+        return profile
+
+    def finish(self, profile, route, duration):
+        """Stop `profile`, and save it if the request was slow enough.
+
+        Returns:
+            path (Path, None): Path of the saved profile, if any.
+        """
+        if profile is None:
+            return None
+        profile.disable()
+        if duration < self.min_seconds:
+            return None
+        name = (f'{time.strftime("%Y%m%d-%H%M%S")}_'
+                f'{os.getpid()}-{next(self._count)}_'
+                f'{route_slug(route)}_{round(duration * 1000)}ms.prof')
+        path = self.output_dir / name
+        profile.dump_stats(str(path))
+        return path
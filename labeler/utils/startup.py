@@ -0,0 +1,48 @@
+"""Time phases of constructing a labeler (listing files, loading labels...).
+
+Usage:
+    with startup.phase('list_files'):
+        ...
+    print(startup.format_phases())
+"""
+
+import contextlib
+import threading
+import time
+
+from . import metrics
+
+STARTUP_SECONDS = metrics.histogram(
+    'labeler_startup_phase_duration_seconds',
+    'Duration of phases of constructing the labeler.', ['phase'])
+
+# List of (depth, phase, seconds), in the order phases started.
+_phases = []
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a phase of startup. Phases may be nested."""
+    depth = getattr(_local, 'depth', 0)
+    entry = [depth, name, None]
+    _phases.append(entry)
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry[2] = time.perf_counter() - start
+        _local.depth = depth
+        STARTUP_SECONDS.observe(entry[2], phase=name)
+
+
+def format_phases(clear=True):
+    """Return breakdown of timed phases, indented by nesting."""
+    lines = ['Startup phases:']
+    for depth, name, seconds in _phases:
+        duration = f'{seconds:.3f}s' if seconds is not None else 'running'
+        lines.append(f'{"  " * (depth + 1)}{name}: {duration}')
+    if clear:
+        _phases.clear()
+    return '\n'.join(lines)
@@ -1,4 +1,7 @@
+import os
 import subprocess
+import tempfile
+from pathlib import Path
 
 
 def num_frames(video_path):
@@ -9,3 +12,101 @@ def num_frames(video_path):
     ]
     frames = subprocess.check_output(num_frames_cmd, stderr=subprocess.STDOUT)
     return int(frames.decode().strip())
+
+
+def transcode_proxy(video_path, output_path, height=360, crf=28):
+    """Transcode video to a small H.264 mp4 suitable for web playback.
+
+    The moov atom is moved to the start of the file (faststart) so browsers
+    can start playback before the whole file is downloaded. Videos shorter
+    than `height` are not upscaled.
+    """
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-i', str(video_path),
+        '-vf', f"scale=-2:'min({height},trunc(ih/2)*2)'",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(crf),
+        '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '64k',
+        '-movflags', '+faststart', '-f', 'mp4', str(output_path)
+    ]
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def gif_to_video(gif_path, output_path):
+    """Convert GIF to a muted mp4 (H.264) or webm (VP9) video.
+
+    The codec is chosen based on the suffix of `output_path`.
+    """
+    if str(output_path).endswith('.webm'):
+        codec = ['-c:v', 'libvpx-vp9', '-b:v', '0', '-crf', '40', '-f', 'webm']
+    else:
+        codec = [
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+            '-movflags', '+faststart', '-f', 'mp4'
+        ]
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-i', str(gif_path),
+        '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-pix_fmt', 'yuv420p',
+        '-an'
+    ] + codec + [str(output_path)]
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def extract_poster(video_path, output_path, width=None):
+    """Save a representative frame from the start of the video as an image.
+
+    Uses ffmpeg's `thumbnail` filter, which picks the most representative of
+    the first few frames (avoiding, e.g., black frames from fade-ins).
+    """
+    filters = 'thumbnail'
+    if width:
+        filters += f",scale='min({width},iw)':-2"
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-i', str(video_path),
+        '-vf', filters, '-frames:v', '1', '-q:v', '3', str(output_path)
+    ]
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def extract_frame(video_path, output_path, index):
+    """Save frame `index` (0-indexed) of the video as an image.
+
+    Frames are selected by index, as in extract_frames(), rather than by
+    seeking to a time, so both save the same frame."""
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-i', str(video_path), '-vf',
+        f"select='eq(n\\,{index})'", '-vsync', '0', '-frames:v', '1',
+        '-q:v', '2', str(output_path)
+    ]
+    subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+
+def extract_frames(video_path, outputs):
+    """Save multiple frames from a video as images, decoding it only once.
+
+    Args:
+        video_path (str, Path)
+        outputs (dict): Map frame index (0-indexed) to output image path. All
+            outputs should be on the same file system.
+    """
+    frames = sorted(outputs)
+    if not frames:
+        return
+    select = '+'.join(f'eq(n\\,{i})' for i in frames)
+    # Write frames to a temporary directory next to the outputs, so they can
+    # be moved in place atomically.
+    tmp_parent = Path(outputs[frames[0]]).parent
+    tmp_parent.mkdir(exist_ok=True, parents=True)
+    with tempfile.TemporaryDirectory(prefix='.', dir=tmp_parent) as tmp_dir:
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error', '-i', str(video_path), '-vf',
+            f"select='{select}'", '-vsync', '0', '-q:v', '2',
+            f'{tmp_dir}/%06d.jpg'
+        ]
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        # ffmpeg numbers output images from 1, in order of frame index.
+        for i, frame in enumerate(frames):
+            tmp_output = Path(tmp_dir) / f'{i + 1:06d}.jpg'
+            if not tmp_output.exists():  # Video has fewer frames than expected
+                break
+            Path(outputs[frame]).parent.mkdir(exist_ok=True, parents=True)
+            os.replace(tmp_output, outputs[frame])
@@ -13,13 +13,18 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('labels_json', nargs='+')
     parser.add_argument('output_txt', type=Path)
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        help=('Processes to parse large labels_json files with. Defaults to '
+              'the number of CPUs.'))
 
     args = parser.parse_args()
     args.output_txt.parent.mkdir(exist_ok=True, parents=True)
     common_setup(
         args.output_txt.name + '_' + Path(__file__).name,
         args.output_txt.parent, args)
-    labels, _ = load_labels(args.labels_json)
+    labels, _ = load_labels(args.labels_json, num_workers=args.num_workers)
 
     keys = sorted(labels.keys())
     with open(args.output_txt, 'w') as f: